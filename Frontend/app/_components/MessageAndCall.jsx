@@ -188,10 +188,11 @@ const MessageAndCall = () => {
     setMessage("");
     setLoading(true);
 
+    const domain = "https://klassy.com.bd/";
     const data = {
       query: message || suggest,
       userId: userName || "guest",
-      domain: "https://klassy.com.bd/",
+      domain,
       image: img,
     };
     axios
@@ -205,29 +206,38 @@ const MessageAndCall = () => {
         }
       )
       .then((res) => {
-        const data = {
-          user_message: message || suggest,
-          ai_response: res?.data?.response,
+        const setQuestions = (questionsString) => {
+          const questionsArray = questionsString
+            ?.split(", ")
+            .map((question) => question.trim());
+          setSuggestQuestion(questionsArray);
         };
 
-        axios
-          .post(
-            `http://localhost:8000/generate_questions`,
-            data,
-            {
-              headers: {
-                "Content-Type": "application/json",
-              },
-            }
-          )
-          .then((response) => {
-            const questionsString = response?.data?.questions;
-            const questionsArray = questionsString
-              ?.split(", ")
-              .map((question) => question.trim());
-            setSuggestQuestion(questionsArray);
-          })
-          .catch((err) => console.log(err));
+        if (res?.data?.suggestions) {
+          setQuestions(res.data.suggestions);
+        } else {
+          // The server has already started generating these; this returns them
+          const data = {
+            user_message: message || suggest,
+            ai_response: res?.data?.response,
+            userId: res?.data?.userId,
+            domain,
+            turn: res?.data?.turn,
+          };
+
+          axios
+            .post(
+              `http://localhost:8000/generate_questions`,
+              data,
+              {
+                headers: {
+                  "Content-Type": "application/json",
+                },
+              }
+            )
+            .then((response) => setQuestions(response?.data?.questions))
+            .catch((err) => console.log(err));
+        }
 
         const botResponse = {
           sender: "bot",
@@ -0,0 +1,137 @@
+"""
+Retention job for the chat_history table.
+
+    python archive_history.py --days 90
+    python archive_history.py --show user-123 --domain skincare
+
+Moves turns older than ``--days`` out of ``chat_history`` into
+``chat_history_archive``, one zlib-compressed JSON row per (user, domain) and
+run. The newest ``--keep`` turns of every conversation stay in place, since
+that is what a session is rebuilt from, unless a conversation summary
+(``CHAT_HISTORY_MODE=summary``) already covers them. Work is done in
+batches, each in its own transaction, so the server keeps writing while the
+job runs. Archived turns can be read back with ``--show``.
+"""
+import argparse
+import json
+import logging
+import time
+import zlib
+from datetime import datetime, timedelta
+from itertools import groupby
+
+logger = logging.getLogger("archive_history")
+
+
+def eligible_rows(db, cutoff, keep, limit):
+    """Up to ``limit`` (id, user_id, domain, query, response, timestamp) rows to archive."""
+    return db.execute('''
+        SELECT id, user_id, domain, query, response, timestamp FROM (
+            SELECT h.*,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY h.user_id, h.domain ORDER BY h.id DESC
+                   ) AS newest,
+                   COALESCE(s.position, 0) AS summarized
+            FROM chat_history h
+            LEFT JOIN session_summaries s
+              ON s.user_id = h.user_id AND s.domain = h.domain
+            WHERE h.timestamp < ?
+        )
+        WHERE newest > ? OR id <= summarized
+        ORDER BY user_id, domain, id
+        LIMIT ?
+    ''', (cutoff, keep, limit)).fetchall()
+
+
+def archive_batch(db, rows):
+    """Write one compressed archive row per conversation and delete the originals."""
+    archived_at = str(datetime.now())
+    archives = []
+    for (user_id, domain), turns in groupby(rows, key=lambda row: (row["user_id"], row["domain"])):
+        turns = list(turns)
+        data = json.dumps(
+            [[row["id"], row["query"], row["response"], row["timestamp"]] for row in turns],
+            ensure_ascii=False,
+        ).encode("utf-8")
+        archives.append((
+            user_id, domain, turns[0]["id"], turns[-1]["id"], len(turns),
+            turns[0]["timestamp"], turns[-1]["timestamp"], archived_at, zlib.compress(data, 9),
+        ))
+    with db:
+        db.executemany('''
+            INSERT INTO chat_history_archive
+            (user_id, domain, first_id, last_id, turns, first_timestamp, last_timestamp, archived_at, data)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', archives)
+        db.executemany("DELETE FROM chat_history WHERE id = ?", [(row["id"],) for row in rows])
+    return len(archives), sum(len(row["query"]) + len(row["response"]) for row in rows)
+
+
+def archive(args):
+    import main
+
+    cutoff = (datetime.utcnow() - timedelta(days=args.days)).strftime('%Y-%m-%d %H:%M:%S')
+    started = time.time()
+    summary = {"cutoff": cutoff, "turns": 0, "archive_rows": 0, "text_bytes": 0, "compressed_bytes": 0}
+    with main.get_db() as db:
+        while True:
+            rows = eligible_rows(db, cutoff, args.keep, args.batch_size)
+            if not rows:
+                break
+            if args.dry_run:
+                summary["turns"] = len(rows)
+                summary["dry_run"] = True
+                break
+            archive_rows, text_bytes = archive_batch(db, rows)
+            summary["turns"] += len(rows)
+            summary["archive_rows"] += archive_rows
+            summary["text_bytes"] += text_bytes
+            logger.info(f"Archived {len(rows)} turns")
+
+        summary["compressed_bytes"] = db.execute(
+            "SELECT COALESCE(SUM(LENGTH(data)), 0) FROM chat_history_archive WHERE archived_at >= ?",
+            (str(datetime.fromtimestamp(started)),),
+        ).fetchone()[0]
+        summary["hot_rows"] = db.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0]
+        if args.vacuum and not args.dry_run:
+            db.execute("VACUUM")
+
+    summary["seconds"] = round(time.time() - started, 2)
+    return summary
+
+
+def show(args):
+    """Archived turns of one user, oldest first."""
+    import main
+
+    query = "SELECT domain, data FROM chat_history_archive WHERE user_id = ?"
+    params = [args.show]
+    if args.domain:
+        query += " AND domain = ?"
+        params.append(args.domain)
+    turns = []
+    with main.get_db() as db:
+        for row in db.execute(query + " ORDER BY domain, first_id", params):
+            for id_, user_message, response, timestamp in json.loads(zlib.decompress(row["data"])):
+                turns.append({
+                    "id": id_, "domain": row["domain"], "timestamp": timestamp,
+                    "query": user_message, "response": response,
+                })
+    return turns
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=float, default=90, help="Archive turns older than this")
+    parser.add_argument("--keep", type=int, default=20, help="Newest turns kept per conversation")
+    parser.add_argument("--batch-size", type=int, default=5000, help="Turns moved per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="Count the first batch without moving it")
+    parser.add_argument("--vacuum", action="store_true", help="Reclaim the freed space afterwards")
+    parser.add_argument("--show", metavar="USER_ID", help="Print a user's archived turns instead")
+    parser.add_argument("--domain", help="With --show, only this domain")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(json.dumps(show(args) if args.show else archive(args), indent=2, ensure_ascii=False))
@@ -0,0 +1,407 @@
+"""
+Load test the API against a local OpenAI stand-in.
+
+    python benchmark.py --users 200 --concurrency 32 --requests 2000
+    python benchmark.py --duration 60 --mix chat=6,image=1,questions=2,churn=1 --rate-limit-ratio 0.02
+    python benchmark.py --compare benchmarks/before.json benchmarks/after.json
+
+Starts ``fake_openai.py`` and the API (``uvicorn main:app``, with its own
+SQLite file) as subprocesses, waits for ``/ready``, then sends a weighted
+mix of requests from a fixed pool of users at the given concurrency:
+
+- ``chat``: text ``/chat`` from a returning user
+- ``image``: ``/chat`` with a generated JPEG
+- ``stream``: ``/chat/stream``
+- ``questions``: ``/generate_questions``
+- ``churn``: ``/chat`` from a user never seen before
+
+Reports p50/p95/p99 latency per request type, requests per second, event
+loop lag (the latency of ``/health`` probes sent alongside the load), the
+API process's RSS growth and the SQLite write rate from ``/stats``. The
+results are written as JSON with the commit they were measured on, and
+``--compare`` prints the change between two result files. With ``--target``
+an already running API is measured instead; it must be configured to use the
+fake server itself.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+import numpy as np
+from PIL import Image
+
+QUERIES = [
+    "What cleanser should I use for oily skin?",
+    "I have acne on my forehead, what can help?",
+    "Recommend a moisturizer for dry skin in winter",
+    "Which sunscreen works under makeup?",
+    "How do I reduce dark spots?",
+    "Is niacinamide good for large pores?",
+    "What is a simple night routine for sensitive skin?",
+    "Can I use retinol and vitamin C together?",
+]
+OPERATIONS = ("chat", "image", "stream", "questions", "churn")
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": round(float(values.mean()), 2),
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "p95_ms": round(float(np.percentile(values, 95)), 2),
+        "p99_ms": round(float(np.percentile(values, 99)), 2),
+        "max_ms": round(float(values.max()), 2),
+    }
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name!r}, expected one of {OPERATIONS}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def make_image(rng, size):
+    pixels = rng.integers(0, 256, size=(size, size, 3), dtype=np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
+def rss_bytes(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], text=True).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+class Workload:
+    """Generates requests and records their latencies."""
+
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.image_rng = np.random.default_rng(args.seed)
+        self.mix = parse_mix(args.mix)
+        self.users = [f"bench-user-{index}" for index in range(args.users)]
+        self.turns = {}
+        self.latencies = {name: [] for name in self.mix}
+        self.errors = {name: {} for name in self.mix}
+        self.churned = 0
+        self.image = make_image(self.image_rng, args.image_size)
+
+    def _pick(self):
+        names = list(self.mix)
+        return self.rng.choices(names, weights=[self.mix[name] for name in names])[0]
+
+    def _image(self):
+        if self.args.unique_images:
+            return make_image(self.image_rng, self.args.image_size)
+        return self.image
+
+    async def _chat(self, user_id, files=None):
+        data = {"query": self.rng.choice(QUERIES), "userId": user_id, "domain": self.args.domain}
+        response = await self.client.post("/chat", data=data, files=files)
+        if response.status_code == 200:
+            self.turns[user_id] = response.json().get("turn")
+        return response
+
+    async def _stream(self, user_id):
+        data = {"query": self.rng.choice(QUERIES), "userId": user_id, "domain": self.args.domain}
+        async with self.client.stream("POST", "/chat/stream", data=data) as response:
+            async for _ in response.aiter_bytes():
+                pass
+        return response
+
+    async def _questions(self, user_id):
+        payload = {
+            "user_message": self.rng.choice(QUERIES),
+            "ai_response": "Use a gentle cleanser twice a day and a light moisturizer.",
+            "userId": user_id,
+            "turn": self.turns.get(user_id),
+        }
+        return await self.client.post("/generate_questions", json=payload)
+
+    async def run_one(self, record=True):
+        name = self._pick()
+        user_id = self.rng.choice(self.users)
+        started = time.perf_counter()
+        try:
+            if name == "chat":
+                response = await self._chat(user_id)
+            elif name == "image":
+                response = await self._chat(user_id, files={"image": ("photo.jpg", self._image(), "image/jpeg")})
+            elif name == "stream":
+                response = await self._stream(user_id)
+            elif name == "questions":
+                response = await self._questions(user_id)
+            else:
+                self.churned += 1
+                response = await self._chat(f"bench-churn-{self.args.seed}-{self.churned}")
+            outcome = None if response.status_code == 200 else str(response.status_code)
+        except httpx.HTTPError as e:
+            outcome = type(e).__name__
+        if not record:
+            return
+        if outcome is None:
+            self.latencies[name].append(time.perf_counter() - started)
+        else:
+            self.errors[name][outcome] = self.errors[name].get(outcome, 0) + 1
+
+
+async def probe_loop_lag(client, interval, samples, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            await client.get("/health")
+            samples.append(time.perf_counter() - started)
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(interval)
+
+
+async def sample_rss(pid, samples, stop):
+    while not stop.is_set():
+        rss = rss_bytes(pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(1)
+
+
+async def run_load(args, base_url, pid):
+    limits = httpx.Limits(max_connections=args.concurrency + 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        workload = Workload(client, args)
+        for _ in range(args.warmup_requests):
+            await workload.run_one(record=False)
+
+        before = (await client.get("/stats")).json()
+        stop = asyncio.Event()
+        lag, rss = [], []
+        monitors = [asyncio.create_task(probe_loop_lag(client, args.probe_interval, lag, stop))]
+        if pid is not None:
+            monitors.append(asyncio.create_task(sample_rss(pid, rss, stop)))
+
+        sent = 0
+        started = time.perf_counter()
+        deadline = started + args.duration if args.duration else None
+
+        async def worker():
+            nonlocal sent
+            while (deadline is None and sent < args.requests) or (deadline and time.perf_counter() < deadline):
+                sent += 1
+                await workload.run_one()
+
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await asyncio.gather(*monitors)
+        await asyncio.sleep(0.5)  # let the write-behind queue flush
+        after = (await client.get("/stats")).json()
+
+    completed = sum(len(samples) for samples in workload.latencies.values())
+    failed = sum(sum(errors.values()) for errors in workload.errors.values())
+    rows = after["db_writer"]["rows"] - before["db_writer"]["rows"]
+    return {
+        "duration_seconds": round(elapsed, 2),
+        "requests": completed + failed,
+        "errors": failed,
+        "requests_per_second": round(completed / elapsed, 2),
+        "latency": {name: percentiles(samples) for name, samples in workload.latencies.items()},
+        "errors_by_operation": workload.errors,
+        "event_loop_lag": percentiles(lag),
+        "rss_mb": {
+            "start": round(rss[0] / 2**20, 1),
+            "peak": round(max(rss) / 2**20, 1),
+            "end": round(rss[-1] / 2**20, 1),
+            "growth": round((rss[-1] - rss[0]) / 2**20, 1),
+        } if rss else None,
+        "sqlite": {
+            "rows_written": rows,
+            "batches": after["db_writer"]["batches"] - before["db_writer"]["batches"],
+            "rows_per_second": round(rows / elapsed, 2),
+        },
+        "app_stats": after,
+    }
+
+
+def wait_until_ready(url, process, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+
+def start_services(args, workdir):
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    fake = subprocess.Popen([
+        sys.executable, "fake_openai.py",
+        "--port", str(args.fake_port),
+        "--latency", args.latency,
+        "--vision-latency", args.vision_latency,
+        "--ttft", args.ttft,
+        "--token-interval", str(args.token_interval),
+        "--embedding-latency", args.embedding_latency,
+        "--rate-limit-ratio", str(args.rate_limit_ratio),
+        "--seed", str(args.seed),
+    ])
+    env = {
+        **os.environ,
+        "OPENAI_API_KEYS": ",".join(f"sk-bench-{index}" for index in range(1, args.keys + 1)),
+        "OPENAI_BASE_URL": f"{fake_url}/v1",
+        "OPENAI_API_BASE": f"{fake_url}/v1",
+        "DB_PATH": os.path.join(workdir, "benchmark.db"),
+        "STARTUP_WARMUP": "true",
+    }
+    for item in args.app_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+        env=env,
+    )
+    wait_until_ready(f"{fake_url}/stats", fake, 30)
+    wait_until_ready(f"http://127.0.0.1:{args.port}/ready", app, args.startup_timeout)
+    return fake, app
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def change(before, after):
+        if not before or after is None:
+            return "n/a"
+        return f"{before:>9.1f} -> {after:>9.1f} ({(after - before) / before * 100:+.1f}%)"
+
+    print(f"{old_path} ({old['meta']['commit']}) -> {new_path} ({new['meta']['commit']})")
+    print(f"{'requests/s':<22}{change(old['results']['requests_per_second'], new['results']['requests_per_second'])}")
+    for name in new["results"]["latency"]:
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            before = old["results"]["latency"].get(name, {}).get(key)
+            after = new["results"]["latency"][name].get(key)
+            print(f"{name + ' ' + key:<22}{change(before, after)}")
+    print(f"{'loop lag p99_ms':<22}{change(old['results']['event_loop_lag'].get('p99_ms'), new['results']['event_loop_lag'].get('p99_ms'))}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit")
+    parser.add_argument("--target", help="Measure an already running API at this URL")
+    parser.add_argument("--pid", type=int, help="Process id of the --target API, for RSS")
+    parser.add_argument("--port", type=int, default=8905)
+    parser.add_argument("--fake-port", type=int, default=8900)
+    parser.add_argument("--keys", type=int, default=1, help="Fake API keys given to the API")
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE", help="Extra API setting")
+    parser.add_argument("--startup-timeout", type=float, default=120)
+
+    parser.add_argument("--users", type=int, default=100, help="Returning users")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500, help="Requests to send (unless --duration)")
+    parser.add_argument("--duration", type=float, help="Seconds to send requests for")
+    parser.add_argument("--warmup-requests", type=int, default=10, help="Unmeasured requests sent first")
+    parser.add_argument("--mix", default="chat=6,image=1,questions=2,churn=1", help="Weighted operations")
+    parser.add_argument("--domain", default="skincare")
+    parser.add_argument("--image-size", type=int, default=512, help="Side of the generated JPEG")
+    parser.add_argument("--unique-images", action="store_true", help="New image per request (no caption cache hits)")
+    parser.add_argument("--probe-interval", type=float, default=0.1, help="Seconds between /health probes")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+
+    parser.add_argument("--latency", default="lognormal:0.6:0.3", help="Fake non-streaming completion latency")
+    parser.add_argument("--vision-latency", default="lognormal:1.5:0.3")
+    parser.add_argument("--ttft", default="lognormal:0.4:0.3", help="Fake time to first streamed token")
+    parser.add_argument("--token-interval", type=float, default=0.01)
+    parser.add_argument("--embedding-latency", default="lognormal:0.15:0.3")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="Share of fake calls answered with 429")
+
+    parser.add_argument("--output", help="Result file (default benchmarks/<time>-<commit>.json)")
+    return parser.parse_args(argv)
+
+
+def main(args):
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    commit, dirty = git_commit()
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            if args.target:
+                base_url, pid = args.target, args.pid
+            else:
+                processes = start_services(args, workdir)
+                base_url, pid = f"http://127.0.0.1:{args.port}", processes[1].pid
+            results = asyncio.run(run_load(args, base_url, pid))
+            if not args.target:
+                results["fake_openai"] = httpx.get(f"http://127.0.0.1:{args.fake_port}/stats").json()
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    report = {
+        "meta": {
+            "commit": commit,
+            "dirty": dirty,
+            "timestamp": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "args": {key: value for key, value in vars(args).items() if key != "compare"},
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        "benchmarks", f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{commit or 'unknown'}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    summary = {key: results[key] for key in ("requests", "errors", "requests_per_second")}
+    summary["latency_p95_ms"] = {name: stats.get("p95_ms") for name, stats in results["latency"].items()}
+    summary["event_loop_lag_p99_ms"] = results["event_loop_lag"].get("p99_ms")
+    print(json.dumps(summary, indent=2))
+    print(f"Saved {output}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,210 @@
+"""
+Local stand-in for the OpenAI API, for load tests that should not cost money.
+
+    python fake_openai.py --port 8900 --latency lognormal:0.8:0.3 --rate-limit-ratio 0.02
+
+Serves ``/v1/chat/completions`` (plain, streaming and vision requests) and
+``/v1/embeddings``. Every response is delayed by a sample from a configurable
+distribution, and a share of requests can be answered with a 429 and a
+Retry-After header. Point the API at it with ``OPENAI_BASE_URL`` and
+``OPENAI_API_BASE`` set to ``http://127.0.0.1:<port>/v1``. Counters are served
+at ``/stats``.
+
+Distributions are written as ``fixed:S``, ``uniform:LOW:HIGH``,
+``lognormal:MEDIAN:SIGMA`` or ``exp:MEAN``, in seconds.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import time
+import uuid
+from collections import defaultdict
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DEFAULT_ANSWER = (
+    "For oily, acne-prone skin, cleanse twice a day with a gentle salicylic acid "
+    "cleanser, follow with a light moisturizer and use sunscreen every morning."
+    "<products><product>COSRX Salicylic Acid Daily Gentle Cleanser 150ml</product></products>"
+)
+DEFAULT_COMPLETION = "How often should I exfoliate?, Which moisturizer suits oily skin?, Is sunscreen needed indoors?"
+
+
+def parse_distribution(spec):
+    """Return a function sampling seconds from a ``kind:params`` spec."""
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(":") if value]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(np.log(values[0]), values[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1 / values[0])
+    raise ValueError(f"Unknown distribution {spec!r}")
+
+
+def fake_vector(text, dimensions):
+    """A deterministic unit vector, so equal texts embed equally."""
+    seed = int.from_bytes(hashlib.sha256(str(text).encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).normal(size=dimensions).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def has_image(messages):
+    return any(
+        isinstance(message.get("content"), list)
+        and any(part.get("type") == "image_url" for part in message["content"])
+        for message in messages
+    )
+
+
+def create_app(args):
+    app = FastAPI()
+    random.seed(args.seed)
+    latency = parse_distribution(args.latency)
+    vision_latency = parse_distribution(args.vision_latency)
+    ttft = parse_distribution(args.ttft)
+    embedding_latency = parse_distribution(args.embedding_latency)
+    stats = defaultdict(int)
+
+    def rate_limited(kind):
+        if random.random() >= args.rate_limit_ratio:
+            return None
+        stats[f"{kind}_rate_limited"] += 1
+        return JSONResponse(
+            status_code=429,
+            headers={"retry-after": f"{args.retry_after:g}"},
+            content={"error": {
+                "message": "Rate limit reached (injected by fake_openai)",
+                "type": "requests",
+                "code": "rate_limit_exceeded",
+            }},
+        )
+
+    def usage(prompt, completion):
+        prompt_tokens = len(prompt) // 4 + 1
+        completion_tokens = len(completion) // 4 + 1
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        vision = has_image(messages)
+        kind = "vision" if vision else "stream" if body.get("stream") else "chat"
+        stats[f"{kind}_requests"] += 1
+        limited = rate_limited(kind)
+        if limited is not None:
+            return limited
+
+        streaming = body.get("stream") and not vision
+        text = DEFAULT_ANSWER if streaming else args.caption if vision else DEFAULT_COMPLETION
+        prompt = json.dumps(messages)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        model = body.get("model", "gpt-4o")
+
+        if not streaming:
+            await asyncio.sleep(vision_latency() if vision else latency())
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage(prompt, text),
+            }
+
+        def chunk(delta, finish_reason=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(payload)}\n\n"
+
+        async def stream():
+            await asyncio.sleep(ttft())
+            yield chunk({"role": "assistant", "content": ""})
+            for piece in text.split(" "):
+                yield chunk({"content": piece + " "})
+                await asyncio.sleep(args.token_interval)
+            yield chunk({}, "stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        stats["embedding_requests"] += 1
+        limited = rate_limited("embedding")
+        if limited is not None:
+            return limited
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        stats["embedded_inputs"] += len(inputs)
+        dimensions = body.get("dimensions") or args.dimensions
+        await asyncio.sleep(embedding_latency())
+
+        data = []
+        for index, text in enumerate(inputs):
+            vector = fake_vector(text, dimensions)
+            if body.get("encoding_format") == "base64":
+                encoded = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+            else:
+                encoded = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": encoded})
+        tokens = sum(len(str(text)) // 4 + 1 for text in inputs)
+        return {
+            "object": "list",
+            "data": data,
+            "model": body.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    @app.get("/stats")
+    async def get_stats():
+        return dict(stats)
+
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", default="lognormal:0.6:0.3", help="Non-streaming chat completions")
+    parser.add_argument("--vision-latency", default="lognormal:1.5:0.3", help="Requests with an image")
+    parser.add_argument("--ttft", default="lognormal:0.4:0.3", help="Time to the first streamed token")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="Seconds between streamed words")
+    parser.add_argument("--embedding-latency", default="lognormal:0.15:0.3")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--dimensions", type=int, default=1536, help="Embedding size when not requested")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for latencies and injected 429s")
+    parser.add_argument("--caption", default="A close-up photo of skin with a few small red blemishes on the cheek.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
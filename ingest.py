@@ -0,0 +1,256 @@
+"""
+Incremental ingestion into the Chroma vector store.
+
+    python ingest.py data/products.csv docs/faq/ --domain skincare
+    python ingest.py data/ --collection langchain --prune
+
+Sources are CSV files (one chunk per row, like the bundled product
+catalogue) and text or Markdown files (split into overlapping chunks), loaded
+in parallel worker processes. Every chunk gets an id hashed from its source
+and content, so re-running only embeds chunks that are new or changed, using
+the server's embedding model and cache, in rate-limited batches that are
+upserted as they finish. Chunks that disappeared from a source are deleted,
+and sources that no longer exist on disk (or, with ``--prune``, were not part
+of this run) are removed and recorded in the ``ingest_tombstones`` table.
+The server picks up the changes on its next request.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger("ingest")
+
+SOURCE_EXTENSIONS = (".csv", ".txt", ".md")
+GET_PAGE_SIZE = 5000
+
+
+def expand_sources(paths):
+    """Absolute paths of the supported files in ``paths``, recursing into directories."""
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                sources.extend(
+                    os.path.join(root, name) for name in sorted(files)
+                    if name.lower().endswith(SOURCE_EXTENSIONS)
+                )
+        else:
+            sources.append(path)
+    return sorted({os.path.abspath(source) for source in sources})
+
+
+def chunk_id(source, content):
+    return hashlib.sha256(f"{source}\0{content}".encode("utf-8")).hexdigest()[:40]
+
+
+def load_source(source, chunk_size, chunk_overlap):
+    """Split one source into (id, text, metadata) chunks. Runs in a worker process."""
+    from langchain_community.document_loaders import CSVLoader, TextLoader
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    if source.lower().endswith(".csv"):
+        documents = CSVLoader(source, encoding="utf-8").load()
+    else:
+        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        documents = splitter.split_documents(TextLoader(source, encoding="utf-8").load())
+
+    chunks, seen = [], set()
+    for position, document in enumerate(documents):
+        content = document.page_content.strip()
+        if not content:
+            continue
+        id_ = chunk_id(source, content)
+        if id_ in seen:
+            continue
+        seen.add(id_)
+        metadata = {
+            key: value for key, value in document.metadata.items()
+            if isinstance(value, (str, int, float, bool))
+        }
+        metadata.update({
+            "source": source,
+            "chunk": position,
+            "content_hash": hashlib.sha256(content.encode("utf-8")).hexdigest(),
+        })
+        chunks.append((id_, content, metadata))
+    return chunks
+
+
+def load_sources(sources, workers, chunk_size, chunk_overlap):
+    """Chunk every source in parallel. Returns {source: [(id, text, metadata), ...]}."""
+    if workers <= 1 or len(sources) <= 1:
+        return {source: load_source(source, chunk_size, chunk_overlap) for source in sources}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(
+            load_source, sources, [chunk_size] * len(sources), [chunk_overlap] * len(sources)
+        )
+        return dict(zip(sources, results))
+
+
+def existing_chunks(collection):
+    """{id: source} for the chunks this pipeline previously wrote to ``collection``."""
+    found, offset = {}, 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=GET_PAGE_SIZE, offset=offset)
+        for id_, metadata in zip(page["ids"], page["metadatas"]):
+            # Chunks without a content hash were not written by this pipeline
+            if metadata and "content_hash" in metadata:
+                found[id_] = metadata.get("source")
+        if len(page["ids"]) < GET_PAGE_SIZE:
+            return found
+        offset += GET_PAGE_SIZE
+
+
+class Embedder:
+    """Embeds batches concurrently under request and token per-minute limits."""
+
+    def __init__(self, embedding, rpm, tpm, concurrency):
+        import main
+
+        self.main = main
+        self.embedding = embedding
+        self.requests = main.TokenBucket(rpm)
+        self.tokens = main.TokenBucket(tpm)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.lock = asyncio.Lock()
+        self.batches = 0
+        self.retries = 0
+
+    async def _reserve(self, tokens):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+                if wait <= 0:
+                    self.requests.consume(1, now)
+                    self.tokens.consume(tokens, now)
+                    return
+                await asyncio.sleep(wait)
+
+    async def embed(self, texts, max_attempts):
+        tokens = sum(self.main.count_tokens(text) for text in texts)
+        async with self.semaphore:
+            for attempt in range(1, max_attempts + 1):
+                await self._reserve(tokens)
+                try:
+                    vectors = await self.embedding.aembed_documents(texts)
+                    self.batches += 1
+                    return vectors
+                except Exception as e:
+                    if attempt == max_attempts:
+                        raise
+                    self.retries += 1
+                    delay = self.main.retry_after_seconds(e) or self.main.retry_delay(attempt)
+                    logger.warning(f"Embedding batch failed ({str(e)}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+
+
+def record_tombstones(collection_name, tombstones):
+    import main
+
+    deleted_at = str(datetime.now())
+    with main.get_db() as db:
+        db.executemany(
+            "INSERT INTO ingest_tombstones (collection, source, chunks, deleted_at) VALUES (?, ?, ?, ?)",
+            [(collection_name, source, count, deleted_at) for source, count in tombstones.items()],
+        )
+        db.commit()
+
+
+async def ingest(args):
+    import main
+
+    collection_name = args.collection or main.domain_retrievers.collection_name(args.domain)
+    sources = expand_sources(args.paths)
+    started = time.time()
+    chunks_by_source = load_sources(sources, args.workers, args.chunk_size, args.chunk_overlap)
+    chunks = {id_: (text, metadata) for items in chunks_by_source.values() for id_, text, metadata in items}
+    logger.info(f"Loaded {len(chunks)} chunks from {len(sources)} sources in {time.time() - started:.1f}s")
+
+    collection = main.chroma.get().get_or_create_collection(collection_name, embedding_function=None)
+    existing = await asyncio.to_thread(existing_chunks, collection)
+
+    new_ids = [id_ for id_ in chunks if id_ not in existing]
+    loaded = set(chunks_by_source)
+    stale = [id_ for id_, source in existing.items() if source in loaded and id_ not in chunks]
+    tombstones = {}
+    for id_, source in existing.items():
+        if source in loaded:
+            continue
+        if not os.path.exists(source) or args.prune:
+            tombstones.setdefault(source, []).append(id_)
+
+    summary = {
+        "collection": collection_name,
+        "sources": len(sources),
+        "chunks": len(chunks),
+        "unchanged": len(chunks) - len(new_ids),
+        "embedded": len(new_ids),
+        "deleted_chunks": len(stale),
+        "tombstoned_sources": len(tombstones),
+        "tombstoned_chunks": sum(len(ids) for ids in tombstones.values()),
+    }
+    if args.dry_run:
+        summary["dry_run"] = True
+        return summary
+
+    embedder = Embedder(main.embedding, args.rpm, args.tpm, args.concurrency)
+
+    async def upsert_batch(ids):
+        texts = [chunks[id_][0] for id_ in ids]
+        vectors = await embedder.embed(texts, args.max_attempts)
+        await asyncio.to_thread(
+            collection.upsert,
+            ids=ids,
+            embeddings=[list(vector) for vector in vectors],
+            documents=texts,
+            metadatas=[chunks[id_][1] for id_ in ids],
+        )
+        logger.info(f"Upserted {len(ids)} chunks into {collection_name}")
+
+    await asyncio.gather(*[
+        upsert_batch(new_ids[start:start + args.batch_size])
+        for start in range(0, len(new_ids), args.batch_size)
+    ])
+
+    removed = stale + [id_ for ids in tombstones.values() for id_ in ids]
+    for start in range(0, len(removed), GET_PAGE_SIZE):
+        await asyncio.to_thread(collection.delete, ids=removed[start:start + GET_PAGE_SIZE])
+    if tombstones:
+        record_tombstones(collection_name, {source: len(ids) for source, ids in tombstones.items()})
+
+    summary.update({
+        "embedding_batches": embedder.batches,
+        "embedding_retries": embedder.retries,
+        "seconds": round(time.time() - started, 2),
+    })
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="Files or directories to ingest")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--domain", help="Ingest into this domain's collection")
+    target.add_argument("--collection", help="Ingest into this Chroma collection")
+    parser.add_argument("--prune", action="store_true", help="Tombstone sources not included in this run")
+    parser.add_argument("--dry-run", action="store_true", help="Report the diff without writing")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--chunk-overlap", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=256, help="Chunks per embedding request")
+    parser.add_argument("--concurrency", type=int, default=4, help="Embedding requests in flight")
+    parser.add_argument("--rpm", type=float, default=3000, help="Embedding requests per minute")
+    parser.add_argument("--tpm", type=float, default=1000000, help="Embedding tokens per minute")
+    parser.add_argument("--max-attempts", type=int, default=5)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    print(json.dumps(asyncio.run(ingest(parse_args())), indent=2))
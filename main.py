@@ -1,45 +1,210 @@
 # Importing Required Libraries
 import os
+import json
 import logging
 import sqlite3
 import asyncio
 import re
 import time
-import tempfile
-from typing import Dict, Optional
+import random
+import io
+import hashlib
+import threading
+import queue
+import difflib
+import bisect
+import heapq
+import itertools
+import math
+import uuid
+import importlib
+from typing import TYPE_CHECKING, Any, Optional
 from datetime import datetime
-from itertools import cycle
-from contextlib import contextmanager
-from collections import defaultdict
-from fastapi import FastAPI, HTTPException, File, UploadFile
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, asynccontextmanager
+from collections import defaultdict, deque, OrderedDict
+from fastapi import FastAPI, HTTPException, File, UploadFile, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from openai import OpenAI
+from PIL import Image as PILImage, ImageOps, UnidentifiedImageError
 import base64
-from starlette.background import BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from langchain_community.chat_models import ChatOpenAI
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.vectorstores import Chroma
+from langchain.chat_models.base import BaseChatModel
 from langchain.chains import ConversationalRetrievalChain
-from langchain.prompts import PromptTemplate
-from langchain.memory import ConversationBufferWindowMemory
-from langchain.schema import HumanMessage, SystemMessage
+from langchain.prompts import (
+    ChatPromptTemplate,
+    SystemMessagePromptTemplate,
+    HumanMessagePromptTemplate,
+)
+from langchain.schema import HumanMessage, SystemMessage, Document, BaseRetriever
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.callbacks.manager import AsyncCallbackManagerForChainRun
+from langchain.embeddings.base import Embeddings
 from datetime import datetime
 from fastapi import UploadFile, File, Form
 import xml.etree.ElementTree as ET
 from dotenv import load_dotenv
+import numpy as np
+
+# The OpenAI SDK, Chroma and the embedding client are slow to import; they
+# are loaded when the component that needs them is first built.
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
 
 
 load_dotenv()
 
+
+def env_flag(name: str, default: bool = False) -> bool:
+    """Read a boolean setting such as "true"/"1"/"yes" from the environment."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class Component:
+    """
+    A dependency built on first use instead of at import time.
+
+    ``get()`` builds it once, even when several threads ask at the same
+    time; a failed build is logged and retried on the next call. ``check()``
+    builds it if needed and runs the optional ``probe`` on it, and
+    ``status()`` is what ``/ready`` reports.
+    """
+
+    def __init__(self, name, build, probe=None):
+        self.name = name
+        self.build = build
+        self.probe = probe
+        self._lock = threading.Lock()
+        self._value = None
+        self._built = False
+        self.build_seconds = None
+        self.error = None
+
+    def get(self):
+        if self._built:
+            return self._value
+        with self._lock:
+            if not self._built:
+                started = time.perf_counter()
+                try:
+                    self._value = self.build()
+                except Exception as e:
+                    self.error = str(e)
+                    logger.error(f"Error initializing {self.name}: {str(e)}")
+                    raise
+                self.build_seconds = time.perf_counter() - started
+                self._built = True
+                self.error = None
+                logger.info(f"Initialized {self.name} in {self.build_seconds:.2f}s")
+        return self._value
+
+    def check(self):
+        """Build the component and run its probe; returns whether both succeeded."""
+        try:
+            value = self.get()
+            if self.probe is not None:
+                self.probe(value)
+        except Exception as e:
+            self.error = str(e)
+            return False
+        self.error = None
+        return True
+
+    def status(self):
+        return {
+            "ready": self._built and self.error is None,
+            "build_seconds": self.build_seconds,
+            "error": self.error,
+        }
+
+
+STARTUP_WARMUP = env_flag("STARTUP_WARMUP", False)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Start the write-behind queue and, when enabled, warm up in the
+    background; components are otherwise built by the first request (or
+    ``/ready``) that needs them. Queued writes are flushed on shutdown.
+    """
+    db_writer.start()
+    app.state.startup_tasks = []
+    if EMBEDDING_CACHE_ENABLED and EMBEDDING_CACHE_WARM_LOAD:
+        app.state.startup_tasks.append(asyncio.create_task(asyncio.to_thread(embedding.warm_load)))
+    if STARTUP_WARMUP:
+        app.state.startup_tasks.append(asyncio.create_task(warmup()))
+    try:
+        yield
+    finally:
+        for task in app.state.startup_tasks:
+            task.cancel()
+        await batch_runner.stop()
+        await db_writer.stop()
+        db_pool.close()
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Reject multipart bodies larger than an image upload plus the form fields
+    with 413 while they arrive, before Starlette spools them to disk.
+
+    A declared Content-Length over the limit is refused without reading the
+    body; otherwise the bytes are counted as the form parser receives them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/form-data"):
+            await self.app(scope, receive, send)
+            return
+
+        max_bytes = IMAGE_MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD_BYTES
+        detail = {"error": f"Request body exceeds the {max_bytes} byte upload limit"}
+        try:
+            declared = int(headers.get(b"content-length", b"0"))
+        except ValueError:
+            declared = 0
+        if declared > max_bytes:
+            response = JSONResponse(status_code=413, content={"detail": detail})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > max_bytes:
+                    # Raised inside the route's form parsing, so it becomes the 413 response
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
 # Initialize FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
+# Added first so CORS headers also reach its 413 responses
+app.add_middleware(UploadSizeLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -61,38 +226,105 @@ class Image(BaseModel):
 class Query(BaseModel):
     user_message: str
     ai_response: str
+    userId: Optional[str] = None
+    domain: Optional[str] = None
+    turn: Optional[int] = None
 
     @staticmethod
     def sanitize_text(text: str) -> str:
         return re.sub(r'[^\x00-\x7F]+', '', text)  # Removes non-ASCII characters    
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Image upload limits
+IMAGE_MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# Room for the other form fields and multipart headers around the image
+UPLOAD_FORM_OVERHEAD_BYTES = int(os.getenv("UPLOAD_FORM_OVERHEAD_BYTES", str(64 * 1024)))
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+IMAGE_READ_CHUNK_SIZE = 64 * 1024
+
+CAPTION_MODEL = "gpt-4o"
+CAPTION_PROMPT = "Describe the visible skin conditions in this image as if you are the person experiencing them. Include details about any redness, discoloration, spots, rashes, texture irregularities, lesions, scars, dryness, or other abnormalities. Share your observations in a natural, self-reflective tone, noting the size, color, distribution, and characteristics of any visible features. Also, consider possible causes for these conditions and how you might address them."
 
-def get_image_caption(image_path):
+
+async def read_upload(upload: UploadFile) -> bytes:
     """
-    Sends an image to the captioning API and returns the response.
+    Read an uploaded file into memory in chunks, enforcing a size cap.
 
-    Args:
-        image_path (str): Path to the image file.
+    Raises:
+        HTTPException: 413 as soon as the upload grows past IMAGE_MAX_UPLOAD_BYTES.
+    """
+    max_bytes = IMAGE_MAX_UPLOAD_BYTES
+    data = bytearray()
+    while chunk := await upload.read(IMAGE_READ_CHUNK_SIZE):
+        data.extend(chunk)
+        if len(data) > max_bytes:
+            raise HTTPException(
+                status_code=413,
+                detail={"error": f"Image exceeds the {max_bytes} byte upload limit"}
+            )
+    return bytes(data)
 
-    Returns:
-        str: Caption response from the API if the request is successful.
-        str: Error message if the request fails.
+
+def prepare_image(image_bytes: bytes) -> bytes:
     """
-    
-    try:
-        # Read the image file from the path
-        with open(image_path, 'rb') as image_file:
-            file_content = image_file.read()
-        
-        base64_string = base64.b64encode(file_content).decode("utf-8")
-        response = client.chat.completions.create(
-            model="gpt-4o",
+    Downscale an image so its longest side is at most IMAGE_MAX_DIMENSION and
+    re-encode it as JPEG. Orientation from EXIF is applied first.
+    """
+    with PILImage.open(io.BytesIO(image_bytes)) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        output = io.BytesIO()
+        img.save(output, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+        return output.getvalue()
+
+
+CAPTION_MAX_TOKENS = 200
+
+# Captions are only reused for the prompt, model and preprocessing they were made with
+CAPTION_PROMPT_VERSION = hashlib.sha256(
+    f"{CAPTION_MODEL}|{CAPTION_MAX_TOKENS}|{IMAGE_MAX_DIMENSION}|{CAPTION_PROMPT}".encode("utf-8")
+).hexdigest()[:16]
+
+
+def perceptual_hash(image_bytes: bytes) -> str:
+    """
+    Compute a 64-bit difference hash (dHash) of an image as 16 hex digits.
+
+    Re-encoded or resized copies of the same photo hash to the same or a
+    nearby value, unlike a hash of the raw bytes.
+    """
+    with PILImage.open(io.BytesIO(image_bytes)) as img:
+        small = ImageOps.exif_transpose(img).convert("L").resize((9, 8), PILImage.LANCZOS)
+        pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:016x}"
+
+
+async def request_image_caption(image_bytes, timeout=None):
+    """
+    Downscale an image and ask the vision model to caption it, giving the API
+    call at most ``timeout`` seconds (the client default otherwise).
+    """
+    jpeg_bytes = await asyncio.to_thread(prepare_image, image_bytes)
+    base64_string = base64.b64encode(jpeg_bytes).decode("utf-8")
+    # Prompt, image and output tokens, for the key pool's budget
+    estimated = estimate_tokens(CAPTION_PROMPT) + 1000 + CAPTION_MAX_TOKENS
+    options = {} if timeout is None else {"timeout": max(timeout, 0.1)}
+    async with key_pool.lease(estimated) as lease:
+        response = await lease.client.chat.completions.create(
+            model=CAPTION_MODEL,
             messages=[
                 {
                     "role": "user",
                     "content": [
-                        {"type": "text", "text": "Describe the visible skin conditions in this image as if you are the person experiencing them. Include details about any redness, discoloration, spots, rashes, texture irregularities, lesions, scars, dryness, or other abnormalities. Share your observations in a natural, self-reflective tone, noting the size, color, distribution, and characteristics of any visible features. Also, consider possible causes for these conditions and how you might address them."},
+                        {"type": "text", "text": CAPTION_PROMPT},
                         {
                             "type": "image_url",
                             "image_url": {
@@ -102,30 +334,146 @@ def get_image_caption(image_path):
                     ],
                 },
             ],
-            max_tokens=200,
+            max_tokens=CAPTION_MAX_TOKENS,
+            **options,
         )
-        return response.choices[0].message.content
+    return response.choices[0].message.content
+
+
+async def get_image_caption(image_bytes, timeout=None):
+    """
+    Sends an image to the captioning API and returns the response.
+
+    Captions are looked up in ``caption_cache`` first, by a hash of the image
+    bytes and, if enabled, by perceptual hash. Only successful captions are
+    cached.
+
+    Args:
+        image_bytes (bytes): Raw bytes of the uploaded image.
+        timeout (float): Seconds the vision API call may take, if limited.
+
+    Returns:
+        str: Caption response from the API if the request is successful.
+        str: Error message if the request fails.
+    """
+    
+    try:
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        caption = await caption_cache.get(image_hash)
+        if caption is not None:
+            return caption
+
+        phash = None
+        if caption_cache.perceptual:
+            phash = await asyncio.to_thread(perceptual_hash, image_bytes)
+            caption = await caption_cache.get_similar(phash)
+            if caption is not None:
+                return caption
+
+        caption = await request_image_caption(image_bytes, timeout)
+        if caption:
+            await caption_cache.put(image_hash, caption, phash)
+        return caption
         
-    except FileNotFoundError:
-        return "Error: Image file not found."
+    except UnidentifiedImageError:
+        return "Error: Unsupported image format."
     except Exception as e:
         return f"An error occurred: {str(e)}"
 
 
 
-# Replace MongoDB imports with SQLite setup
-@contextmanager
-def get_db():
-    db = sqlite3.connect('klyraai.db')
-    db.row_factory = sqlite3.Row
-    try:
-        yield db
-    finally:
-        db.close()
+# SQLite storage settings
+DB_PATH = os.getenv("DB_PATH", "klyraai.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "500"))
+DB_WRITE_FLUSH_INTERVAL = float(os.getenv("DB_WRITE_FLUSH_INTERVAL", "0.05"))
+DB_WRITE_MAX_ATTEMPTS = int(os.getenv("DB_WRITE_MAX_ATTEMPTS", "3"))
+DB_WRITE_RETRY_BASE_DELAY = float(os.getenv("DB_WRITE_RETRY_BASE_DELAY", "0.1"))
+
+class ConnectionPool:
+    """
+    Pool of reusable SQLite connections configured for WAL mode.
+
+    Connections may be used from worker threads, one thread at a time. When
+    every pooled connection is busy an extra one is opened and closed on
+    release instead of blocking the caller.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=134217728",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._overflow = set()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+        db.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS:
+            db.execute(pragma)
+        return db
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            pooled = self._created < self.size
+            if pooled:
+                self._created += 1
+        db = self._connect()
+        if not pooled:
+            self._overflow.add(id(db))
+        return db
+
+    def release(self, db):
+        if db.in_transaction:
+            db.rollback()
+        if id(db) in self._overflow:
+            self._overflow.discard(id(db))
+            db.close()
+        else:
+            self._idle.put(db)
+
+    @contextmanager
+    def connection(self):
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def fill(self):
+        """Open every pooled connection ahead of the first requests."""
+        connections = [self.acquire() for _ in range(self.size)]
+        for db in connections:
+            self.release(db)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
 
 # Initialize SQLite database and create table
 def init_db():
-    with get_db() as db:
+    with db_pool.connection() as db:
         db.execute('''
             CREATE TABLE IF NOT EXISTS chat_history (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -146,302 +494,3985 @@ def init_db():
                 error_message TEXT
             )
         ''')
+        db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_history_user_domain_time
+            ON chat_history (user_id, domain, timestamp)
+        ''')
+        db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_request_metrics_user_time
+            ON request_metrics (user_id, request_time)
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS caption_cache (
+                image_hash TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                phash TEXT,
+                caption TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (image_hash, prompt_version)
+            )
+        ''')
+        db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_caption_cache_last_used
+            ON caption_cache (last_used)
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                dimensions INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used
+            ON embedding_cache (last_used)
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS session_state (
+                user_id TEXT NOT NULL,
+                domain TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (user_id, domain)
+            )
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS metric_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )
+        ''')
+        db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_request_metrics_time
+            ON request_metrics (request_time)
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS product_catalog (
+                collection TEXT NOT NULL,
+                id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                highlights TEXT,
+                price TEXT,
+                image_url TEXT,
+                buy_link TEXT,
+                PRIMARY KEY (collection, id)
+            )
+        ''')
+        db.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS product_catalog_fts
+            USING fts5(name, collection UNINDEXED, product_id UNINDEXED)
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS session_summaries (
+                user_id TEXT NOT NULL,
+                domain TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (user_id, domain)
+            )
+        ''')
+        db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_history_user_domain_id
+            ON chat_history (user_id, domain, id)
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS chat_history_archive (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                domain TEXT NOT NULL,
+                first_id INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                turns INTEGER NOT NULL,
+                first_timestamp TEXT,
+                last_timestamp TEXT,
+                archived_at TEXT NOT NULL,
+                data BLOB NOT NULL
+            )
+        ''')
+        db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_chat_history_archive_user_domain
+            ON chat_history_archive (user_id, domain, first_id)
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS ingest_tombstones (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                collection TEXT NOT NULL,
+                source TEXT NOT NULL,
+                chunks INTEGER NOT NULL,
+                deleted_at TEXT NOT NULL
+            )
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS batch_jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                succeeded INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL,
+                finished_at TEXT
+            )
+        ''')
+        db.execute('''
+            CREATE TABLE IF NOT EXISTS batch_results (
+                job_id TEXT NOT NULL,
+                item INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT NOT NULL,
+                PRIMARY KEY (job_id, item)
+            )
+        ''')
         db.commit()
+    return db_pool
 
-# Initialize database on startup
-init_db()
-
-class UserSession:
-    def __init__(self, domain, user_id):
-        self.domain = domain
-        self.user_id = user_id
-        self.last_active = datetime.now()
-        # Load last 20 messages from database for this user
-        self.chat_history = self._load_chat_history()
-        
-        # Create user-specific memory
-        self.memory = ConversationBufferWindowMemory(
-            memory_key="chat_history",
-            human_prefix="### Input",
-            ai_prefix="### Response",
-            output_key="answer",
-            return_messages=True,
-            k=20  # Keep last 20 messages in memory
-        )
-        
-        # Initialize memory with user's chat history
-        for query, response in self.chat_history:
-            self.memory.save_context({"input": query}, {"answer": response})
-            
-        self.conversation = self._create_conversation()
 
-    def _load_chat_history(self):
-        with get_db() as db:
-            cursor = db.execute('''
-                SELECT query, response 
-                FROM chat_history 
-                WHERE user_id = ? AND domain = ? 
-                ORDER BY timestamp DESC LIMIT 20
-            ''', (self.user_id, self.domain))
-            
-            # Return history in chronological order
-            history = [(row['query'], row['response']) for row in cursor.fetchall()]
-            return history[::-1]  # Reverse to get chronological order
+def check_database(pool):
+    with pool.connection() as db:
+        db.execute("SELECT 1")
 
-    def save_message(self, query, response):
-        with get_db() as db:
-            db.execute('''
-                INSERT INTO chat_history (user_id, domain, query, response)
-                VALUES (?, ?, ?, ?)
-            ''', (self.user_id, self.domain, query, response))
-            db.commit()
+# Tables are created when the first connection is asked for
+database = Component("database", init_db, probe=check_database)
 
-    def _create_conversation(self):
-        try:
-            return ConversationalRetrievalChain.from_llm(
-                llm=llm.current_llm,
-                retriever=retrieval,
-                memory=self.memory,
-                combine_docs_chain_kwargs={"prompt": CONVERSATIONAL_PROMPT},
-                return_source_documents=True,
-                verbose=True,
-            )
-        except Exception as e:
-            logger.error(f"Error creating conversation chain for user {self.user_id}: {str(e)}")
-            raise
+@contextmanager
+def get_db():
+    database.get()
+    with db_pool.connection() as db:
+        yield db
 
-sessions: Dict[str, Dict[str, UserSession]] = {}
+class WriteBehindQueue:
+    """
+    Batches chat_history, request_metrics and other shared-state writes off
+    the request path.
 
-# Initialize environment and API keys
+    Rows are queued in memory and written by one background task. Each flush
+    waits ``flush_interval`` seconds to collect more rows, then writes up to
+    ``batch_size`` of them in a single transaction on a worker thread. Before
+    ``start`` (or after ``stop``) rows are written immediately.
 
-# Define OpenAI API keys
-OPENAI_API_KEYS = [
-    os.getenv("OPENAI_API_KEY")
-]
+    A batch that fails with a transient error (a locked database) is retried
+    with exponential backoff. If it still fails, or fails on a bad row, its
+    rows are written one per transaction, so only the rows that fail on
+    their own are dropped.
+    """
 
-# Initialize LangChain OpenAI client
-suggetion_llm = ChatOpenAI(
-    model="gpt-4o",  # Use "gpt-4-turbo" or "gpt-4" based on your needs
-    openai_api_key=os.getenv("OPENAI_API_KEY"),
-    temperature=0.3,
-)
+    STATEMENTS = {
+        "chat_history": '''
+            INSERT INTO chat_history (user_id, domain, query, response, timestamp)
+            VALUES (?, ?, ?, ?, ?)
+        ''',
+        "request_metrics": '''
+            INSERT INTO request_metrics
+            (user_id, request_time, response_time, success, error_message)
+            VALUES (?, ?, ?, ?, ?)
+        ''',
+        "session_state": '''
+            INSERT INTO session_state (user_id, domain, version, updated_at)
+            VALUES (?, ?, 1, ?)
+            ON CONFLICT (user_id, domain)
+            DO UPDATE SET version = version + 1, updated_at = excluded.updated_at
+        ''',
+        "metric_counters": '''
+            INSERT INTO metric_counters (name, value) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+        ''',
+        "batch_results": '''
+            INSERT OR REPLACE INTO batch_results (job_id, item, status, result)
+            VALUES (?, ?, ?, ?)
+        ''',
+        "batch_jobs": '''
+            UPDATE batch_jobs SET status = ?, succeeded = ?, failed = ?, finished_at = ?
+            WHERE id = ?
+        ''',
+        "batch_results_delete": "DELETE FROM batch_results WHERE job_id = ?",
+        "batch_jobs_delete": "DELETE FROM batch_jobs WHERE id = ?",
+    }
 
-# Initialize embeddings and vector store
-embedding = OpenAIEmbeddings(
-    model='text-embedding-3-large',
-    openai_api_key=os.getenv("OPENAI_API_KEY"),
-    dimensions=768  # Set to match existing Chroma collection dimensionality
-)
+    def __init__(self, batch_size, flush_interval, max_attempts=1, retry_base_delay=0.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self._queue = None
+        self._task = None
+        self.batches = 0
+        self.rows = 0
+        self.retries = 0
+        self.row_fallbacks = 0
+        self.failed_rows = 0
 
-try:
-    persist_directory = "chroma"
-    vectordb = Chroma(
-        persist_directory=persist_directory, 
-        embedding_function=embedding
-    )
-except Exception as e:
-    logger.error(f"Error loading ChromaDB: {str(e)}")
-    raise RuntimeError(f"Error loading ChromaDB: {str(e)}")
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
 
-class RotatingOpenAILLM:
-    def __init__(self, model: str, temperature: float):
-        self.model = model
-        self.temperature = temperature
-        self.api_keys = cycle(OPENAI_API_KEYS)  # Rotate keys
-        self.current_key = next(self.api_keys)
-        self.current_llm = self._create_llm()
-        self.max_retries = len(OPENAI_API_KEYS) * 2  # Retry twice per key
+    async def stop(self):
+        """Stop the writer and flush whatever is still queued."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        batch = self._drain(self._queue.qsize())
+        if batch:
+            await self._flush(batch)
 
-    def _create_llm(self) -> ChatOpenAI:
-        """
-        Create an instance of ChatOpenAI with the current API key.
-        """
-        return ChatOpenAI(
-            model=self.model,
-            temperature=self.temperature,
-            openai_api_key=self.current_key,
-            max_retries=1
-        )
+    def put(self, table, row):
+        if self._task is None:
+            self._write([(table, row)])
+        else:
+            self._queue.put_nowait((table, row))
 
-    def _rotate_key(self):
-        """
-        Rotate to the next API key in the list.
-        """
-        self.current_key = next(self.api_keys)
-        logger.info(f"Rotating to new API key: {self.current_key[:8]}...")
-        self.current_llm = self._create_llm()
+    def _drain(self, limit):
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
 
-    def invoke(self, messages, **kwargs):
-        """
-        Invoke the ChatOpenAI model with fault-tolerant API key rotation.
-        """
-        attempts = 0
-        last_error = None
+    async def _run(self):
+        while True:
+            first = await self._queue.get()
+            await asyncio.sleep(self.flush_interval)
+            batch = [first] + self._drain(self.batch_size - 1)
+            await self._flush(batch)
 
-        while attempts < self.max_retries:
+    async def _flush(self, batch):
+        """Write ``batch``, retrying transient errors and then falling back to one row at a time."""
+        for attempt in range(1, self.max_attempts + 1):
             try:
-                # Make the API call
-                return self.current_llm(messages=messages, **kwargs)
+                await asyncio.to_thread(self._write, batch)
+                return
+            except sqlite3.OperationalError as e:
+                if attempt == self.max_attempts:
+                    logger.error(f"Error writing {len(batch)} queued rows after {attempt} attempts: {str(e)}")
+                    break
+                delay = self.retry_base_delay * 2 ** (attempt - 1)
+                self.retries += 1
+                logger.warning(f"Writing {len(batch)} queued rows failed, retrying in {delay:.2f}s: {str(e)}")
+                await asyncio.sleep(delay)
             except Exception as e:
-                attempts += 1
-                last_error = e
-                logger.warning(f"API call failed (attempt {attempts}/{self.max_retries}): {str(e)}")
-                
-                # Rotate to next key and retry
-                if attempts < self.max_retries:
-                    self._rotate_key()
-                    continue
-                
-                raise Exception(f"All API keys exhausted after {attempts} attempts. Last error: {str(last_error)}")
+                logger.error(f"Error writing {len(batch)} queued rows: {str(e)}")
+                break
+        self.row_fallbacks += 1
+        await asyncio.to_thread(self._write_rows, batch)
 
-# Initialize the rotating LLM with GPT-4-turbo
-llm = RotatingOpenAILLM(
-    model="gpt-4o",
-    temperature=0.1
-)
+    def _write_rows(self, batch):
+        """Write each row in its own transaction, dropping only the rows that fail."""
+        written = 0
+        with latency_metrics.time_stage("db_write"), get_db() as db:
+            for table, row in batch:
+                try:
+                    with db:
+                        db.execute(self.STATEMENTS[table], row)
+                    written += 1
+                except Exception as e:
+                    self.failed_rows += 1
+                    logger.error(f"Dropped queued {table} row: {str(e)}")
+        self.batches += 1
+        self.rows += written
 
+    def _write(self, batch):
+        grouped = defaultdict(list)
+        for table, row in batch:
+            grouped[table].append(row)
+        with latency_metrics.time_stage("db_write"), get_db() as db:
+            with db:
+                for table, rows in grouped.items():
+                    db.executemany(self.STATEMENTS[table], rows)
+        self.batches += 1
+        self.rows += len(batch)
 
-retrieval = vectordb.as_retriever(search_type="mmr", k=10)
+    def stats(self):
+        return {
+            "pending": self._queue.qsize() if self._queue else 0,
+            "batches": self.batches,
+            "rows": self.rows,
+            "retries": self.retries,
+            "row_fallbacks": self.row_fallbacks,
+            "failed_rows": self.failed_rows,
+            "rows_per_batch": self.rows / self.batches if self.batches else 0.0,
+        }
 
-# Define the conversation prompt template
-template = """Hello AI Dermatologist! You are an advanced AI specializing in providing personalized skincare solutions. You will analyze user-provided photos and text inputs to identify skin conditions, recommend natural skincare routines, suggest personalized treatment plans, and recommend suitable products. Your responses should be informative, empathetic, and prioritize user safety.
-Here's a detailed guide for your interactions:
-You name: Klyra AI. 
-Image Analysis:
-Request Clear Images: Begin by requesting clear, well-lit photos of the affected skin areas. Specify that photos should be taken without makeup or filters. Example: "Please upload a clear, well-lit photo of the affected area without makeup or filters. This will help me assess your skin condition accurately."
-Analyze Visual Cues: Analyze uploaded photos for visual cues like inflammation, redness, pigmentation, scaling, rashes, texture, and pore size.
-Determine Skin Type: Infer skin type (oily, dry, combination, sensitive) based on visual cues and user-provided information.
-Text Input Interpretation:
-Gather Detailed Information: Ask clarifying questions to understand the user's skin concerns, symptoms, current routine, lifestyle, diet, allergies, medical history, medications, and any potential triggers (e.g., stress, specific foods, environmental factors). Example: "Could you describe your current skincare routine? Do you have any known allergies? Are you currently taking any medications?"
-Symptom Analysis: Analyze user-described symptoms to identify potential skin conditions like acne, eczema, rosacea, psoriasis, melasma, contact dermatitis, etc.
-Personalized Routine & Treatment Plan Generation:
-Natural Skincare Routine: Recommend natural skincare routines including gentle cleansers, natural moisturizers, and DIY remedies (e.g., oatmeal baths, aloe vera, tea tree oil) where appropriate. Provide specific instructions and precautions.
-Preventive Measures: Suggest preventive measures like sun protection (SPF), avoiding triggers, managing stress, and maintaining a healthy diet.
-Daily Routine Structure: Prescribe a detailed daily routine, including cleansing, toning, treating, moisturizing, and protecting.
-Medical Treatment Suggestions (Over-the-Counter): Recommend over-the-counter creams, lotions, and medications (e.g., hydrocortisone cream, retinoids, benzoyl peroxide) where appropriate. Clearly state that these are suggestions and not prescriptions.
-Medical Treatment Suggestions (Prescription): For conditions potentially requiring prescription medication (e.g., topical antibiotics, steroid creams), clearly advise the user to consult a dermatologist or qualified healthcare professional. Provide information about potential treatment options but refrain from prescribing.
-Product Recommendations: Suggest specific products based on the identified skin condition and user preferences. Consider skin type, allergies, and potential sensitivities. Differentiate between natural remedies, over-the-counter products, and prescription medications. Always recommend consulting a doctor before starting any new medication.
-Complex Condition Support:
-Recognize Complexities: Acknowledge the complexities of overlapping or atypical skin conditions. Example: "Your symptoms suggest a combination of rosacea and acne. It's important to see a dermatologist for a proper diagnosis."
-Referral to Specialists: For complex conditions or those requiring specialized care (e.g., psoriatic arthritis, severe allergies), strongly recommend consulting a relevant specialist. Offer interim advice for managing symptoms while awaiting professional consultation.
-Interactive Dialogue & Follow-Up:
-Clarifying Questions: Ask follow-up questions to refine recommendations and ensure accuracy.
-Progress Tracking: Encourage users to provide updates and upload follow-up photos to monitor progress and adjust recommendations as needed.
-Educational Insights:
-Provide Educational Content: Offer concise explanations of potential skin conditions, including causes, triggers, and long-term management strategies.
-Prevention Tips: Provide general skincare tips for maintaining healthy skin.
-Ethical and Safe Recommendations:
-Prioritize Safety: Always prioritize user safety. Clearly state when a condition requires professional medical evaluation. Emphasize that your advice is not a substitute for professional medical care. Example: "While these suggestions may help, it's crucial to consult a dermatologist for a proper diagnosis and personalized treatment plan."
+db_writer = WriteBehindQueue(
+    DB_WRITE_BATCH_SIZE, DB_WRITE_FLUSH_INTERVAL, DB_WRITE_MAX_ATTEMPTS, DB_WRITE_RETRY_BASE_DELAY
+)
 
-Product recommendation: 
-After prescribing, suggest the products the patient needs to improve or recover his condition in this way, 
-Suggested Ingredients. Ensure the product information is complete, including:
 
-Product XML Response: Format the response as a XML object with one main field:
-products: An array of product objects, each containing:
-id: A unique identifier
-image_url: The product image URL
-name: Product name
-highlights: Key features
-price: Product price
-buy_link: Product page URL
+class SessionBackend(ABC):
+    """
+    Conversation and metrics state shared by every worker process.
 
-Ensure that the response is structured in a way that the assistant provides a list of products with these details.
+    Each (user_id, domain) session has a history of turns and a version that
+    goes up by one per appended turn, so a worker can tell with one cheap
+    lookup whether its cached session is behind. Counters and request records
+    are aggregated across processes. A Redis-style store fits the same
+    interface with a capped list per session, INCR for versions, HINCRBY for
+    counters and a sorted set of request times for active users.
 
-Example:
+    Turns also have a position, increasing as they are appended, which the
+    conversation summary uses to record how far it reaches. Position 0 is
+    before the first turn.
 
-Answer: Dealing with acne can be frustrating! Before we look at products, here are a few things you can try:
+    Subclasses must implement every abstract method, so an incomplete
+    ``SESSION_BACKEND`` fails when it is loaded rather than mid-request.
+    """
 
-Gentle Cleansing: Wash your face twice daily with a mild, fragrance-free cleanser. Avoid harsh scrubbing. Spot Treatment with Tea Tree Oil: Dilute tea tree oil with a carrier oil (like jojoba or grapeseed oil) and apply it to blemishes. Always do a patch test first. Hydration: Drink plenty of water and eat antioxidant-rich foods like berries and leafy greens.
+    @abstractmethod
+    def load_history(self, user_id, domain, limit, after=0):
+        """
+        Return (turns, version): the last ``limit`` (query, response) pairs
+        after position ``after``, oldest first.
+        """
 
-Now, here are some products that might be helpful:
+    def load_summary(self, user_id, domain):
+        """Return (summary, position): the running summary and the last turn it covers."""
+        return "", 0
 
-Response in XML format:
+    @abstractmethod
+    def turns_after(self, user_id, domain, after, limit):
+        """The last ``limit`` turns after position ``after`` as (position, query, response), oldest first."""
 
-<products>
-    <product>
-        <id>1</id>
-        <name>COSRX Salicylic Acid Daily Gentle Cleanser 150ml</name>
-        <highlights>Oil Controlling, Acne Controlling, Exfoliating, Reduce Comedones</highlights>
-        <price>995TK</price>
-        <image_url>https://cdn.klassy.com.bd/uploads/products/products/oeq0fGTCiBSDKdsOyK5POtT3QWhAltUjnzAr1Pne.png</image_url>
-        <buy_link>https://klassy.com.bd/product/COSRX-Salicylic-Acid-Daily-Gentle-Cleanser-150ml-z8eFy</buy_link>
-    </product>
-    <product>
-        <id>2</id>
-        <name>COSRX Salicylic Acid Daily Gentle Cleanser 150ml</name>
-        <highlights>Oil Controlling, Acne Controlling, Exfoliating, Reduce Comedones</highlights>
-        <price>995TK</price>
-        <image_url>https://cdn.klassy.com.bd/uploads/products/products/oeq0fGTCiBSDKdsOyK5POtT3QWhAltUjnzAr1Pne.png</image_url>
-        <buy_link>https://klassy.com.bd/product/COSRX-Salicylic-Acid-Daily-Gentle-Cleanser-150ml-z8eFy</buy_link>
-    </product>
-</products>
+    @abstractmethod
+    def save_summary(self, user_id, domain, summary, position, previous):
+        """
+        Store a summary covering the turns up to ``position``, unless another
+        worker has moved the summary on from ``previous``. Returns whether it
+        was stored.
+        """
 
-If a customer directly asks for product recommendations, quickly suggest the product.
+    @abstractmethod
+    def version(self, user_id, domain):
+        """The session's version: how many turns have been appended to it."""
 
-**Provide Accurate Link to the Product Page and Image, and Ensure do not generate any false links or images.
-**Show the product image and link to the product page.
-*** Answer always in user's language.
+    @abstractmethod
+    def append_turn(self, user_id, domain, query, response):
+        """Append a turn and bump the session's version."""
 
-By following these guidelines, you will provide valuable and safe skincare guidance to users, while promoting responsible self-care and encouraging professional consultation when necessary.
+    @abstractmethod
+    def record_request(self, user_id, response_time, success, error=None):
+        """Record one request's outcome for the per-user metrics."""
 
-Use only the chat history and the following information
-{context}
-    
-Current conversation:
-{chat_history}
+    @abstractmethod
+    def incr(self, name, amount=1):
+        """Add ``amount`` to a shared counter."""
 
-Human: {question}
-AI Assistant:"""
+    @abstractmethod
+    def counters(self):
+        """Every shared counter, as {name: value}."""
 
+    @abstractmethod
+    def active_users(self, window_seconds):
+        """Distinct users with a request in the last ``window_seconds``."""
 
-CONVERSATIONAL_PROMPT = PromptTemplate(
-    input_variables=["context", "question", "chat_history"],
-    template=template,
+    @abstractmethod
+    def user_metrics(self, user_id):
+        """Request counts and response times for one user."""
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    SessionBackend on the local SQLite database, shared by the workers of one
+    host. Writes go through ``db_writer``, so other workers see a turn once
+    its batch is flushed (``DB_WRITE_FLUSH_INTERVAL``).
+    """
+
+    def load_history(self, user_id, domain, limit, after=0):
+        with get_db() as db:
+            if after:
+                rows = db.execute('''
+                    SELECT query, response
+                    FROM chat_history
+                    WHERE user_id = ? AND domain = ? AND id > ?
+                    ORDER BY id DESC LIMIT ?
+                ''', (user_id, domain, after, limit)).fetchall()
+            else:
+                rows = db.execute('''
+                    SELECT query, response
+                    FROM chat_history
+                    WHERE user_id = ? AND domain = ?
+                    ORDER BY timestamp DESC, id DESC LIMIT ?
+                ''', (user_id, domain, limit)).fetchall()
+            state = db.execute(
+                "SELECT version FROM session_state WHERE user_id = ? AND domain = ?",
+                (user_id, domain),
+            ).fetchone()
+        # Return history in chronological order
+        history = [(row['query'], row['response']) for row in rows][::-1]
+        return history, state['version'] if state else 0
+
+    def version(self, user_id, domain):
+        with get_db() as db:
+            state = db.execute(
+                "SELECT version FROM session_state WHERE user_id = ? AND domain = ?",
+                (user_id, domain),
+            ).fetchone()
+        return state['version'] if state else 0
+
+    def load_summary(self, user_id, domain):
+        with get_db() as db:
+            row = db.execute(
+                "SELECT summary, position FROM session_summaries WHERE user_id = ? AND domain = ?",
+                (user_id, domain),
+            ).fetchone()
+        return (row['summary'], row['position']) if row else ("", 0)
+
+    def turns_after(self, user_id, domain, after, limit):
+        with get_db() as db:
+            rows = db.execute('''
+                SELECT id, query, response
+                FROM chat_history
+                WHERE user_id = ? AND domain = ? AND id > ?
+                ORDER BY id DESC LIMIT ?
+            ''', (user_id, domain, after, limit)).fetchall()
+        return [(row['id'], row['query'], row['response']) for row in rows][::-1]
+
+    def save_summary(self, user_id, domain, summary, position, previous):
+        with get_db() as db:
+            with db:
+                cursor = db.execute('''
+                    INSERT INTO session_summaries (user_id, domain, summary, position, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id, domain) DO UPDATE SET
+                        summary = excluded.summary,
+                        position = excluded.position,
+                        updated_at = excluded.updated_at
+                    WHERE session_summaries.position = ?
+                ''', (user_id, domain, summary, position, str(datetime.now()), previous))
+        return cursor.rowcount > 0
+
+    def append_turn(self, user_id, domain, query, response):
+        # Stamp the row now; the write-behind queue may insert it a little later
+        timestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        db_writer.put("chat_history", (user_id, domain, query, response, timestamp))
+        db_writer.put("session_state", (user_id, domain, timestamp))
+
+    def record_request(self, user_id, response_time, success, error=None):
+        db_writer.put("request_metrics", (user_id, str(datetime.now()), response_time, success, error))
+
+    def incr(self, name, amount=1):
+        db_writer.put("metric_counters", (name, amount))
+
+    def counters(self):
+        with get_db() as db:
+            return {row['name']: row['value'] for row in db.execute("SELECT name, value FROM metric_counters")}
+
+    def active_users(self, window_seconds):
+        since = str(datetime.fromtimestamp(time.time() - window_seconds))
+        with get_db() as db:
+            row = db.execute(
+                "SELECT COUNT(DISTINCT user_id) AS users FROM request_metrics WHERE request_time >= ?",
+                (since,),
+            ).fetchone()
+        return row['users']
+
+    def user_metrics(self, user_id):
+        with get_db() as db:
+            row = db.execute('''
+                SELECT COUNT(*) AS total_requests,
+                       COALESCE(SUM(success), 0) AS successful_requests,
+                       MAX(request_time) AS last_request_time,
+                       AVG(CASE WHEN success THEN response_time END) AS average_response_time
+                FROM request_metrics WHERE user_id = ?
+            ''', (user_id,)).fetchone()
+        metrics = dict(row)
+        metrics["failed_requests"] = metrics["total_requests"] - metrics["successful_requests"]
+        metrics["average_response_time"] = metrics["average_response_time"] or 0
+        return metrics
+
+
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")
+
+
+def load_session_backend(name):
+    """``sqlite`` or the ``module:Class`` path of a custom SessionBackend."""
+    if name == "sqlite":
+        return SQLiteSessionBackend()
+    module_name, _, class_name = name.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+session_backend = load_session_backend(SESSION_BACKEND)
+
+# Caption cache settings
+CAPTION_CACHE_ENABLED = env_flag("CAPTION_CACHE_ENABLED", True)
+CAPTION_CACHE_MAX_ENTRIES = int(os.getenv("CAPTION_CACHE_MAX_ENTRIES", "10000"))
+CAPTION_CACHE_MAX_AGE_SECONDS = float(os.getenv("CAPTION_CACHE_MAX_AGE_SECONDS", str(30 * 24 * 3600)))
+CAPTION_CACHE_MEMORY_SIZE = int(os.getenv("CAPTION_CACHE_MEMORY_SIZE", "256"))
+CAPTION_CACHE_PERCEPTUAL = env_flag("CAPTION_CACHE_PERCEPTUAL", False)
+CAPTION_CACHE_PHASH_DISTANCE = int(os.getenv("CAPTION_CACHE_PHASH_DISTANCE", "6"))
+
+class CaptionCache:
+    """
+    Two-tier cache of image captions keyed by the SHA-256 of the image bytes.
+
+    An in-process LRU sits in front of the ``caption_cache`` table in
+    klyraai.db; the table is read and written on worker threads, like the
+    embedding cache. Entries are scoped to CAPTION_PROMPT_VERSION, so
+    changing the prompt or model makes old captions unreachable. The table is
+    trimmed by age and size as new captions are written.
+
+    Perceptual lookups compare against an in-memory array of the stored
+    hashes, loaded on first use and reloaded after each prune, instead of
+    reading every row per image.
+    """
+
+    PRUNE_EVERY = 100
+
+    def __init__(self, enabled, max_entries, max_age, memory_size, perceptual, phash_distance):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.memory_size = memory_size
+        self.perceptual = enabled and perceptual
+        self.phash_distance = phash_distance
+        self._memory = OrderedDict()
+        # (phashes as uint64, image hashes, created_at), or None until loaded
+        self._phashes = None
+        self._writes = 0
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.perceptual_hits = 0
+        self.misses = 0
+
+    def _remember(self, image_hash, caption, created_at):
+        self._memory[image_hash] = (caption, created_at)
+        self._memory.move_to_end(image_hash)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _from_memory(self, image_hash, now):
+        entry = self._memory.get(image_hash)
+        if entry is not None and now - entry[1] <= self.max_age:
+            self._memory.move_to_end(image_hash)
+            return entry[0]
+        return None
+
+    def _load(self, image_hash, now):
+        with get_db() as db:
+            row = db.execute('''
+                SELECT caption, created_at FROM caption_cache
+                WHERE image_hash = ? AND prompt_version = ? AND created_at >= ?
+            ''', (image_hash, CAPTION_PROMPT_VERSION, now - self.max_age)).fetchone()
+            if row is not None:
+                db.execute('''
+                    UPDATE caption_cache SET last_used = ?
+                    WHERE image_hash = ? AND prompt_version = ?
+                ''', (now, image_hash, CAPTION_PROMPT_VERSION))
+                db.commit()
+        return row
+
+    async def _lookup(self, image_hash, now):
+        """(caption, tier) from memory or SQLite, or (None, None)."""
+        caption = self._from_memory(image_hash, now)
+        if caption is not None:
+            return caption, "memory"
+        row = await asyncio.to_thread(self._load, image_hash, now)
+        if row is None:
+            return None, None
+        self._remember(image_hash, row['caption'], row['created_at'])
+        return row['caption'], "db"
+
+    async def get(self, image_hash):
+        """Return the cached caption for an exact image hash, or None."""
+        if not self.enabled:
+            return None
+        caption, tier = await self._lookup(image_hash, time.time())
+        if tier == "memory":
+            self.memory_hits += 1
+        elif tier == "db":
+            self.db_hits += 1
+        elif not self.perceptual:
+            self.misses += 1
+        return caption
+
+    def _load_phashes(self):
+        with get_db() as db:
+            rows = db.execute('''
+                SELECT phash, image_hash, created_at FROM caption_cache
+                WHERE prompt_version = ? AND phash IS NOT NULL
+            ''', (CAPTION_PROMPT_VERSION,)).fetchall()
+        return (
+            np.array([int(row['phash'], 16) for row in rows], dtype=np.uint64),
+            [row['image_hash'] for row in rows],
+            np.array([row['created_at'] for row in rows], dtype=np.float64),
+        )
+
+    async def get_similar(self, phash):
+        """Return a caption whose perceptual hash is within the distance threshold, or None."""
+        if self._phashes is None:
+            self._phashes = await asyncio.to_thread(self._load_phashes)
+        hashes, image_hashes, created = self._phashes
+        now = time.time()
+        if image_hashes:
+            differing = np.unpackbits((hashes ^ np.uint64(int(phash, 16))).view(np.uint8)).reshape(-1, 64)
+            distances = differing.sum(axis=1)
+            distances[created < now - self.max_age] = 65
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= self.phash_distance:
+                caption, _ = await self._lookup(image_hashes[nearest], now)
+                if caption is not None:
+                    self.perceptual_hits += 1
+                    return caption
+        self.misses += 1
+        return None
+
+    def _store(self, image_hash, caption, phash, now, prune):
+        with get_db() as db:
+            db.execute('''
+                INSERT OR REPLACE INTO caption_cache
+                (image_hash, prompt_version, model, prompt, phash, caption, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (image_hash, CAPTION_PROMPT_VERSION, CAPTION_MODEL, CAPTION_PROMPT, phash, caption, now, now))
+            if prune:
+                self._prune(db, now)
+            db.commit()
+
+    async def put(self, image_hash, caption, phash=None):
+        if not self.enabled:
+            return
+        now = time.time()
+        self._remember(image_hash, caption, now)
+        self._writes += 1
+        prune = self._writes % self.PRUNE_EVERY == 1
+        await asyncio.to_thread(self._store, image_hash, caption, phash, now, prune)
+        if prune:
+            self._phashes = None
+        elif phash is not None and self._phashes is not None:
+            hashes, image_hashes, created = self._phashes
+            self._phashes = (
+                np.append(hashes, np.uint64(int(phash, 16))),
+                image_hashes + [image_hash],
+                np.append(created, now),
+            )
+
+    def _prune(self, db, now):
+        db.execute('''
+            DELETE FROM caption_cache WHERE created_at < ? OR prompt_version != ?
+        ''', (now - self.max_age, CAPTION_PROMPT_VERSION))
+        db.execute('''
+            DELETE FROM caption_cache WHERE rowid IN (
+                SELECT rowid FROM caption_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_entries,))
+
+    def stats(self):
+        hits = self.memory_hits + self.db_hits + self.perceptual_hits
+        lookups = hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "perceptual": self.perceptual,
+            "memory_entries": len(self._memory),
+            "phash_entries": len(self._phashes[1]) if self._phashes is not None else 0,
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "perceptual_hits": self.perceptual_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+caption_cache = CaptionCache(
+    CAPTION_CACHE_ENABLED,
+    CAPTION_CACHE_MAX_ENTRIES,
+    CAPTION_CACHE_MAX_AGE_SECONDS,
+    CAPTION_CACHE_MEMORY_SIZE,
+    CAPTION_CACHE_PERCEPTUAL,
+    CAPTION_CACHE_PHASH_DISTANCE,
+)
+
+class KlyraRetrievalChain(ConversationalRetrievalChain):
+    """
+    ConversationalRetrievalChain that can reuse documents retrieved ahead of
+    time, passed in as the ``prefetched_docs`` input, and trims the documents
+    to the prompt token budget.
+
+    ``query_strategy`` decides what the retriever is queried with:
+
+    - ``condense``: the stock behaviour, an LLM rewrites every follow-up
+      before retrieval and the answer is generated for the rewrite.
+    - ``recent``: the question plus the last ``RETRIEVAL_HISTORY_TURNS``
+      user messages, with no extra LLM call.
+    - ``rewrite``: the question rewritten by ``question_generator`` (built on
+      the cheaper ``rewrite_llm``), used for retrieval only.
+    - ``race``: retrieval on the ``recent`` query starts while the rewrite
+      runs; the rewrite's documents are used if they are ready within
+      ``RETRIEVAL_REWRITE_GRACE_SECONDS`` of the first set.
+
+    Outside ``condense`` the answer prompt always gets the user's own question.
+    The history is formatted once per call, as ``chat_history_str``, and that
+    text is what the rewrite, the token budget and the answer prompt all see.
+    """
+
+    query_strategy: str = "condense"
+
+    async def _acall(self, inputs, run_manager=None):
+        _run_manager = run_manager or AsyncCallbackManagerForChainRun.get_noop_manager()
+        question = inputs["question"]
+        chat_history_str = self.get_chat_history(inputs["chat_history"])
+        inputs = {**inputs, "chat_history_str": chat_history_str}
+        if self.query_strategy == "condense" and chat_history_str:
+            question = await self._generate_question(question, chat_history_str, _run_manager)
+        docs = await self._aget_docs(question, inputs, run_manager=_run_manager)
+        new_inputs = {key: value for key, value in inputs.items() if key != "chat_history_str"}
+        new_inputs["question"] = question
+        new_inputs["chat_history"] = chat_history_str
+        result = await self.combine_docs_chain.ainvoke(
+            {"input_documents": docs, **new_inputs}, config={"callbacks": _run_manager.get_child()}
+        )
+        output = {self.output_key: result[self.combine_docs_chain.output_key]}
+        if self.return_source_documents:
+            output["source_documents"] = docs
+        return output
+
+    async def _generate_question(self, question, chat_history_str, run_manager):
+        result = await self.question_generator.ainvoke(
+            {"question": question, "chat_history": chat_history_str},
+            config={"callbacks": run_manager.get_child()},
+        )
+        return result[self.question_generator.output_key]
+
+    async def _aget_docs(self, question, inputs, *, run_manager):
+        docs = inputs.get("prefetched_docs")
+        if docs is None:
+            docs = await self._retrieve_for_strategy(question, inputs, run_manager)
+        docs = [ProductCatalog.tag(doc) for doc in docs]
+        return prompt_budget.fit_documents(docs, question, inputs["chat_history_str"])
+
+    async def _retrieve(self, query, inputs, run_manager):
+        with latency_metrics.time_stage("retrieval"):
+            return await self.retriever.aretrieve(query, inputs["domain"], run_manager.get_child())
+
+    def _recent_query(self, question, chat_history):
+        turns = []
+        for item in chat_history:
+            if isinstance(item, tuple):
+                turns.append(item[0])
+            elif item.type == "human":
+                turns.append(item.content)
+        return "\n".join(turns[-RETRIEVAL_HISTORY_TURNS:] + [question]) if RETRIEVAL_HISTORY_TURNS else question
+
+    async def _rewritten_docs(self, question, inputs, run_manager):
+        chat_history_str = inputs["chat_history_str"]
+        query = question
+        if chat_history_str:
+            query = await self._generate_question(question, chat_history_str, run_manager)
+        return await self._retrieve(query, inputs, run_manager)
+
+    async def _retrieve_for_strategy(self, question, inputs, run_manager):
+        if self.query_strategy == "condense":
+            # ``question`` has already been condensed in ``_acall``
+            return await self._retrieve(question, inputs, run_manager)
+        if self.query_strategy == "rewrite":
+            return await self._rewritten_docs(question, inputs, run_manager)
+
+        recent_query = self._recent_query(question, inputs["chat_history"])
+        if self.query_strategy == "recent" or not inputs["chat_history"]:
+            return await self._retrieve(recent_query, inputs, run_manager)
+
+        rewritten = asyncio.ensure_future(self._rewritten_docs(question, inputs, run_manager))
+        try:
+            docs = await self._retrieve(recent_query, inputs, run_manager)
+            try:
+                docs = await asyncio.wait_for(rewritten, RETRIEVAL_REWRITE_GRACE_SECONDS)
+                retrieval_query_stats["race_rewrite"] += 1
+            except asyncio.TimeoutError:
+                retrieval_query_stats["race_recent"] += 1
+            except Exception as e:
+                retrieval_query_stats["race_rewrite_failed"] += 1
+                logger.error(f"Error rewriting retrieval query: {str(e)}")
+            return docs
+        finally:
+            rewritten.cancel()
+
+class UserSession:
+    """
+    One conversation's state as plain data: the recent (query, answer) turns,
+    the running summary in summary mode, and the backend version used to spot
+    turns appended by other workers. The conversation chain is shared by
+    every session and gets this history with each call.
+    """
+
+    __slots__ = (
+        "domain", "user_id", "last_active", "checked_at", "summary", "summary_position",
+        "chat_history", "version", "turns",
+    )
+
+    def __init__(self, domain, user_id):
+        self.domain = domain
+        self.user_id = user_id
+        self.last_active = time.time()
+        # When the backend version was last compared with this copy
+        self.checked_at = self.last_active
+        # In summary mode, the running summary of the turns folded so far
+        self.summary, self.summary_position = self._load_summary()
+        # Load last 20 messages (after the summary) from the session backend for this user
+        self.chat_history, self.version = self._load_chat_history()
+        self.turns = max(self.version, len(self.chat_history))
+
+    def _load_summary(self):
+        if CHAT_HISTORY_MODE != "summary":
+            return "", 0
+        return session_backend.load_summary(self.user_id, self.domain)
+
+    def _load_chat_history(self):
+        return session_backend.load_history(self.user_id, self.domain, 20, after=self.summary_position)
+
+    def prompt_history(self):
+        """The history the chain is called with: the summary, if any, then the turns."""
+        if not self.summary:
+            return self.chat_history
+        return [SystemMessage(content=self.summary)] + self.chat_history
+
+    def save_message(self, query, response):
+        self.version += 1
+        session_backend.append_turn(self.user_id, self.domain, query, response)
+
+    def apply_summary(self, summary, position, folded):
+        """Swap in a new summary and drop the ``folded`` turns it now covers."""
+        self.summary, self.summary_position = summary, position
+        # The oldest turns held here are the newest of the folded ones. Turns
+        # answered in this process hold the raw answer, so match on queries.
+        held = [query for query, _ in self.chat_history]
+        folded = [query for query, _ in folded]
+        for count in range(min(len(folded), len(held)), 0, -1):
+            if held[:count] == folded[-count:]:
+                self.chat_history = self.chat_history[count:]
+                break
+
+# Session cache limits
+SESSION_CACHE_MAX_SIZE = int(os.getenv("SESSION_CACHE_MAX_SIZE", "1000"))
+SESSION_IDLE_TTL_SECONDS = float(os.getenv("SESSION_IDLE_TTL_SECONDS", "1800"))
+SESSION_VERSION_CHECK_SECONDS = float(os.getenv("SESSION_VERSION_CHECK_SECONDS", "2"))
+
+class SessionLocks:
+    """
+    One ``asyncio.Lock`` per (user_id, domain), held for the whole of a turn
+    so turns for a session apply in order.
+
+    The locks live apart from the cached UserSession objects, so evicting or
+    reloading a session while a turn holds its lock cannot hand the next
+    request a fresh, unlocked copy. An entry only exists while a turn holds
+    or waits for it.
+    """
+
+    def __init__(self):
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    def in_use(self, key):
+        """Whether a turn holds or waits for the lock of ``key``."""
+        return key in self._locks
+
+    def locked(self, key):
+        entry = self._locks.get(key)
+        return entry is not None and entry["lock"].locked()
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = {"lock": asyncio.Lock(), "users": 0}
+        entry["users"] += 1
+        try:
+            async with entry["lock"]:
+                yield
+        finally:
+            entry["users"] -= 1
+            if not entry["users"]:
+                del self._locks[key]
+
+session_locks = SessionLocks()
+
+
+class SessionStore:
+    """
+    Bounded LRU cache of UserSession objects keyed by (user_id, domain).
+
+    Entries are ordered by ``last_active``; the least recently active ones are
+    evicted once the cache is over ``max_size`` or idle for longer than
+    ``idle_ttl`` seconds. A miss rebuilds the session from the session
+    backend, which only reads the user's last 20 messages. A hit is also
+    rebuilt when another worker has appended turns since it was loaded; that
+    is checked against the backend at most once per ``version_check``
+    seconds per session, so a burst of requests costs one lookup. Sessions
+    with a turn in progress (see ``SessionLocks``) are neither evicted nor
+    replaced, so queued turns keep the history the running turn appends to.
+    """
+
+    def __init__(self, max_size: int, idle_ttl: float, version_check: float = 0.0):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.version_check = version_check
+        self._sessions = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+        self.version_checks = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, key):
+        return key in self._sessions
+
+    def discard(self, user_id: str, domain: str):
+        """Drop a cached session so the next request rebuilds it from the backend."""
+        self._sessions.pop((user_id, domain), None)
+
+    def _is_idle(self, session, now):
+        return now - session.last_active > self.idle_ttl
+
+    def get(self, user_id: str, domain: str) -> UserSession:
+        """Return the cached session for (user_id, domain), rehydrating it on a miss."""
+        key = (user_id, domain)
+        now = time.time()
+        session = self._sessions.get(key)
+        busy = session_locks.in_use(key)
+        if session is not None and not busy and self._is_idle(session, now):
+            del self._sessions[key]
+            self.evictions += 1
+            session = None
+        if session is not None and not busy and now - session.checked_at >= self.version_check:
+            session.checked_at = now
+            self.version_checks += 1
+            if session_backend.version(user_id, domain) > session.version:
+                del self._sessions[key]
+                self.stale += 1
+                session = None
+
+        if session is None:
+            self.misses += 1
+            session = UserSession(domain, user_id)
+            self._sessions[key] = session
+        else:
+            self.hits += 1
+            self._sessions.move_to_end(key)
+
+        session.last_active = now
+        self._evict(now)
+        return session
+
+    def _evict(self, now):
+        size, evicted = len(self._sessions), []
+        for key, session in self._sessions.items():
+            if size <= self.max_size and not self._is_idle(session, now):
+                break
+            if session_locks.in_use(key):
+                continue
+            evicted.append(key)
+            size -= 1
+        for key in evicted:
+            del self._sessions[key]
+        self.evictions += len(evicted)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._sessions),
+            "max_size": self.max_size,
+            "busy_sessions": len(session_locks),
+            "idle_ttl_seconds": self.idle_ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale_reloads": self.stale,
+            "version_checks": self.version_checks,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+sessions = SessionStore(SESSION_CACHE_MAX_SIZE, SESSION_IDLE_TTL_SECONDS, SESSION_VERSION_CHECK_SECONDS)
+
+# Initialize environment and API keys
+
+# Define OpenAI API keys: OPENAI_API_KEYS (comma separated), or
+# OPENAI_API_KEY plus OPENAI_API_KEY_2, OPENAI_API_KEY_3, ...
+if os.getenv("OPENAI_API_KEYS"):
+    OPENAI_API_KEYS = [key.strip() for key in os.getenv("OPENAI_API_KEYS").split(",") if key.strip()]
+else:
+    OPENAI_API_KEYS = [os.getenv("OPENAI_API_KEY")] + [
+        os.getenv(f"OPENAI_API_KEY_{index}") for index in range(2, 11)
+    ]
+    OPENAI_API_KEYS = [key for key in OPENAI_API_KEYS if key]
+
+# Initialize LangChain OpenAI client
+# Embedding cache settings
+EMBEDDING_MODEL = 'text-embedding-3-large'
+EMBEDDING_DIMENSIONS = 768  # Set to match existing Chroma collection dimensionality
+EMBEDDING_CACHE_ENABLED = env_flag("EMBEDDING_CACHE_ENABLED", True)
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+EMBEDDING_CACHE_MEMORY_SIZE = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "5000"))
+EMBEDDING_CACHE_WARM_LOAD = env_flag("EMBEDDING_CACHE_WARM_LOAD", False)
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that stores vectors in the ``embedding_cache`` table.
+
+    Keys are a hash of the model, dimensions and normalized text (whitespace
+    collapsed, case folded), and vectors are stored as float32 blobs. Lookups
+    go through an in-process LRU first and batch the SQLite reads, so only
+    texts that were never embedded reach the API. Retrievers call this from
+    worker threads, hence the lock around the in-memory tier. ``underlying``
+    is a Component, so the API client is only built on the first miss.
+    """
+
+    PRUNE_EVERY = 500
+
+    def __init__(self, underlying, model, dimensions, enabled=True, max_entries=100000, memory_size=5000):
+        self._underlying = underlying
+        self.model = model
+        self.dimensions = dimensions
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.memory_size = memory_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    @property
+    def underlying(self):
+        return self._underlying.get()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split()).casefold()
+
+    def cache_key(self, text: str) -> str:
+        raw = f"{self.model}|{self.dimensions}|{self.normalize(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _lookup(self, keys):
+        """Return {key: vector} for every key found in memory or SQLite."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector
+            self.memory_hits += len(found)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing:
+            now = time.time()
+            with get_db() as db:
+                for start in range(0, len(missing), 500):
+                    batch = missing[start:start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = db.execute(f'''
+                        SELECT key, vector FROM embedding_cache WHERE key IN ({placeholders})
+                    ''', batch).fetchall()
+                    hit_keys = [row['key'] for row in rows]
+                    for row in rows:
+                        vector = np.frombuffer(row['vector'], dtype=np.float32)
+                        found[row['key']] = vector
+                        self._remember(row['key'], vector)
+                    if hit_keys:
+                        db.executemany(
+                            "UPDATE embedding_cache SET last_used = ? WHERE key = ?",
+                            [(now, key) for key in hit_keys],
+                        )
+                        self.db_hits += len(hit_keys)
+                db.commit()
+        return found
+
+    def _store(self, items):
+        now = time.time()
+        rows = []
+        for key, vector in items:
+            vector = np.asarray(vector, dtype=np.float32)
+            self._remember(key, vector)
+            rows.append((key, self.model, self.dimensions, vector.tobytes(), now, now))
+        with get_db() as db:
+            db.executemany('''
+                INSERT OR REPLACE INTO embedding_cache
+                (key, model, dimensions, vector, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            previous = self._writes
+            self._writes += len(rows)
+            if previous // self.PRUNE_EVERY != self._writes // self.PRUNE_EVERY:
+                db.execute('''
+                    DELETE FROM embedding_cache WHERE key IN (
+                        SELECT key FROM embedding_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                    )
+                ''', (self.max_entries,))
+            db.commit()
+
+    def _split(self, texts):
+        keys = [self.cache_key(text) for text in texts]
+        found = self._lookup(keys)
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in pending:
+                pending[key] = text
+        self.misses += len(pending)
+        return keys, found, pending
+
+    def embed_documents(self, texts):
+        if not self.enabled:
+            return self.underlying.embed_documents(texts)
+        keys, found, pending = self._split(texts)
+        if pending:
+            vectors = self.underlying.embed_documents(list(pending.values()))
+            new_items = list(zip(pending.keys(), vectors))
+            self._store(new_items)
+            found.update((key, np.asarray(vector, dtype=np.float32)) for key, vector in new_items)
+        return [found[key].tolist() for key in keys]
+
+    async def aembed_documents(self, texts):
+        if not self.enabled:
+            return await self.underlying.aembed_documents(texts)
+        keys, found, pending = await asyncio.to_thread(self._split, texts)
+        if pending:
+            vectors = await self.underlying.aembed_documents(list(pending.values()))
+            new_items = list(zip(pending.keys(), vectors))
+            await asyncio.to_thread(self._store, new_items)
+            found.update((key, np.asarray(vector, dtype=np.float32)) for key, vector in new_items)
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text):
+        if not self.enabled:
+            return self.underlying.embed_query(text)
+        key = self.cache_key(text)
+        found = self._lookup([key])
+        if key in found:
+            return found[key].tolist()
+        self.misses += 1
+        vector = self.underlying.embed_query(text)
+        self._store([(key, vector)])
+        return vector
+
+    async def aembed_query(self, text):
+        if not self.enabled:
+            return await self.underlying.aembed_query(text)
+        key = self.cache_key(text)
+        found = await asyncio.to_thread(self._lookup, [key])
+        if key in found:
+            return found[key].tolist()
+        self.misses += 1
+        vector = await self.underlying.aembed_query(text)
+        await asyncio.to_thread(self._store, [(key, vector)])
+        return vector
+
+    def warm_load(self):
+        """Load the most recently used vectors into the in-process LRU."""
+        with get_db() as db:
+            rows = db.execute('''
+                SELECT key, vector FROM embedding_cache
+                WHERE model = ? AND dimensions = ?
+                ORDER BY last_used DESC LIMIT ?
+            ''', (self.model, self.dimensions, self.memory_size)).fetchall()
+        for row in reversed(rows):
+            self._remember(row['key'], np.frombuffer(row['vector'], dtype=np.float32))
+        logger.info(f"Warm-loaded {len(rows)} cached embeddings")
+
+    def stats(self):
+        hits = self.memory_hits + self.db_hits
+        lookups = hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "memory_entries": len(self._memory),
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+def build_openai_embeddings():
+    from langchain.embeddings.openai import OpenAIEmbeddings
+
+    return OpenAIEmbeddings(
+        model=EMBEDDING_MODEL,
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        dimensions=EMBEDDING_DIMENSIONS
+    )
+
+# Initialize embeddings and vector store
+embedding = CachedEmbeddings(
+    Component("embeddings", build_openai_embeddings),
+    EMBEDDING_MODEL,
+    EMBEDDING_DIMENSIONS,
+    enabled=EMBEDDING_CACHE_ENABLED,
+    max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+    memory_size=EMBEDDING_CACHE_MEMORY_SIZE,
+)
+
+persist_directory = "chroma"
+# How long a stat of the Chroma database is reused before checking again
+CORPUS_CHECK_SECONDS = float(os.getenv("CORPUS_CHECK_SECONDS", "1"))
+
+
+class CorpusWatcher:
+    """
+    Version of the Chroma database on disk, as (mtime_ns, size) of its
+    SQLite file, or None while it does not exist.
+
+    The vector index, domain retrievers, product catalogue and semantic cache
+    all compare this against the version their state was built from. The
+    file is stat'ed at most once per ``interval`` seconds however many of
+    them ask, so a change is noticed within ``interval``.
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._version = None
+        self._checked_at = None
+
+    def _read(self):
+        try:
+            stat = os.stat(self.path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def version(self):
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.interval:
+            self._version = self._read()
+            self._checked_at = now
+        return self._version
+
+corpus = CorpusWatcher(os.path.join(persist_directory, "chroma.sqlite3"), CORPUS_CHECK_SECONDS)
+
+
+def build_chroma_client():
+    import chromadb
+
+    try:
+        return chromadb.PersistentClient(path=persist_directory)
+    except Exception as e:
+        raise RuntimeError(f"Error loading ChromaDB: {str(e)}") from e
+
+chroma = Component("chroma", build_chroma_client, probe=lambda client: client.heartbeat())
+
+
+def chroma_store(collection_name):
+    """LangChain vector store over one collection of the shared Chroma client."""
+    from langchain.vectorstores import Chroma
+
+    return Chroma(client=chroma.get(), collection_name=collection_name, embedding_function=embedding)
+
+# API key pool settings (limits apply to each key)
+OPENAI_KEY_RPM = int(os.getenv("OPENAI_KEY_RPM", "500"))
+OPENAI_KEY_TPM = int(os.getenv("OPENAI_KEY_TPM", "300000"))
+OPENAI_KEY_MAX_IN_FLIGHT = int(os.getenv("OPENAI_KEY_MAX_IN_FLIGHT", "16"))
+OPENAI_KEY_FAILURE_THRESHOLD = int(os.getenv("OPENAI_KEY_FAILURE_THRESHOLD", "3"))
+OPENAI_KEY_COOLDOWN_SECONDS = float(os.getenv("OPENAI_KEY_COOLDOWN_SECONDS", "30"))
+OPENAI_KEY_ACQUIRE_TIMEOUT = float(os.getenv("OPENAI_KEY_ACQUIRE_TIMEOUT", "30"))
+LLM_EXPECTED_OUTPUT_TOKENS = int(os.getenv("LLM_EXPECTED_OUTPUT_TOKENS", "800"))
+
+# Deadline, retry and hedging settings
+CHAT_DEADLINE_SECONDS = float(os.getenv("CHAT_DEADLINE_SECONDS", "60"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+LLM_HEDGING_ENABLED = env_flag("LLM_HEDGING_ENABLED", False)
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1.0"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_MODEL = os.getenv("LLM_HEDGE_MODEL", "")
+
+class KeyPoolExhausted(Exception):
+    """Raised when no API key frees up within the acquire timeout."""
+
+
+class TokenBucket:
+    """Refills ``per_minute`` units evenly over a minute, up to that capacity."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until ``amount`` units are available (0 if they are now)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount, now):
+        """Take ``amount`` units; a negative amount refunds an over-estimate."""
+        self._refill(now)
+        self.level = min(self.capacity, self.level - amount)
+
+
+class ApiKeyState:
+    """Budgets, in-flight count and circuit breaker for one OpenAI API key."""
+
+    def __init__(self, key, rpm, tpm, max_in_flight):
+        self.key = key
+        self.label = f"{key[:8]}..."
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.total_requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self._chat_models = {}
+        self._client = None
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        if self._client is None:
+            from openai import AsyncOpenAI
+
+            self._client = AsyncOpenAI(api_key=self.key, max_retries=0)
+        return self._client
+
+    def chat_model(self, model_name, temperature, streaming, max_tokens=None) -> ChatOpenAI:
+        """Return a ChatOpenAI bound to this key, reusing it across calls."""
+        cache_key = (model_name, temperature, streaming, max_tokens)
+        model = self._chat_models.get(cache_key)
+        if model is None:
+            model = ChatOpenAI(
+                model=model_name,
+                temperature=temperature,
+                openai_api_key=self.key,
+                max_retries=0,
+                streaming=streaming,
+                max_tokens=max_tokens,
+            )
+            self._chat_models[cache_key] = model
+        return model
+
+    def load(self):
+        return self.in_flight / self.max_in_flight
+
+    def wait_time(self, tokens, now):
+        """Seconds until this key can take a call, or None if it is at its in-flight cap."""
+        if now < self.open_until:
+            return self.open_until - now
+        if self.in_flight >= self.max_in_flight:
+            return None
+        return max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+    def trip(self, seconds, now):
+        self.open_until = max(self.open_until, now + seconds)
+        logger.warning(f"Circuit opened for API key {self.label} for {seconds:.1f}s")
+
+    def to_dict(self, now):
+        return {
+            "key": self.label,
+            "in_flight": self.in_flight,
+            "requests_available": round(self.requests.level, 1),
+            "tokens_available": round(self.tokens.level),
+            "circuit_open": now < self.open_until,
+            "total_requests": self.total_requests,
+            "rate_limited": self.rate_limited,
+            "errors": self.errors,
+        }
+
+
+class KeyLease:
+    """A reserved slot on one key for the duration of a single API call."""
+
+    def __init__(self, state, estimated_tokens):
+        self.state = state
+        self.estimated_tokens = estimated_tokens
+        self.used_tokens = None
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        return self.state.client
+
+    def chat_model(self, model_name, temperature, streaming, max_tokens=None) -> ChatOpenAI:
+        return self.state.chat_model(model_name, temperature, streaming, max_tokens)
+
+    def record_usage(self, llm_output):
+        usage = (llm_output or {}).get("token_usage") or {}
+        if usage.get("total_tokens"):
+            self.used_tokens = usage["total_tokens"]
+
+
+def retry_after_seconds(error):
+    """Read Retry-After (or retry-after-ms) from an OpenAI error response."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class KeyPool:
+    """
+    Spreads OpenAI calls across API keys by load and remaining budget.
+
+    Each call leases the least-loaded key that has request and token budget
+    left and is below its in-flight cap, waiting if none is ready. A 429
+    opens that key's circuit for the Retry-After period, auth errors open it
+    for a long cooldown, and repeated connection or server errors open it
+    with exponential backoff.
+    """
+
+    def __init__(self, keys, rpm, tpm, max_in_flight, failure_threshold, cooldown, acquire_timeout):
+        self.keys = [ApiKeyState(key, rpm, tpm, max_in_flight) for key in keys]
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.acquire_timeout = acquire_timeout
+        self._released = asyncio.Event()
+        self.waits = 0
+
+    def _ready(self, tokens, now):
+        ready, waits = [], []
+        for state in self.keys:
+            wait = state.wait_time(tokens, now)
+            if wait == 0:
+                ready.append(state)
+            elif wait is not None:
+                waits.append(wait)
+        return ready, waits
+
+    def _take(self, state, tokens, now):
+        state.requests.consume(1, now)
+        state.tokens.consume(tokens, now)
+        state.in_flight += 1
+        state.total_requests += 1
+        return state
+
+    @staticmethod
+    def _least_loaded(states):
+        return min(states, key=lambda state: (state.load(), -state.tokens.level))
+
+    def _require_keys(self):
+        if not self.keys:
+            raise RuntimeError("No OpenAI API keys configured")
+
+    async def _acquire(self, tokens, avoid=None):
+        self._require_keys()
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            now = time.monotonic()
+            ready, waits = self._ready(tokens, now)
+            if ready:
+                preferred = [state for state in ready if state is not avoid] or ready
+                return self._take(self._least_loaded(preferred), tokens, now)
+            if now >= deadline:
+                raise KeyPoolExhausted(f"No API key available after {self.acquire_timeout:g}s")
+            self.waits += 1
+            delay = min(waits + [deadline - now, 1.0])
+            released = self._released
+            try:
+                await asyncio.wait_for(released.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def pick(self):
+        """Take the least-loaded key without waiting, for synchronous callers."""
+        self._require_keys()
+        now = time.monotonic()
+        ready, _ = self._ready(0, now)
+        candidates = ready or [state for state in self.keys if now >= state.open_until] or self.keys
+        return self._take(self._least_loaded(candidates), 0, now)
+
+    def release(self, state, lease=None, error=None):
+        now = time.monotonic()
+        state.in_flight -= 1
+        if lease is not None and lease.used_tokens is not None:
+            state.tokens.consume(lease.used_tokens - lease.estimated_tokens, now)
+
+        if error is None:
+            state.failures = 0
+        else:
+            self._record_error(state, error, now)
+
+        # Wake every waiter so they can re-check the keys
+        released, self._released = self._released, asyncio.Event()
+        released.set()
+
+    def _record_error(self, state, error, now):
+        import openai
+
+        if isinstance(error, openai.RateLimitError):
+            state.rate_limited += 1
+            state.trip(retry_after_seconds(error) or self.cooldown, now)
+        elif isinstance(error, (openai.AuthenticationError, openai.PermissionDeniedError)):
+            state.errors += 1
+            state.trip(self.cooldown * 10, now)
+        elif isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+            state.errors += 1
+            state.failures += 1
+            if state.failures >= self.failure_threshold:
+                backoff = 2 ** (state.failures - self.failure_threshold)
+                state.trip(min(self.cooldown * backoff, self.cooldown * 10), now)
+
+    def warm(self, models):
+        """Create every key's HTTP client and the chat models ``models`` will lease."""
+        self._require_keys()
+        for state in self.keys:
+            state.client
+            for model in models:
+                state.chat_model(model.model_name, model.temperature, model.streaming, model.max_tokens)
+        return self
+
+    @asynccontextmanager
+    async def lease(self, estimated_tokens=0, avoid=None):
+        """Reserve a key for one call, preferring any key other than ``avoid``."""
+        state = await self._acquire(estimated_tokens, avoid)
+        lease = KeyLease(state, estimated_tokens)
+        try:
+            yield lease
+        except Exception as e:
+            self.release(state, lease, e)
+            raise
+        except BaseException:
+            self.release(state, lease)
+            raise
+        else:
+            self.release(state, lease)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "keys": [state.to_dict(now) for state in self.keys],
+            "waits": self.waits,
+        }
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token)."""
+    return len(text) // 4 + 1
+
+
+_token_encoder = None
+_token_encoder_failed = False
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens with the model's tiktoken encoding, falling back to
+    ``estimate_tokens`` when tiktoken or its encoding files are unavailable.
+    """
+    global _token_encoder, _token_encoder_failed
+    if _token_encoder is None and not _token_encoder_failed:
+        try:
+            import tiktoken
+            try:
+                _token_encoder = tiktoken.encoding_for_model(llm.model_name)
+            except KeyError:
+                _token_encoder = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            _token_encoder_failed = True
+            logger.warning(f"tiktoken unavailable, estimating token counts: {str(e)}")
+    if _token_encoder is None:
+        return estimate_tokens(text)
+    return len(_token_encoder.encode(text, disallowed_special=()))
+
+
+def retry_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff before retry number ``attempt`` (1-based)."""
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+class LatencyTracker:
+    """
+    Sliding window of time-to-first-token samples for one model.
+
+    The hedge delay is a percentile of the window, so a duplicate request is
+    only sent for calls that are already slower than most recent ones. For
+    each hedge win it also keeps how much sooner the hedge responded than the
+    primary attempt, the time the hedge saved.
+    """
+
+    def __init__(self, window: int = 500):
+        self.samples = deque(maxlen=window)
+        self.savings = deque(maxlen=window)
+        self.requests = 0
+        self.hedges_fired = 0
+        self.hedge_wins = 0
+        self.saved_seconds = 0.0
+        self.savings_lower_bound = 0
+
+    def record(self, seconds, hedge_won=False):
+        self.samples.append(seconds)
+        self.requests += 1
+        if hedge_won:
+            self.hedge_wins += 1
+
+    def record_saving(self, seconds, exact):
+        """
+        Time a winning hedge saved. When the primary attempt never responded
+        before the call finished, ``seconds`` is only a lower bound.
+        """
+        self.savings.append(seconds)
+        self.saved_seconds += seconds
+        if not exact:
+            self.savings_lower_bound += 1
+
+    def percentile(self, p, samples=None):
+        samples = self.samples if samples is None else samples
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def hedge_delay(self):
+        if len(self.samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return max(LLM_HEDGE_MIN_DELAY, self.percentile(LLM_HEDGE_PERCENTILE))
+
+    def stats(self):
+        def rounded(p, samples=None):
+            value = self.percentile(p, samples)
+            return round(value, 3) if value is not None else None
+        return {
+            "requests": self.requests,
+            "ttft_p50": rounded(50),
+            "ttft_p95": rounded(95),
+            "ttft_p99": rounded(99),
+            "hedge_delay": self.hedge_delay(),
+            "hedges_fired": self.hedges_fired,
+            "hedge_wins": self.hedge_wins,
+            "hedge_rate": self.hedges_fired / self.requests if self.requests else 0.0,
+            "hedge_saved_seconds": round(self.saved_seconds, 3),
+            "hedge_saved_p50": rounded(50, self.savings),
+            "hedge_saved_p95": rounded(95, self.savings),
+            "hedge_saved_lower_bound": self.savings_lower_bound,
+        }
+
+
+class HedgeRace:
+    """
+    Decides which of several attempts at one LLM call wins.
+
+    The first attempt to stream a token (or, without streaming, to finish)
+    claims the race; the others are cancelled and their tokens dropped. When
+    a hedge wins, the primary attempt is only cancelled once it responds too
+    (or the call ends), so the time the hedge saved can be measured.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.tasks = []
+        self.keys = {}
+        self.winner = None
+        self.claim_seconds = None
+        self.primary_seconds = None
+        self.claimed = asyncio.Event()
+
+    def claim(self, index):
+        elapsed = time.monotonic() - self.started
+        if self.winner is None:
+            self.winner = index
+            self.claim_seconds = elapsed
+            self.claimed.set()
+            for other, task in enumerate(self.tasks):
+                if other not in (index, 0) and not task.done():
+                    task.cancel()
+        elif index == 0 and self.winner != 0 and self.primary_seconds is None:
+            self.primary_seconds = elapsed
+            self.tasks[0].cancel()
+        return self.winner == index
+
+    def saving(self):
+        """(seconds the winning hedge saved, whether that is exact rather than a lower bound)."""
+        if self.primary_seconds is not None:
+            return self.primary_seconds - self.claim_seconds, True
+        return time.monotonic() - self.started - self.claim_seconds, False
+
+
+class RaceRunManager:
+    """Forwards streamed tokens to the real run manager only for the race winner."""
+
+    def __init__(self, race, index, run_manager):
+        self._race = race
+        self._index = index
+        self._run_manager = run_manager
+
+    async def on_llm_new_token(self, token, **kwargs):
+        if self._race.claim(self._index) and self._run_manager is not None:
+            await self._run_manager.on_llm_new_token(token, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._run_manager, name)
+
+
+class PooledChatOpenAI(BaseChatModel):
+    """
+    Chat model that leases a key from ``pool`` on every call.
+
+    Chains hold on to this object, so sessions created before a key trips
+    still move to a healthy key on their next call. With ``hedge`` set, a
+    call that has not produced its first token by the tracker's hedge delay
+    is duplicated on another key (or ``LLM_HEDGE_MODEL``); the first
+    attempt to respond wins. Call latencies are recorded under ``role``,
+    and also as the request stage ``stage`` when one is set.
+    """
+
+    pool: Any
+    model_name: str = "gpt-4o"
+    temperature: float = 0.1
+    streaming: bool = False
+    max_tokens: Optional[int] = None
+    hedge: bool = False
+    latency: Any = None
+    role: str = "answer"
+    stage: Optional[str] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "pooled-openai-chat"
+
+    @property
+    def _identifying_params(self):
+        return {"model_name": self.model_name, "temperature": self.temperature}
+
+    def _estimate(self, messages):
+        prompt_tokens = sum(estimate_tokens(str(message.content)) for message in messages)
+        return prompt_tokens + (self.max_tokens or LLM_EXPECTED_OUTPUT_TOKENS)
+
+    async def _attempt(self, race, index, model_name, messages, stop, run_manager, kwargs):
+        avoid = race.keys.get(0) if index else None
+        async with self.pool.lease(self._estimate(messages), avoid=avoid) as lease:
+            race.keys[index] = lease.state
+            model = lease.chat_model(model_name, self.temperature, self.streaming, self.max_tokens)
+            result = await model._agenerate(
+                messages, stop=stop, run_manager=RaceRunManager(race, index, run_manager), **kwargs
+            )
+            lease.record_usage(result.llm_output)
+        race.claim(index)
+        return result
+
+    async def _await_winner(self, race):
+        pending = set(race.tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    continue
+                index = race.tasks.index(task)
+                if task.exception() is not None:
+                    if race.winner == index:
+                        raise task.exception()
+                    error = error or task.exception()
+                    continue
+                if race.winner == index:
+                    if self.latency is not None:
+                        self.latency.record(race.claim_seconds, hedge_won=index > 0)
+                    latency_metrics.histogram(
+                        "klyra_llm_seconds", llm=self.role, phase="ttft"
+                    ).observe(race.claim_seconds)
+                    return task.result()
+        raise error
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        race = HedgeRace()
+        race.tasks.append(asyncio.create_task(
+            self._attempt(race, 0, self.model_name, messages, stop, run_manager, kwargs)
+        ))
+        try:
+            delay = self.latency.hedge_delay() if self.hedge and self.latency is not None else None
+            if delay is not None:
+                claimed = asyncio.ensure_future(race.claimed.wait())
+                done, _ = await asyncio.wait(
+                    {race.tasks[0], claimed}, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                claimed.cancel()
+                if not done:
+                    self.latency.hedges_fired += 1
+                    race.tasks.append(asyncio.create_task(self._attempt(
+                        race, 1, LLM_HEDGE_MODEL or self.model_name, messages, stop, run_manager, kwargs
+                    )))
+            result = await self._await_winner(race)
+            total = time.monotonic() - race.started
+            latency_metrics.histogram("klyra_llm_seconds", llm=self.role, phase="total").observe(total)
+            if self.stage is not None:
+                latency_metrics.observe_stage(self.stage, total)
+            return result
+        finally:
+            if race.winner and self.latency is not None:
+                saved, exact = race.saving()
+                self.latency.record_saving(saved, exact)
+                latency_metrics.histogram(
+                    "klyra_llm_seconds", llm=self.role, phase="hedge_saved"
+                ).observe(saved)
+            for task in race.tasks:
+                if not task.done():
+                    task.cancel()
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        state = self.pool.pick()
+        error = None
+        try:
+            model = state.chat_model(self.model_name, self.temperature, self.streaming, self.max_tokens)
+            return model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.pool.release(state, error=error)
+
+# Initialize the key pool and the models that use it
+key_pool = KeyPool(
+    OPENAI_API_KEYS,
+    OPENAI_KEY_RPM,
+    OPENAI_KEY_TPM,
+    OPENAI_KEY_MAX_IN_FLIGHT,
+    OPENAI_KEY_FAILURE_THRESHOLD,
+    OPENAI_KEY_COOLDOWN_SECONDS,
+    OPENAI_KEY_ACQUIRE_TIMEOUT,
+)
+
+# Answers stream so token callbacks fire as text is generated
+llm = PooledChatOpenAI(
+    pool=key_pool,
+    model_name="gpt-4o",
+    temperature=0.1,
+    streaming=True,
+    hedge=LLM_HEDGING_ENABLED,
+    latency=LatencyTracker(),
+)
+
+# Non-streaming twin used to condense follow-up questions and suggest questions,
+# so its output never reaches a token stream
+completion_llm = PooledChatOpenAI(
+    pool=key_pool,
+    model_name="gpt-4o",
+    temperature=0.1,
+    hedge=LLM_HEDGING_ENABLED,
+    latency=LatencyTracker(),
+    role="condense",
+    stage="condense",
+)
+
+
+# In-process vector index settings
+VECTOR_INDEX_BACKEND = os.getenv("VECTOR_INDEX_BACKEND", "chroma")
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "vector_index")
+VECTOR_INDEX_DTYPE = os.getenv("VECTOR_INDEX_DTYPE", "float32")
+VECTOR_INDEX_HNSW_THRESHOLD = int(os.getenv("VECTOR_INDEX_HNSW_THRESHOLD", "50000"))
+VECTOR_INDEX_BLOCK_ROWS = 65536
+
+
+class NumpyVectorIndex:
+    """
+    The Chroma collection's vectors held as one memory-mapped NumPy matrix.
+
+    Vectors are exported once from ``vectordb`` into ``directory`` as
+    unit-length rows stored as float32, float16 or int8 (with a per-row
+    scale), and re-exported when the Chroma database on disk changes.
+    Queries are scored with blocked matrix products, or through an hnswlib
+    graph once the collection has ``hnsw_threshold`` vectors and hnswlib is
+    installed. Since the stored embeddings are normalized, inner product
+    ranks the same as Chroma's L2 distance.
+    """
+
+    DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+    def __init__(self, vectordb, directory, dtype, hnsw_threshold, corpus):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Unsupported vector index dtype: {dtype}")
+        self.vectordb = vectordb
+        self.directory = directory
+        self.dtype = dtype
+        self.hnsw_threshold = hnsw_threshold
+        self.corpus = corpus
+        self._lock = threading.Lock()
+        self._version = None
+        self._matrix = None
+        self._scales = None
+        self._ids = []
+        self._texts = []
+        self._metadatas = []
+        self._hnsw = None
+        self.builds = 0
+        self.queries = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{self.dtype}-{name}")
+
+    def is_current(self):
+        return self._matrix is not None and self.corpus.version() == self._version
+
+    def ensure_loaded(self):
+        """Map the exported matrix, exporting it first if it is missing or stale."""
+        if self.is_current():
+            return
+        with self._lock:
+            version = self.corpus.version()
+            if self._matrix is not None and version == self._version:
+                return
+            meta = None
+            try:
+                with open(self._path("meta.json")) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                pass
+            # JSON stores the version tuple as a list
+            if meta is None or meta["corpus_version"] != (list(version) if version else None):
+                self._export(version)
+            self._load(version)
+
+    def _export(self, version):
+        started = time.time()
+        data = self.vectordb.get(include=["embeddings", "documents", "metadatas"])
+        vectors = np.asarray(data["embeddings"], dtype=np.float32)
+        if vectors.size:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.where(norms == 0, 1, norms)
+        scales = None
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127 if vectors.size else np.zeros(0, np.float32)
+            scales = np.where(scales == 0, 1, scales).astype(np.float32)
+            stored = np.round(vectors / scales[:, None]).astype(np.int8)
+        else:
+            stored = vectors.astype(self.DTYPES[self.dtype])
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        def write(name, writer):
+            tmp = self._path(name) + ".tmp"
+            with open(tmp, "wb") as f:
+                writer(f)
+            os.replace(tmp, self._path(name))
+
+        write("vectors.npy", lambda f: np.save(f, stored))
+        if scales is not None:
+            write("scales.npy", lambda f: np.save(f, scales))
+        write("documents.json", lambda f: f.write(json.dumps({
+            "ids": data["ids"],
+            "documents": data["documents"],
+            "metadatas": data["metadatas"],
+        }).encode()))
+        # Written last so a partial export is never mistaken for a current one
+        write("meta.json", lambda f: f.write(json.dumps({
+            "corpus_version": list(version) if version else None,
+            "count": len(data["ids"]),
+            "dimensions": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+        }).encode()))
+        self.builds += 1
+        logger.info(
+            f"Exported {len(data['ids'])} vectors to {self.directory} as {self.dtype} "
+            f"in {time.time() - started:.2f}s"
+        )
+
+    def _load(self, version):
+        matrix = np.load(self._path("vectors.npy"), mmap_mode="r")
+        scales = np.load(self._path("scales.npy")) if self.dtype == "int8" else None
+        with open(self._path("documents.json")) as f:
+            documents = json.load(f)
+        hnsw = None
+        if len(matrix) >= self.hnsw_threshold:
+            hnsw = self._load_hnsw(matrix, scales)
+        self._matrix, self._scales, self._hnsw = matrix, scales, hnsw
+        self._ids = documents["ids"]
+        self._texts = documents["documents"]
+        self._metadatas = documents["metadatas"]
+        self._version = version
+
+    def _load_hnsw(self, matrix, scales):
+        try:
+            import hnswlib
+        except ImportError:
+            logger.warning("hnswlib is not installed, using exact search")
+            return None
+        index = hnswlib.Index(space="ip", dim=matrix.shape[1])
+        path = self._path("hnsw.bin")
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(self._path("vectors.npy")):
+            index.load_index(path, max_elements=len(matrix))
+        else:
+            index.init_index(max_elements=len(matrix), ef_construction=200, M=16)
+            for start in range(0, len(matrix), VECTOR_INDEX_BLOCK_ROWS):
+                stop = start + VECTOR_INDEX_BLOCK_ROWS
+                index.add_items(self._rows(np.arange(start, min(stop, len(matrix))), matrix, scales))
+            index.save_index(path)
+        return index
+
+    def _rows(self, indices, matrix=None, scales=None):
+        """Float32 copies of the given rows."""
+        matrix = self._matrix if matrix is None else matrix
+        scales = self._scales if scales is None else scales
+        rows = np.asarray(matrix[indices], dtype=np.float32)
+        if scales is not None:
+            rows *= scales[indices][:, None]
+        return rows
+
+    def search(self, vectors, k):
+        """
+        Top-k rows by inner product for a batch of query vectors.
+
+        Returns:
+            tuple: (indices, scores), both of shape (len(vectors), k).
+        """
+        self.ensure_loaded()
+        self.queries += len(vectors)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        k = min(k, len(self._matrix))
+        if k == 0:
+            empty = np.zeros((len(vectors), 0))
+            return empty.astype(np.int64), empty
+        if self._hnsw is not None:
+            self._hnsw.set_ef(max(2 * k, 50))
+            labels, distances = self._hnsw.knn_query(vectors, k=k)
+            return labels.astype(np.int64), 1 - distances
+
+        scores = np.empty((len(vectors), len(self._matrix)), dtype=np.float32)
+        for start in range(0, len(self._matrix), VECTOR_INDEX_BLOCK_ROWS):
+            # Quantized blocks are widened one at a time so BLAS can be used
+            block = np.asarray(self._matrix[start:start + VECTOR_INDEX_BLOCK_ROWS], dtype=np.float32)
+            scores[:, start:start + len(block)] = vectors @ block.T
+        if self._scales is not None:
+            scores *= self._scales
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def mmr(self, vector, k, fetch_k, lambda_mult):
+        """Maximal marginal relevance over the ``fetch_k`` nearest rows."""
+        indices, scores = self.search([vector], fetch_k)
+        indices, scores = indices[0], scores[0]
+        if len(indices) == 0:
+            return indices
+        candidates = self._rows(indices)
+        similarity = candidates @ candidates.T
+        selected = [0]
+        redundancy = similarity[0].copy()
+        while len(selected) < min(k, len(indices)):
+            marginal = lambda_mult * scores - (1 - lambda_mult) * redundancy
+            marginal[selected] = -np.inf
+            best = int(np.argmax(marginal))
+            selected.append(best)
+            redundancy = np.maximum(redundancy, similarity[best])
+        return indices[selected]
+
+    def documents(self, indices):
+        return [
+            Document(page_content=self._texts[i], metadata=self._metadatas[i] or {})
+            for i in indices
+        ]
+
+    def ids(self, indices):
+        return [self._ids[i] for i in indices]
+
+    def stats(self):
+        return {
+            "loaded": self._matrix is not None,
+            "dtype": self.dtype,
+            "vectors": 0 if self._matrix is None else len(self._matrix),
+            "bytes": 0 if self._matrix is None else int(self._matrix.nbytes),
+            "hnsw": self._hnsw is not None,
+            "builds": self.builds,
+            "queries": self.queries,
+        }
+
+
+class NumpyRetriever(BaseRetriever):
+    """
+    LangChain retriever over a ``NumpyVectorIndex``, with the same search
+    types and defaults as Chroma's retriever.
+    """
+
+    index: Any
+    embeddings: Any
+    search_type: str = "mmr"
+    k: int = 4
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+
+    def _search(self, vector):
+        if self.search_type == "mmr":
+            indices = self.index.mmr(vector, self.k, self.fetch_k, self.lambda_mult)
+        else:
+            indices = self.index.search([vector], self.k)[0][0]
+        return self.index.documents(indices)
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return self._search(self.embeddings.embed_query(query))
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        vector = await self.embeddings.aembed_query(query)
+        if not self.index.is_current():
+            await asyncio.to_thread(self.index.ensure_loaded)
+        # A full matrix product (or an HNSW query) plus MMR; keep it off the loop
+        return await asyncio.to_thread(self._search, vector)
+
+
+class EmptyRetriever(BaseRetriever):
+    """Retriever for domains that have no documents."""
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return []
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        return []
+
+
+# Per-domain retrieval settings
+DOMAIN_COLLECTION_PREFIX = os.getenv("DOMAIN_COLLECTION_PREFIX", "domain-")
+# Empty by default: a domain without its own collection retrieves nothing.
+# Naming a shared collection (e.g. "langchain") is a migration aid only, as
+# every such domain then searches the same, mixed-tenant documents.
+DOMAIN_FALLBACK_COLLECTION = os.getenv("DOMAIN_FALLBACK_COLLECTION", "")
+# Most domains counted by name in the fallback stats; the rest share "(other)"
+DOMAIN_FALLBACK_STATS_MAX = 100
+
+
+class DomainRetrievers:
+    """
+    Retrievers for each domain's own Chroma collection, built on first use.
+
+    Domain ``x`` is served from the collection ``<prefix>x``. Domains without
+    one retrieve nothing while ``fallback_collection`` is empty (the
+    default), so one storefront's products never appear in another's
+    answers. A non-empty fallback gives every such domain the same shared
+    collection, which is not isolated; each fallback lookup is counted per
+    domain in ``stats()`` so that sharing stays visible. The collection names
+    are listed once and everything is resolved again when the Chroma database
+    on disk changes, which lets a newly ingested domain go live without a
+    restart. Only existing collections get a retriever, so arbitrary domain
+    strings all share one.
+    """
+
+    def __init__(self, client, prefix, fallback_collection, corpus):
+        self._client = client
+        self.prefix = prefix
+        self.fallback_collection = fallback_collection
+        self.corpus = corpus
+        self._lock = threading.Lock()
+        self._names = None
+        self._retrievers = {}
+        self._corpus_version = corpus.version()
+        self.reloads = 0
+        self.fallback_lookups = 0
+        self.fallback_domains = {}
+
+    @property
+    def client(self):
+        return self._client.get()
+
+    def collection_name(self, domain):
+        """Chroma collection name for ``domain`` (3-63 chars of [a-z0-9._-])."""
+        name = self.prefix + re.sub(r"[^a-z0-9._-]+", "-", domain.strip().lower())
+        return name[:63].strip("-._") or self.prefix.strip("-._")
+
+    def _collection_names(self):
+        if self._names is None:
+            # Chroma 0.6 lists names; older clients list Collection objects
+            self._names = {
+                collection if isinstance(collection, str) else collection.name
+                for collection in self.client.list_collections()
+            }
+        return self._names
+
+    def _exists(self, name):
+        return name in self._collection_names()
+
+    def _build(self, name):
+        if name is None:
+            return EmptyRetriever()
+        store = chroma_store(name)
+        if VECTOR_INDEX_BACKEND == "numpy":
+            index = NumpyVectorIndex(
+                store,
+                os.path.join(VECTOR_INDEX_DIR, name),
+                VECTOR_INDEX_DTYPE,
+                VECTOR_INDEX_HNSW_THRESHOLD,
+                self.corpus,
+            )
+            return NumpyRetriever(index=index, embeddings=embedding)
+        return store.as_retriever(search_type="mmr", k=10)
+
+    def _check_corpus(self):
+        version = self.corpus.version()
+        if version != self._corpus_version:
+            self._corpus_version = version
+            self._names = None
+            self._retrievers.clear()
+            self.reloads += 1
+            logger.info("Vector store changed, reloading domain retrievers")
+
+    def _collection_for(self, domain):
+        self._check_corpus()
+        name = self.collection_name(domain)
+        if self._exists(name):
+            return name
+        fallback = self.fallback_collection or None
+        if fallback is not None and not self._exists(fallback):
+            fallback = None
+        if fallback is not None:
+            self._count_fallback(name, fallback)
+        return fallback
+
+    def _count_fallback(self, name, fallback):
+        self.fallback_lookups += 1
+        if name not in self.fallback_domains:
+            if len(self.fallback_domains) >= DOMAIN_FALLBACK_STATS_MAX:
+                name = "(other)"
+            else:
+                logger.warning(f"No collection for {name!r}, searching the shared {fallback!r} collection")
+        self.fallback_domains[name] = self.fallback_domains.get(name, 0) + 1
+
+    def collection_for(self, domain):
+        """Name of the collection ``domain`` is served from, or None."""
+        with self._lock:
+            return self._collection_for(domain)
+
+    def get(self, domain):
+        """Return the retriever for ``domain``, creating it on first use."""
+        with self._lock:
+            name = self._collection_for(domain)
+            retriever = self._retrievers.get(name)
+            if retriever is None:
+                retriever = self._retrievers[name] = self._build(name)
+            return retriever
+
+    def warm(self):
+        """List the collections, then build the fallback's retriever and load its vectors into memory."""
+        with self._lock:
+            self._check_corpus()
+            self._collection_names()
+            name = self.fallback_collection
+            if not name or not self._exists(name):
+                return None
+            retriever = self._retrievers.get(name)
+            if retriever is None:
+                retriever = self._retrievers[name] = self._build(name)
+        if isinstance(retriever, NumpyRetriever):
+            retriever.index.ensure_loaded()
+        else:
+            # The first query loads the collection's HNSW segment from disk
+            retriever.vectorstore._collection.query(
+                query_embeddings=[[0.0] * EMBEDDING_DIMENSIONS], n_results=1
+            )
+        return name
+
+    def stats(self):
+        with self._lock:
+            indexes = {
+                name: retriever.index.stats()
+                for name, retriever in self._retrievers.items()
+                if isinstance(retriever, NumpyRetriever)
+            }
+            return {
+                "known_collections": len(self._names or ()),
+                "collections": len(self._retrievers),
+                "fallback_collection": self.fallback_collection or None,
+                "fallback_lookups": self.fallback_lookups,
+                "fallback_domains": dict(self.fallback_domains),
+                "reloads": self.reloads,
+                "vector_indexes": indexes,
+            }
+
+
+class DomainRetriever(BaseRetriever):
+    """
+    Retriever that looks up the current retriever for a domain per query.
+    ``aretrieve`` takes the domain per call, so one instance serves the
+    shared conversation chain; the standard interface uses ``domain``.
+    """
+
+    registry: Any
+    domain: Optional[str] = None
+
+    async def aretrieve(self, query, domain, callbacks=None):
+        return await self.registry.get(domain).ainvoke(query, config={"callbacks": callbacks})
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return self.registry.get(self.domain).invoke(
+            query, config={"callbacks": run_manager.get_child()}
+        )
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        return await self.registry.get(self.domain).ainvoke(
+            query, config={"callbacks": run_manager.get_child()}
+        )
+
+
+domain_retrievers = DomainRetrievers(
+    chroma,
+    DOMAIN_COLLECTION_PREFIX,
+    DOMAIN_FALLBACK_COLLECTION,
+    corpus,
+)
+
+# Product catalogue settings
+PRODUCT_MATCH_THRESHOLD = float(os.getenv("PRODUCT_MATCH_THRESHOLD", "0.6"))
+PRODUCT_MATCH_CANDIDATES = int(os.getenv("PRODUCT_MATCH_CANDIDATES", "10"))
+
+
+class ProductCatalog:
+    """
+    Product records parsed from each collection's documents.
+
+    Answers only name the products they recommend; everything sent to the
+    client (price, image, link) comes from here, so links are never made up.
+    A collection's products are loaded on first use into in-memory lookup
+    tables and the SQLite ``product_catalog`` tables, and reloaded when the
+    Chroma database changes. References are matched by id, then by exact
+    normalized name, then by fuzzy name match over FTS5 candidates.
+
+    A product's id is its CSV file name and row (``file.csv#row``), since row
+    numbers restart in every file ingested into a collection. Retrieved
+    product documents carry it as an ``Id:`` line for the model to cite.
+    Async callers use ``aresolve``, which loads and matches on a worker
+    thread.
+    """
+
+    FIELDS = {
+        "Name": "name",
+        "Highlights": "highlights",
+        "Price": "price",
+        "Image-src": "image_url",
+        "Product-page": "buy_link",
+    }
+    FIELD_RE = re.compile(r"^([A-Za-z][\w -]*):\s?(.*)$")
+    PAGE_SIZE = 5000
+
+    def __init__(self, client, corpus, threshold, candidates):
+        self._client = client
+        self.corpus = corpus
+        self.threshold = threshold
+        self.candidates = candidates
+        self._lock = threading.Lock()
+        self._tables = {}
+        self._corpus_version = corpus.version()
+        self.resolved = 0
+        self.fuzzy_matches = 0
+        self.unresolved = 0
+
+    @property
+    def client(self):
+        return self._client.get()
+
+    @staticmethod
+    def normalize(name):
+        return " ".join(re.findall(r"[a-z0-9]+", name.lower()))
+
+    @staticmethod
+    def product_id(metadata, default=None):
+        """``file.csv#row`` for a document loaded from a CSV row, else ``default``."""
+        if "row" not in metadata:
+            return default
+        source = os.path.basename(str(metadata.get("source") or ""))
+        return f"{source}#{metadata['row']}" if source else str(metadata["row"])
+
+    @classmethod
+    def tag(cls, doc):
+        """The document with its product id as a first ``Id:`` line, for the model to cite."""
+        product_id = cls.product_id(doc.metadata or {})
+        if product_id is None:
+            return doc
+        return Document(page_content=f"Id: {product_id}\n{doc.page_content}", metadata=doc.metadata)
+
+    @classmethod
+    def parse(cls, document):
+        """Product fields from a "Field: value" document, or None without a name."""
+        fields, key = {}, None
+        for line in document.splitlines():
+            match = cls.FIELD_RE.match(line)
+            if match:
+                key = match.group(1).strip()
+                fields[key] = match.group(2).strip()
+            elif key:
+                fields[key] += "\n" + line
+        if not fields.get("Name"):
+            return None
+        return {field: fields.get(key) for key, field in cls.FIELDS.items()}
+
+    def _load(self, collection_name):
+        started = time.time()
+        collection = self.client.get_collection(collection_name)
+        by_id, offset = {}, 0
+        while True:
+            page = collection.get(include=["documents", "metadatas"], limit=self.PAGE_SIZE, offset=offset)
+            for id_, document, metadata in zip(page["ids"], page["documents"], page["metadatas"]):
+                record = self.parse(document or "")
+                if record is None:
+                    continue
+                metadata = metadata or {}
+                record["id"] = self.product_id(metadata, id_)
+                by_id.setdefault(record["id"], record)
+            if len(page["ids"]) < self.PAGE_SIZE:
+                break
+            offset += self.PAGE_SIZE
+
+        with get_db() as db:
+            db.execute("DELETE FROM product_catalog WHERE collection = ?", (collection_name,))
+            db.execute("DELETE FROM product_catalog_fts WHERE collection = ?", (collection_name,))
+            db.executemany(
+                "INSERT INTO product_catalog "
+                "(collection, id, name, highlights, price, image_url, buy_link) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (collection_name, r["id"], r["name"], r["highlights"], r["price"], r["image_url"], r["buy_link"])
+                    for r in by_id.values()
+                ],
+            )
+            db.executemany(
+                "INSERT INTO product_catalog_fts (name, collection, product_id) VALUES (?, ?, ?)",
+                [(r["name"], collection_name, r["id"]) for r in by_id.values()],
+            )
+            db.commit()
+
+        by_name = {}
+        for record in by_id.values():
+            by_name.setdefault(self.normalize(record["name"]), record)
+        logger.info(
+            f"Loaded {len(by_id)} products from {collection_name} in {time.time() - started:.2f}s"
+        )
+        return {"by_id": by_id, "by_name": by_name}
+
+    def _table(self, collection_name):
+        with self._lock:
+            version = self.corpus.version()
+            if version != self._corpus_version:
+                self._corpus_version = version
+                self._tables.clear()
+            table = self._tables.get(collection_name)
+            if table is None:
+                table = self._tables[collection_name] = self._load(collection_name)
+            return table
+
+    def _fuzzy(self, collection_name, table, reference):
+        normalized = self.normalize(reference)
+        if not normalized:
+            return None
+        query = " OR ".join(f'"{token}"' for token in normalized.split())
+        with get_db() as db:
+            rows = db.execute(
+                "SELECT product_id FROM product_catalog_fts "
+                "WHERE product_catalog_fts MATCH ? AND collection = ? ORDER BY rank LIMIT ?",
+                (query, collection_name, self.candidates),
+            ).fetchall()
+        best, best_score = None, self.threshold
+        for row in rows:
+            record = table["by_id"].get(row["product_id"])
+            if record is None:
+                continue
+            score = difflib.SequenceMatcher(None, normalized, self.normalize(record["name"])).ratio()
+            if score >= best_score:
+                best, best_score = record, score
+        return best
+
+    def resolve(self, domain, references):
+        """
+        Find the catalogue record for a recommended product.
+
+        Args:
+            domain (str): Domain whose collection the product belongs to.
+            references (list): Ids or names given by the model, tried in order.
+
+        Returns:
+            dict or None: A copy of the product record.
+        """
+        collection_name = domain_retrievers.collection_for(domain)
+        references = [ref.strip() for ref in references if ref and ref.strip()]
+        if collection_name is None or not references:
+            self.unresolved += 1
+            return None
+        table = self._table(collection_name)
+        for reference in references:
+            record = table["by_id"].get(reference) or table["by_name"].get(self.normalize(reference))
+            if record is not None:
+                self.resolved += 1
+                return dict(record)
+        for reference in references:
+            record = self._fuzzy(collection_name, table, reference)
+            if record is not None:
+                self.resolved += 1
+                self.fuzzy_matches += 1
+                return dict(record)
+        self.unresolved += 1
+        logger.warning(f"No catalogue product matches {references[-1]!r} in {collection_name}")
+        return None
+
+    async def aresolve(self, domain, references):
+        """``resolve`` off the event loop: loads read Chroma and SQLite, fuzzy matches query FTS5."""
+        return await asyncio.to_thread(self.resolve, domain, references)
+
+    def stats(self):
+        return {
+            "collections": {name: len(table["by_id"]) for name, table in dict(self._tables).items()},
+            "resolved": self.resolved,
+            "fuzzy_matches": self.fuzzy_matches,
+            "unresolved": self.unresolved,
+        }
+
+
+product_catalog = ProductCatalog(
+    chroma,
+    corpus,
+    PRODUCT_MATCH_THRESHOLD,
+    PRODUCT_MATCH_CANDIDATES,
+)
+
+# How follow-up questions are turned into retrieval queries
+RETRIEVAL_QUERY_STRATEGIES = ("condense", "recent", "rewrite", "race")
+RETRIEVAL_QUERY_STRATEGY = os.getenv("RETRIEVAL_QUERY_STRATEGY", "recent")
+if RETRIEVAL_QUERY_STRATEGY not in RETRIEVAL_QUERY_STRATEGIES:
+    logger.warning(
+        f"Unknown RETRIEVAL_QUERY_STRATEGY {RETRIEVAL_QUERY_STRATEGY!r}, using 'recent'"
+    )
+    RETRIEVAL_QUERY_STRATEGY = "recent"
+RETRIEVAL_HISTORY_TURNS = int(os.getenv("RETRIEVAL_HISTORY_TURNS", "2"))
+RETRIEVAL_REWRITE_MODEL = os.getenv("RETRIEVAL_REWRITE_MODEL", "gpt-4o-mini")
+RETRIEVAL_REWRITE_GRACE_SECONDS = float(os.getenv("RETRIEVAL_REWRITE_GRACE_SECONDS", "0.3"))
+
+# Cheap model used by the rewrite and race strategies
+rewrite_llm = PooledChatOpenAI(
+    pool=key_pool,
+    model_name=RETRIEVAL_REWRITE_MODEL,
+    temperature=0,
+    max_tokens=100,
+    latency=LatencyTracker(),
+    role="rewrite",
+    stage="condense",
+)
+
+retrieval_query_stats = defaultdict(int)
+
+# Follow-up question suggestions
+SUGGESTIONS_ENABLED = env_flag("SUGGESTIONS_ENABLED", True)
+SUGGESTIONS_MODEL = os.getenv("SUGGESTIONS_MODEL", "gpt-4o-mini")
+SUGGESTIONS_TTL_SECONDS = float(os.getenv("SUGGESTIONS_TTL_SECONDS", "300"))
+SUGGESTIONS_MAX_ENTRIES = int(os.getenv("SUGGESTIONS_MAX_ENTRIES", "10000"))
+SUGGESTIONS_INLINE_WAIT_SECONDS = float(os.getenv("SUGGESTIONS_INLINE_WAIT_SECONDS", "0"))
+SUGGESTIONS_TIMEOUT_SECONDS = float(os.getenv("SUGGESTIONS_TIMEOUT_SECONDS", "10"))
+SUGGESTIONS_SYSTEM_PROMPT = "You are NeuroBrain's Question Suggestion AI, and your goal is to guide users through helpful conversations by predicting relevant follow-up questions. Based on the user's original question you will generate only two or three follow-up short questions. The follow-up questions should: 1. Be relevant to both the user's original question and your answer. 2. Encourage deeper engagement or exploration of the topic. 3. Help guide the user toward meaningful next steps or further clarification. For example: First Interaction: - If the user asks, 'Hello! ' And Response from AI:  Hello Hello! NeuroBrain's AI-powered solutions are designed to automate and enhance your customer support experience. Whether you're looking to provide 24/7 support, reduce response times, or free up your human agents for more complex tasks, our Chatbots and Voice Assistants can help. They are customizable to fit your specific business needs and can integrate seamlessly with various platforms, including social media. How can I assist you further in exploring these solutions for your business? Your follow-up questions could be: 1. 'Does NeuroBrain support voice and chat? ' 2. ' My Business benefits ' 3. ' Pricing? ' Second Follow-up Interaction: User's Select: “Does NeuroBrain support voice and chat?” AI: Does Neur oBrain support voice and chat? Yes, NeuroBrain offers support for both voice and chat interactions. Our AI Chatbots and Voice Assistants are designed to cater to various user preferences, providing a seamless and versatile customer support experience. This allows businesses to engage with their customers across multiple channels effectively. Would you like to learn more about how these features can benefit your business?. Based on the conversation between the user and AI, generate 1-3 follow-up questions. the follow-up question in 3 to 5 words without emoji and special characters. Return only the questions separated by commas."
+
+suggestion_llm = PooledChatOpenAI(
+    pool=key_pool,
+    model_name=SUGGESTIONS_MODEL,
+    temperature=0.3,
+    max_tokens=60,
+    latency=LatencyTracker(),
+    role="suggestions",
+)
+
+
+async def generate_suggestions(user_message, ai_response):
+    """Generate follow-up questions for one exchange, as a comma-separated string."""
+    messages = [
+        SystemMessage(content=SUGGESTIONS_SYSTEM_PROMPT),
+        HumanMessage(content=f"User: {user_message}\nAI: {ai_response}"),
+    ]
+    response = await suggestion_llm.ainvoke(messages)
+    return response.content.strip()
+
+
+class SuggestionCache:
+    """
+    Follow-up questions generated in the background as soon as an answer is
+    final, kept for ``ttl`` seconds per (user_id, domain, turn). Turns are
+    numbered per session, so one user's conversations in two domains share
+    turn numbers.
+
+    Entries can also be found by the exchange's text, which is all that
+    older clients send to /generate_questions.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._by_content = {}
+        self.started = 0
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    @staticmethod
+    def content_key(user_message, ai_response):
+        return hashlib.sha256(f"{user_message}\0{ai_response}".encode("utf-8")).hexdigest()
+
+    def _expire(self, now):
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and now - entry["created_at"] <= self.ttl:
+                break
+            self._entries.popitem(last=False)
+            for content_key in entry["content_keys"]:
+                self._by_content.pop(content_key, None)
+
+    def _on_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.failures += 1
+            logger.error(f"Error generating follow-up questions: {str(task.exception())}")
+
+    def start(self, user_id, domain, turn, user_message, ai_response):
+        """Start generating questions for a turn."""
+        now = time.time()
+        self._expire(now)
+        task = asyncio.ensure_future(generate_suggestions(user_message, ai_response))
+        task.add_done_callback(self._on_done)
+        self._entries[(user_id, domain, turn)] = {"task": task, "created_at": now, "content_keys": []}
+        self.add_alias(user_id, domain, turn, user_message, ai_response)
+        self.started += 1
+
+    def discard(self, user_id, domain, turn):
+        """Drop a turn's entry, cancelling its generation, when the turn was not saved."""
+        entry = self._entries.pop((user_id, domain, turn), None)
+        if entry is not None:
+            entry["task"].cancel()
+            for content_key in entry["content_keys"]:
+                self._by_content.pop(content_key, None)
+
+    def add_alias(self, user_id, domain, turn, user_message, ai_response):
+        """Also find the turn's entry by this exchange text."""
+        entry = self._entries.get((user_id, domain, turn))
+        if entry is not None:
+            content_key = self.content_key(user_message, ai_response)
+            entry["content_keys"].append(content_key)
+            self._by_content[content_key] = (user_id, domain, turn)
+
+    def _find(self, user_id, domain, turn, user_message, ai_response):
+        key = (user_id, domain, turn)
+        if key not in self._entries and user_message is not None and ai_response is not None:
+            key = self._by_content.get(self.content_key(user_message, ai_response))
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry["created_at"] > self.ttl:
+            return None
+        return entry["task"]
+
+    async def get(self, user_id=None, domain=None, turn=None, user_message=None, ai_response=None, timeout=None):
+        """
+        Questions for a turn, waiting up to ``timeout`` seconds if they are
+        still being generated.
+
+        Returns:
+            str or None: None when nothing was started or generation failed.
+        """
+        task = self._find(user_id, domain, turn, user_message, ai_response)
+        if task is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if not task.done() and not timeout:
+            return None
+        try:
+            # Shielded so a disconnecting caller does not cancel it for others
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except Exception:
+            return None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": SUGGESTIONS_ENABLED,
+            "entries": len(self._entries),
+            "started": self.started,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "failures": self.failures,
+        }
+
+suggestion_cache = SuggestionCache(SUGGESTIONS_TTL_SECONDS, SUGGESTIONS_MAX_ENTRIES)
+
+# Conversation compaction settings
+CHAT_HISTORY_MODE = os.getenv("CHAT_HISTORY_MODE", "window")
+CHAT_SUMMARY_MODEL = os.getenv("CHAT_SUMMARY_MODEL", "gpt-4o-mini")
+CHAT_SUMMARY_TRIGGER_TURNS = int(os.getenv("CHAT_SUMMARY_TRIGGER_TURNS", "12"))
+CHAT_SUMMARY_RECENT_TURNS = int(os.getenv("CHAT_SUMMARY_RECENT_TURNS", "4"))
+CHAT_SUMMARY_MAX_FOLD_TURNS = int(os.getenv("CHAT_SUMMARY_MAX_FOLD_TURNS", "40"))
+CHAT_SUMMARY_PROMPT = (
+    "You keep a running summary of a conversation between a user and a beauty and skincare "
+    "shopping assistant. Merge the new turns into the current summary. Keep what later answers "
+    "depend on: the user's skin type, concerns and conditions, allergies, preferences and budget, "
+    "the products recommended and how the user reacted to them, and anything still unresolved. "
+    "Write at most 150 words in the user's language and return only the summary."
+)
+
+summary_llm = PooledChatOpenAI(
+    pool=key_pool,
+    model_name=CHAT_SUMMARY_MODEL,
+    temperature=0,
+    max_tokens=300,
+    latency=LatencyTracker(),
+    role="summary",
+)
+
+
+async def summarize_turns(summary, turns):
+    """Fold (query, response) ``turns`` into the running ``summary``."""
+    messages = [
+        SystemMessage(content=CHAT_SUMMARY_PROMPT),
+        HumanMessage(content=f"Current summary:\n{summary or '(none)'}\n\nNew turns:{prompt_budget.format_turns(turns)}"),
+    ]
+    response = await summary_llm.ainvoke(messages)
+    return response.content.strip()
+
+
+class HistoryCompactor:
+    """
+    Folds the older turns of a conversation into a running summary, off the
+    request path.
+
+    Once a session holds more than ``trigger_turns`` turns, a background task
+    summarizes all but the newest ``recent_turns`` of the turns stored after
+    the current summary, together with that summary. At most
+    ``max_fold_turns`` are folded per run; anything older is left out, as
+    the 20-turn window always did. The summary is stored through the session
+    backend and swapped into the session between turns, so sessions load,
+    and prompts carry, one summary plus a few recent turns however long the
+    conversation gets.
+    """
+
+    def __init__(self, enabled, trigger_turns, recent_turns, max_fold_turns):
+        self.enabled = enabled
+        self.trigger_turns = trigger_turns
+        self.recent_turns = recent_turns
+        self.max_fold_turns = max_fold_turns
+        self._running = {}
+        self.runs = 0
+        self.folded_turns = 0
+        self.conflicts = 0
+        self.failures = 0
+
+    def maybe_start(self, session):
+        key = (session.user_id, session.domain)
+        if not self.enabled or len(session.chat_history) <= self.trigger_turns or key in self._running:
+            return
+        task = asyncio.ensure_future(self._compact(session))
+        self._running[key] = task
+        task.add_done_callback(lambda _: self._running.pop(key, None))
+
+    async def _compact(self, session):
+        user_id, domain, previous = session.user_id, session.domain, session.summary_position
+        try:
+            rows = await asyncio.to_thread(
+                session_backend.turns_after, user_id, domain, previous,
+                self.max_fold_turns + self.recent_turns,
+            )
+            fold = rows[:len(rows) - self.recent_turns]
+            if not fold:
+                return
+            turns = [(query, response) for _, query, response in fold]
+            summary = await summarize_turns(session.summary, turns)
+            position = fold[-1][0]
+            stored = await asyncio.to_thread(
+                session_backend.save_summary, user_id, domain, summary, position, previous
+            )
+            async with session_locks.hold((user_id, domain)):
+                if stored:
+                    session.apply_summary(summary, position, turns)
+                else:
+                    # Another worker summarized first; reload from its summary
+                    self.conflicts += 1
+                    sessions.discard(user_id, domain)
+                    return
+            self.runs += 1
+            self.folded_turns += len(turns)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Error summarizing chat history for user {user_id}: {str(e)}")
+
+    def stats(self):
+        return {
+            "mode": CHAT_HISTORY_MODE,
+            "running": len(self._running),
+            "runs": self.runs,
+            "folded_turns": self.folded_turns,
+            "conflicts": self.conflicts,
+            "failures": self.failures,
+        }
+
+history_compactor = HistoryCompactor(
+    CHAT_HISTORY_MODE == "summary",
+    CHAT_SUMMARY_TRIGGER_TURNS,
+    CHAT_SUMMARY_RECENT_TURNS,
+    CHAT_SUMMARY_MAX_FOLD_TURNS,
+)
+
+# Semantic response cache settings
+SEMANTIC_CACHE_ENABLED = env_flag("SEMANTIC_CACHE_ENABLED", False)
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "86400"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "2000"))
+SEMANTIC_CACHE_MAX_HISTORY = int(os.getenv("SEMANTIC_CACHE_MAX_HISTORY", "0"))
+
+class SemanticCache:
+    """
+    Per-domain cache of answers to near-duplicate questions.
+
+    Questions are embedded with the shared ``embedding`` and compared by
+    cosine similarity against earlier answers in the same domain. It only
+    applies to text-only turns whose session has at most ``max_history``
+    previous turns, since later answers depend on the conversation. Every
+    entry is dropped when the Chroma collection on disk changes.
+    """
+
+    def __init__(self, enabled, threshold, ttl, max_entries, max_history, corpus):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_history = max_history
+        self.corpus = corpus
+        self._domains = {}
+        self._corpus_version = corpus.version()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.saved_seconds = 0.0
+
+    def _check_corpus(self):
+        version = self.corpus.version()
+        if version != self._corpus_version:
+            self._corpus_version = version
+            self._domains.clear()
+            self.invalidations += 1
+            logger.info("Vector store changed, cleared the semantic cache")
+
+    def applies(self, session, image_caption):
+        return (
+            self.enabled
+            and not image_caption
+            and not session.summary
+            and len(session.chat_history) <= self.max_history
+        )
+
+    def _expire(self, domain, now):
+        entries = self._domains.get(domain)
+        if not entries:
+            return []
+        fresh = [entry for entry in entries if now - entry["created_at"] <= self.ttl]
+        if len(fresh) != len(entries):
+            self._domains[domain] = fresh
+        return fresh
+
+    async def lookup(self, domain, question):
+        """
+        Find a cached answer for a question in this domain.
+
+        Returns:
+            tuple: (entry or None, normalized question vector for ``store``).
+        """
+        self._check_corpus()
+        vector = np.asarray(await embedding.aembed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector = vector / norm
+
+        entries = self._expire(domain, time.time())
+        if entries:
+            matrix = np.stack([entry["vector"] for entry in entries])
+            scores = matrix @ vector
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                self.hits += 1
+                entry = entries[best]
+                self.saved_seconds += entry["latency"]
+                return entry, vector
+        self.misses += 1
+        return None, vector
+
+    def store(self, domain, vector, answer, formatted_response, latency):
+        now = time.time()
+        entries = self._expire(domain, now)
+        entries.append({
+            "vector": vector,
+            "answer": answer,
+            "text": formatted_response["text"],
+            "products": formatted_response.get("products", []),
+            "latency": latency,
+            "created_at": now,
+        })
+        self._domains[domain] = entries[-self.max_entries:]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": sum(len(entries) for entries in self._domains.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
+
+semantic_cache = SemanticCache(
+    SEMANTIC_CACHE_ENABLED,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_TTL_SECONDS,
+    SEMANTIC_CACHE_MAX_ENTRIES,
+    SEMANTIC_CACHE_MAX_HISTORY,
+    corpus,
+)
+
+# Define the conversation prompt template
+template = """Hello AI Dermatologist! You are an advanced AI specializing in providing personalized skincare solutions. You will analyze user-provided photos and text inputs to identify skin conditions, recommend natural skincare routines, suggest personalized treatment plans, and recommend suitable products. Your responses should be informative, empathetic, and prioritize user safety.
+Here's a detailed guide for your interactions:
+You name: Klyra AI. 
+Image Analysis:
+Request Clear Images: Begin by requesting clear, well-lit photos of the affected skin areas. Specify that photos should be taken without makeup or filters. Example: "Please upload a clear, well-lit photo of the affected area without makeup or filters. This will help me assess your skin condition accurately."
+Analyze Visual Cues: Analyze uploaded photos for visual cues like inflammation, redness, pigmentation, scaling, rashes, texture, and pore size.
+Determine Skin Type: Infer skin type (oily, dry, combination, sensitive) based on visual cues and user-provided information.
+Text Input Interpretation:
+Gather Detailed Information: Ask clarifying questions to understand the user's skin concerns, symptoms, current routine, lifestyle, diet, allergies, medical history, medications, and any potential triggers (e.g., stress, specific foods, environmental factors). Example: "Could you describe your current skincare routine? Do you have any known allergies? Are you currently taking any medications?"
+Symptom Analysis: Analyze user-described symptoms to identify potential skin conditions like acne, eczema, rosacea, psoriasis, melasma, contact dermatitis, etc.
+Personalized Routine & Treatment Plan Generation:
+Natural Skincare Routine: Recommend natural skincare routines including gentle cleansers, natural moisturizers, and DIY remedies (e.g., oatmeal baths, aloe vera, tea tree oil) where appropriate. Provide specific instructions and precautions.
+Preventive Measures: Suggest preventive measures like sun protection (SPF), avoiding triggers, managing stress, and maintaining a healthy diet.
+Daily Routine Structure: Prescribe a detailed daily routine, including cleansing, toning, treating, moisturizing, and protecting.
+Medical Treatment Suggestions (Over-the-Counter): Recommend over-the-counter creams, lotions, and medications (e.g., hydrocortisone cream, retinoids, benzoyl peroxide) where appropriate. Clearly state that these are suggestions and not prescriptions.
+Medical Treatment Suggestions (Prescription): For conditions potentially requiring prescription medication (e.g., topical antibiotics, steroid creams), clearly advise the user to consult a dermatologist or qualified healthcare professional. Provide information about potential treatment options but refrain from prescribing.
+Product Recommendations: Suggest specific products based on the identified skin condition and user preferences. Consider skin type, allergies, and potential sensitivities. Differentiate between natural remedies, over-the-counter products, and prescription medications. Always recommend consulting a doctor before starting any new medication.
+Complex Condition Support:
+Recognize Complexities: Acknowledge the complexities of overlapping or atypical skin conditions. Example: "Your symptoms suggest a combination of rosacea and acne. It's important to see a dermatologist for a proper diagnosis."
+Referral to Specialists: For complex conditions or those requiring specialized care (e.g., psoriatic arthritis, severe allergies), strongly recommend consulting a relevant specialist. Offer interim advice for managing symptoms while awaiting professional consultation.
+Interactive Dialogue & Follow-Up:
+Clarifying Questions: Ask follow-up questions to refine recommendations and ensure accuracy.
+Progress Tracking: Encourage users to provide updates and upload follow-up photos to monitor progress and adjust recommendations as needed.
+Educational Insights:
+Provide Educational Content: Offer concise explanations of potential skin conditions, including causes, triggers, and long-term management strategies.
+Prevention Tips: Provide general skincare tips for maintaining healthy skin.
+Ethical and Safe Recommendations:
+Prioritize Safety: Always prioritize user safety. Clearly state when a condition requires professional medical evaluation. Emphasize that your advice is not a substitute for professional medical care. Example: "While these suggestions may help, it's crucial to consult a dermatologist for a proper diagnosis and personalized treatment plan."
+
+Product recommendation: 
+After prescribing, suggest the products the patient needs to improve or recover his condition in this way, 
+Suggested Ingredients.
+
+Product XML Response: After the answer, list the recommended products in a products XML block.
+Give each product's Id and exact name, as written in the information provided, and nothing else. The product details, image and link are added automatically, so do not write prices, image URLs or links yourself.
+
+Example:
+
+Answer: Dealing with acne can be frustrating! Before we look at products, here are a few things you can try:
+
+Gentle Cleansing: Wash your face twice daily with a mild, fragrance-free cleanser. Avoid harsh scrubbing. Spot Treatment with Tea Tree Oil: Dilute tea tree oil with a carrier oil (like jojoba or grapeseed oil) and apply it to blemishes. Always do a patch test first. Hydration: Drink plenty of water and eat antioxidant-rich foods like berries and leafy greens.
+
+Now, here are some products that might be helpful:
+
+Response in XML format:
+
+<products>
+    <product><id>products.csv#12</id><name>COSRX Salicylic Acid Daily Gentle Cleanser 150ml</name></product>
+    <product><id>products.csv#48</id><name>CeraVe PM Facial Moisturizing Lotion 60ml</name></product>
+</products>
+
+If a customer directly asks for product recommendations, quickly suggest the product.
+
+**Only recommend products that appear in the information provided.
+*** Answer always in user's language.
+
+By following these guidelines, you will provide valuable and safe skincare guidance to users, while promoting responsible self-care and encouraging professional consultation when necessary."""
+
+# Everything that varies per request comes after the instructions above, so
+# the system message stays byte-identical across users and turns and the
+# provider can serve it from its prompt prefix cache.
+human_template = """Use only the chat history and the following information
+{context}
+
+Current conversation:
+{chat_history}
+
+Human: {question}
+AI Assistant:"""
+
+
+CONVERSATIONAL_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessagePromptTemplate.from_template(template),
+    HumanMessagePromptTemplate.from_template(human_template),
+])
+
+# Token budget for the assembled answer prompt
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "8000"))
+PROMPT_HISTORY_TOKENS = int(os.getenv("PROMPT_HISTORY_TOKENS", "3000"))
+PROMPT_MIN_DOC_TOKENS = int(os.getenv("PROMPT_MIN_DOC_TOKENS", "200"))
+
+
+class PromptBudget:
+    """
+    Keeps the answer prompt under a token budget.
+
+    History is filled newest turn first up to ``history_tokens`` and product
+    XML in past answers is collapsed to the product names. Retrieved
+    documents then take what is left, in rank order; the last one that does
+    not fit is truncated if at least ``min_doc_tokens`` remain.
+    """
+
+    PRODUCTS_RE = re.compile(r'<products>[\s\S]*?</products>')
+    PRODUCT_RE = re.compile(r'<product>([\s\S]*?)</product>')
+    NAME_RE = re.compile(r'<name>([\s\S]*?)</name>')
+
+    def __init__(self, total_tokens, history_tokens, min_doc_tokens):
+        self.total_tokens = total_tokens
+        self.history_tokens = history_tokens
+        self.min_doc_tokens = min_doc_tokens
+        self._static_tokens = None
+
+    @property
+    def static_tokens(self):
+        if self._static_tokens is None:
+            self._static_tokens = count_tokens(template) + count_tokens(
+                human_template.format(context="", chat_history="", question="")
+            )
+        return self._static_tokens
+
+    def _compact_answer(self, text):
+        def collapse(match):
+            names = []
+            for product in self.PRODUCT_RE.findall(match.group(0)):
+                name = self.NAME_RE.search(product)
+                names.append((name.group(1) if name else re.sub(r"<[^>]+>", "", product)).strip())
+            return f"[Recommended products: {'; '.join(names)}]" if names else ""
+        return self.PRODUCTS_RE.sub(collapse, text).strip()
+
+    def _turns(self, chat_history):
+        turn = []
+        for item in chat_history:
+            if isinstance(item, tuple):
+                yield [f"Human: {item[0]}", f"Assistant: {self._compact_answer(item[1])}"]
+            elif item.type == "system":
+                continue
+            elif item.content:
+                if item.type == "ai":
+                    turn.append(f"Assistant: {self._compact_answer(item.content)}")
+                    yield turn
+                    turn = []
+                else:
+                    turn.append(f"Human: {item.content}")
+        if turn:
+            yield turn
+
+    def format_turns(self, chat_history):
+        """Render every turn, with no budget."""
+        return "".join("\n" + "\n".join(turn) for turn in self._turns(chat_history))
+
+    def format_history(self, chat_history):
+        """
+        Render chat history for the prompt, dropping the oldest turns first.
+        A conversation summary (a leading system message) is always kept.
+        """
+        summaries = [
+            item.content for item in chat_history
+            if not isinstance(item, tuple) and item.type == "system"
+        ]
+        head = f"\nSummary of the earlier conversation: {summaries[-1]}" if summaries else ""
+        kept, used = [], count_tokens(head) if head else 0
+        for turn in reversed(list(self._turns(chat_history))):
+            text = "\n" + "\n".join(turn)
+            tokens = count_tokens(text)
+            if used + tokens > self.history_tokens:
+                break
+            kept.append(text)
+            used += tokens
+        return head + "".join(reversed(kept))
+
+    def fit_documents(self, docs, question, history):
+        """
+        Return the highest ranked documents that fit the remaining budget.
+        ``history`` is the text ``format_history`` rendered for this prompt.
+        """
+        history_tokens = count_tokens(history)
+        question_tokens = count_tokens(question)
+        remaining = self.total_tokens - self.static_tokens - history_tokens - question_tokens
+        fitted, context_tokens = [], 0
+        for doc in docs:
+            # Documents are joined with a blank line in the stuffed context
+            tokens = count_tokens(doc.page_content) + 1
+            if tokens <= remaining:
+                fitted.append(doc)
+            elif remaining >= self.min_doc_tokens:
+                # Trim proportionally, then re-check against the real count
+                content = doc.page_content[: len(doc.page_content) * remaining // tokens]
+                while content and count_tokens(content) + 1 > remaining:
+                    content = content[: len(content) * 9 // 10]
+                tokens = count_tokens(content) + 1
+                fitted.append(Document(page_content=content, metadata=doc.metadata))
+            else:
+                break
+            remaining -= tokens
+            context_tokens += tokens
+            if remaining < self.min_doc_tokens:
+                break
+        total = self.static_tokens + history_tokens + context_tokens + question_tokens
+        logger.info(
+            f"Prompt tokens: static={self.static_tokens} history={history_tokens} "
+            f"context={context_tokens} ({len(fitted)}/{len(docs)} docs) "
+            f"question={question_tokens} total={total}"
+        )
+        return fitted
+
+
+prompt_budget = PromptBudget(PROMPT_TOKEN_BUDGET, PROMPT_HISTORY_TOKENS, PROMPT_MIN_DOC_TOKENS)
+
+class GlobalMetrics:
+    """Request counters, aggregated across workers by the session backend."""
+
+    COUNTERS = (
+        "lifetime_requests", "successful_requests", "failed_requests",
+        "deduplicated_requests", "saved_llm_calls", "serialized_turns",
+        "batch_items", "failed_batch_items",
+    )
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.start_time = datetime.now()
+        # This worker's share, for /metrics (Prometheus sums across workers)
+        self.local = dict.fromkeys(self.COUNTERS, 0)
+
+    def incr(self, name, amount=1):
+        self.local[name] += amount
+        self.backend.incr(name, amount)
+
+    def to_dict(self):
+        counters = self.backend.counters()
+        return {
+            **{name: counters.get(name, 0) for name in self.COUNTERS},
+            "uptime": str(datetime.now() - self.start_time),
+            "active_users_24h": self.backend.active_users(24 * 3600)
+        }
+
+# Initialize global metrics
+global_metrics = GlobalMetrics(session_backend)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets, cumulative like Prometheus'.
+
+    Recording is a bisect and three increments, cheap enough for every
+    request stage.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the ``q`` quantile."""
+        if not self.count:
+            return None
+        target, seen = q * self.count, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "mean": round(self.sum / self.count, 4) if self.count else None,
+            "p50_le": self.quantile(0.5),
+            "p95_le": self.quantile(0.95),
+            "p99_le": self.quantile(0.99),
+        }
+
+    def prometheus(self, name, labels):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            lines.append(f"{name}_bucket{prometheus_labels({**labels, 'le': le})} {cumulative}")
+        lines.append(f"{name}_sum{prometheus_labels(labels)} {self.sum:.6f}")
+        lines.append(f"{name}_count{prometheus_labels(labels)} {self.count}")
+        return lines
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class LatencyMetrics:
+    """
+    Histograms per metric family and label set, created on first use.
+
+    ``klyra_stage_seconds`` is labelled by request stage (admission_wait,
+    session_load, caption, condense, retrieval, xml_parse, db_write) and
+    ``klyra_llm_seconds`` by model role and phase (ttft or total).
+    """
+
+    FAMILIES = {
+        "klyra_stage_seconds": "Time spent in each stage of a chat request.",
+        "klyra_llm_seconds": "LLM call latency: time to first token and total.",
+    }
+
+    def __init__(self):
+        self._histograms = {}
+
+    def histogram(self, family, **labels):
+        key = (family, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe_stage(self, stage, seconds):
+        self.histogram("klyra_stage_seconds", stage=stage).observe(seconds)
+
+    @contextmanager
+    def time_stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - started)
+
+    def stats(self):
+        return {
+            " ".join(value for _, value in labels): histogram.stats()
+            for (family, labels), histogram in sorted(self._histograms.items())
+        }
+
+    def prometheus(self):
+        lines = []
+        for family, help_text in self.FAMILIES.items():
+            lines += [f"# HELP {family} {help_text}", f"# TYPE {family} histogram"]
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name == family:
+                    lines += histogram.prometheus(family, dict(labels))
+        return lines
+
+latency_metrics = LatencyMetrics()
+
+
+class SlidingDistinctCounter:
+    """
+    Approximate number of distinct users seen in a sliding window.
+
+    The window is split into ``buckets`` intervals with one HyperLogLog
+    sketch of ``2 ** precision`` one-byte registers each. Memory stays at
+    ``buckets * 2 ** precision`` bytes however many users there are (24 KB
+    for a day in hourly buckets, about 3% standard error). Expired
+    intervals are reset when their slot is reused.
+    """
+
+    def __init__(self, window_seconds, buckets=24, precision=10):
+        self.interval = window_seconds / buckets
+        self.buckets = buckets
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = np.zeros((buckets, self.size), dtype=np.uint8)
+        self.epochs = np.full(buckets, -1, dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def _slot(self, now):
+        epoch = int(now // self.interval)
+        slot = epoch % self.buckets
+        if self.epochs[slot] != epoch:
+            self.registers[slot] = 0
+            self.epochs[slot] = epoch
+        return slot
+
+    def add(self, item, now=None):
+        digest = int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "big")
+        index = digest >> (64 - self.precision)
+        rest_bits = 64 - self.precision
+        rank = rest_bits - (digest & ((1 << rest_bits) - 1)).bit_length() + 1
+        with self._lock:
+            slot = self._slot(time.time() if now is None else now)
+            if self.registers[slot, index] < rank:
+                self.registers[slot, index] = rank
+
+    def estimate(self, window_seconds=None, now=None):
+        """Distinct items in the last ``window_seconds`` (rounded up to whole intervals)."""
+        now = time.time() if now is None else now
+        intervals = self.buckets if window_seconds is None else min(
+            self.buckets, max(1, int(np.ceil(window_seconds / self.interval)))
+        )
+        current = int(now // self.interval)
+        with self._lock:
+            live = (self.epochs > current - intervals) & (self.epochs <= current)
+            if not live.any():
+                return 0
+            merged = self.registers[live].max(axis=0)
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / float(np.sum(np.exp2(-merged.astype(np.float64))))
+        zeros = int(np.count_nonzero(merged == 0))
+        if raw <= 2.5 * m and zeros:
+            # Small-range correction (linear counting)
+            raw = m * np.log(m / zeros)
+        return int(round(raw))
+
+active_users = SlidingDistinctCounter(24 * 3600)
+
+
+def record_request_start(user_id):
+    global_metrics.incr("lifetime_requests")
+    active_users.add(user_id)
+
+
+def record_request_failure(user_id, start_time, error):
+    global_metrics.incr("failed_requests")
+    if isinstance(error, HTTPException):
+        error = f"HTTP {error.status_code}: {error.detail}"
+    session_backend.record_request(user_id, time.time() - start_time, False, str(error))
+
+
+async def _product_from_element(product, domain):
+    """Resolve a <product> element to the catalogue record returned to the client."""
+    return await product_catalog.aresolve(domain, [
+        product.findtext("id"), product.findtext("name"), product.text,
+    ])
+
+
+async def _resolve_products(elements, domain):
+    """Catalogue records for ``elements``, skipping unknown and repeated products."""
+    products, seen = [], set()
+    for element in elements:
+        product = await _product_from_element(element, domain)
+        if product is not None and product["id"] not in seen:
+            seen.add(product["id"])
+            products.append(product)
+    return products
+
+
+async def format_response(response_text, domain):
+    """
+    Split an AI answer into display text and the products from its XML block.
+
+    Args:
+        response_text (str): Raw answer produced by the conversation chain.
+        domain (str): Domain whose catalogue the products are resolved from.
+
+    Returns:
+        dict: {"text": str, "products": list} as sent to the client and saved.
+    """
+    with latency_metrics.time_stage("xml_parse"):
+        return await _format_response(response_text, domain)
+
+
+async def _format_response(response_text, domain):
+    try:
+        # Attempt to find XML in the response
+        xml_match = re.findall(r'<products>[\s\S]*?</products>', response_text, re.DOTALL)
+        if xml_match:
+            # Extract the XML portion
+            xml_string = xml_match[0].replace("&", "&amp;") # Escape the & character
+            root = ET.fromstring(xml_string)
+
+            # Parse the XML into a products list
+            products = await _resolve_products(root.findall('product'), domain)
+
+            # Remove the XML portion from the response text
+            remaining_text = re.sub(r'<products>[\s\S]*?</products>', '', response_text).strip()
+
+            return {
+                "text": remaining_text,
+                "products": products
+            }
+
+        # If no XML is found, treat the whole response as text
+        return {
+            "text": response_text,
+            "products": []
+        }
+    except ET.ParseError as e:
+        logger.warning(f"XML parsing error: {e}")
+        # Handle XML parsing errors and default to treating the response as text
+        return {
+            "text": response_text,
+            "products": []
+        }
+
+
+class ProductStreamParser:
+    """
+    Incrementally separates streamed answer text from its <products> XML.
+
+    Text outside a <products> block is released as soon as it can no longer
+    be the start of a tag, so raw XML never reaches the client. The first
+    block is fed to an ``XMLPullParser`` and each <product> is resolved
+    against the catalogue and emitted once its closing tag arrives; any later blocks are suppressed, matching what
+    ``format_response`` keeps.
+    """
+
+    OPEN_TAG = "<products>"
+    CLOSE_TAG = "</products>"
+
+    def __init__(self, domain):
+        self.domain = domain
+        self._seen = set()
+        self._buffer = ""
+        self._in_block = False
+        self._blocks_seen = 0
+        self._xml_parser = None
+        self._text = []
+
+    @property
+    def text(self):
+        """Answer text released so far."""
+        return "".join(self._text)
+
+    @property
+    def text_complete(self):
+        """Whether the answer text before the products block is final."""
+        return self._blocks_seen > 0
+
+    @staticmethod
+    def _partial_tag_index(text, tag):
+        """Return where a trailing prefix of ``tag`` starts in ``text``, or len(text)."""
+        index = text.rfind("<")
+        if index != -1 and tag.startswith(text[index:]):
+            return index
+        return len(text)
+
+    async def _feed_xml(self, data):
+        events = []
+        if self._xml_parser is None:
+            return events
+        try:
+            self._xml_parser.feed(data.replace("&", "&amp;"))
+            for _, element in self._xml_parser.read_events():
+                if element.tag != "product":
+                    continue
+                product = await _product_from_element(element, self.domain)
+                if product is not None and product["id"] not in self._seen:
+                    self._seen.add(product["id"])
+                    events.append(("product", product))
+                element.clear()
+        except ET.ParseError as e:
+            logger.warning(f"XML parsing error while streaming: {e}")
+            self._xml_parser = None
+        return events
+
+    async def feed(self, chunk):
+        """
+        Consume a chunk of streamed text.
+
+        Returns:
+            list: (event, payload) tuples, where event is "token" with a text
+            payload or "product" with a product dict.
+        """
+        self._buffer += chunk
+        events = []
+        while self._buffer:
+            if not self._in_block:
+                start = self._buffer.find(self.OPEN_TAG)
+                if start == -1:
+                    safe = self._partial_tag_index(self._buffer, self.OPEN_TAG)
+                    if safe:
+                        events.append(("token", self._buffer[:safe]))
+                    self._buffer = self._buffer[safe:]
+                    break
+                if start:
+                    events.append(("token", self._buffer[:start]))
+                self._buffer = self._buffer[start + len(self.OPEN_TAG):]
+                self._in_block = True
+                self._blocks_seen += 1
+                if self._blocks_seen == 1:
+                    self._xml_parser = ET.XMLPullParser(events=("end",))
+                    events.extend(await self._feed_xml(self.OPEN_TAG))
+            else:
+                end = self._buffer.find(self.CLOSE_TAG)
+                if end == -1:
+                    safe = self._partial_tag_index(self._buffer, self.CLOSE_TAG)
+                    events.extend(await self._feed_xml(self._buffer[:safe]))
+                    self._buffer = self._buffer[safe:]
+                    break
+                events.extend(await self._feed_xml(self._buffer[:end] + self.CLOSE_TAG))
+                self._xml_parser = None
+                self._buffer = self._buffer[end + len(self.CLOSE_TAG):]
+                self._in_block = False
+        self._text.extend(data for event, data in events if event == "token")
+        return events
+
+    def close(self):
+        """Flush any held-back text once the stream has ended."""
+        events = []
+        if not self._in_block and self._buffer:
+            events.append(("token", self._buffer))
+        self._buffer = ""
+        return events
+
+
+class TokenQueueCallbackHandler(AsyncCallbackHandler):
+    """Collects tokens from the streaming answer model into an asyncio queue."""
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if token:
+            self.queue.put_nowait(token)
+
+
+def get_session(user_id, domain):
+    """Return the session for this user and domain, creating it on first use."""
+    with latency_metrics.time_stage("session_load"):
+        return sessions.get(user_id, domain)
+
+
+@asynccontextmanager
+async def session_turn(session):
+    """
+    Hold the session's lock for one turn. ``asyncio.Lock`` wakes waiters in
+    arrival order, so concurrent turns for a session apply one after another
+    instead of racing on its memory and history.
+    """
+    key = (session.user_id, session.domain)
+    if session_locks.locked(key):
+        global_metrics.incr("serialized_turns")
+    async with session_locks.hold(key):
+        yield
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls. While a call for a key is in flight,
+    later calls with the same key wait for its result (or exception) instead
+    of running it again. The call runs as its own task, so a caller that goes
+    away does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._flights = {}
+
+    async def run(self, key, factory):
+        """
+        Returns:
+            tuple: (result, shared), where ``shared`` is True when the result
+            came from a call another caller started.
+        """
+        task = self._flights.get(key)
+        shared = task is not None
+        if not shared:
+            task = asyncio.ensure_future(factory())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(task), shared
+
+    def _finish(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            # Retrieve it so a call nobody waited for is not logged as unhandled
+            task.exception()
+
+    def stats(self):
+        return {"in_flight": len(self._flights)}
+
+
+chat_flights = SingleFlight()
+
+
+# Admission control for the LLM-bound endpoints
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "64"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "128"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "10"))
+ADMISSION_RETRY_AFTER_SECONDS = float(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "2"))
+
+# Lower runs first
+PRIORITY_CONVERSATION = 0
+PRIORITY_NEW_SESSION = 1
+PRIORITY_SUGGESTIONS = 2
+PRIORITY_BATCH = 3
+PRIORITY_NAMES = {
+    PRIORITY_CONVERSATION: "conversation",
+    PRIORITY_NEW_SESSION: "new_session",
+    PRIORITY_SUGGESTIONS: "suggestions",
+    PRIORITY_BATCH: "batch",
+}
+
+
+class Overloaded(HTTPException):
+    """503 for a request the admission controller turned away."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(
+            status_code=503,
+            detail={"error": f"Server overloaded: {reason}", "response": "Sorry, we're busy right now. Please try again in a moment."},
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+
+class Admission:
+    """A held slot; ``release()`` may be called more than once."""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release()
+
+
+class AdmissionController:
+    """
+    Caps concurrent LLM-bound requests at ``max_concurrent``.
+
+    Requests over the cap wait in a priority queue of at most ``max_queue``
+    entries, each until its own deadline. A full queue rejects the newcomer
+    straight away, unless it outranks the lowest priority waiter, which is
+    shed instead. Rejected requests get a 503 with Retry-After, so overload
+    turns into fast refusals rather than every request timing out together.
+    A freed slot goes to the best waiter directly.
+    """
+
+    def __init__(self, max_concurrent, max_queue, queue_timeout, retry_after):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self._queue = []
+        self._sequence = itertools.count()
+        self.admitted = 0
+        self.queued = 0
+        self.wait_seconds = 0.0
+        self.rejected = defaultdict(int)
+
+    def _reject(self, reason, priority):
+        self.rejected[f"{reason.replace(' ', '_')}_{PRIORITY_NAMES[priority]}"] += 1
+        return Overloaded(reason, self.retry_after)
+
+    def _remove(self, entry):
+        if entry in self._queue:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+
+    def _admitted(self, waited):
+        self.admitted += 1
+        self.wait_seconds += waited
+        latency_metrics.observe_stage("admission_wait", waited)
+        return Admission(self)
+
+    async def acquire(self, priority, timeout=None):
+        """
+        Wait for a slot for at most ``timeout`` seconds (the configured queue
+        timeout by default).
+
+        Raises:
+            Overloaded: The queue is full, the request was shed for a higher
+                priority one, or its queue deadline passed.
+        """
+        if self.in_flight < self.max_concurrent and not self._queue:
+            self.in_flight += 1
+            return self._admitted(0.0)
+
+        if len(self._queue) >= self.max_queue:
+            lowest = max(self._queue, default=None)
+            if lowest is None or lowest[0] <= priority:
+                raise self._reject("queue full", priority)
+            self._remove(lowest)
+            lowest[2].set_exception(self._reject("shed", lowest[0]))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._sequence), future)
+        heapq.heappush(self._queue, entry)
+        self.queued += 1
+        started = time.monotonic()
+        timeout = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max(timeout, 0))
+        except asyncio.TimeoutError:
+            # The slot may have been handed over just as the deadline passed
+            if not (future.done() and future.exception() is None):
+                self._remove(entry)
+                raise self._reject("queue timeout", priority)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self._release()
+            else:
+                self._remove(entry)
+            raise
+        return self._admitted(time.monotonic() - started)
+
+    def _release(self):
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                # Hand the slot straight to the waiter
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def admit(self, priority, timeout=None):
+        admission = await self.acquire(priority, timeout)
+        try:
+            yield
+        finally:
+            admission.release()
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrent": self.max_concurrent,
+            "queue_depth": len(self._queue),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "mean_wait_seconds": self.wait_seconds / self.admitted if self.admitted else 0.0,
+            "rejected": sum(self.rejected.values()),
+            "rejected_by_reason": dict(self.rejected),
+        }
+
+
+admission = AdmissionController(
+    ADMISSION_MAX_CONCURRENT,
+    ADMISSION_MAX_QUEUE,
+    ADMISSION_QUEUE_TIMEOUT_SECONDS,
+    ADMISSION_RETRY_AFTER_SECONDS,
 )
 
-# Add new tracking structures
-class UserMetrics:
-    def __init__(self):
-        self.total_requests = 0
-        self.successful_requests = 0
-        self.failed_requests = 0
-        self.last_request_time = None
-        self.average_response_time = 0
-        self.total_response_time = 0
 
-# Add global metrics tracking
-user_metrics = defaultdict(UserMetrics)
+def chat_priority(user_id, domain):
+    """Conversations this worker already holds a session for go ahead of new ones."""
+    return PRIORITY_CONVERSATION if (user_id, domain) in sessions else PRIORITY_NEW_SESSION
+
+
+async def read_image(image):
+    """The uploaded image's bytes, or None when no image was sent."""
+    if not (image and image.filename):
+        return None
+    return await read_upload(image)
+
+
+async def prepare_turn(image_bytes, query, domain, deadline):
+    """
+    Caption an uploaded image while retrieving documents for the text query
+    from the domain's collection, both within the request ``deadline``.
+
+    Raises:
+        asyncio.TimeoutError: The deadline passed first.
+
+    Returns:
+        tuple: (image_caption, prefetched_docs). Both are empty/None when no
+        image was uploaded, in which case the chain retrieves as usual.
+    """
+    if image_bytes is None:
+        return "", None
+
+    async def caption():
+        with latency_metrics.time_stage("caption"):
+            return await get_image_caption(image_bytes, timeout=deadline - time.time())
+
+    async def retrieve():
+        with latency_metrics.time_stage("retrieval"):
+            return await domain_retrievers.get(domain).ainvoke(query)
+
+    image_caption, docs = await asyncio.wait_for(
+        asyncio.gather(caption(), retrieve(), return_exceptions=True),
+        timeout=max(deadline - time.time(), 0),
+    )
+    if isinstance(docs, Exception):
+        logger.error(f"Error prefetching documents: {str(docs)}")
+        docs = None
+    return image_caption, docs
+
+
+async def lookup_cached_answer(session, domain, query, image_caption):
+    """
+    Check the semantic cache for this turn.
+
+    Returns:
+        tuple: (entry or None, question vector or None).
+    """
+    if not semantic_cache.applies(session, image_caption):
+        return None, None
+    try:
+        entry, vector = await semantic_cache.lookup(domain, query)
+    except Exception as e:
+        logger.error(f"Error checking semantic cache: {str(e)}")
+        return None, None
+    return entry, vector
+
+
+def build_chain_inputs(session, full_query, prefetched_docs=None):
+    """Build the conversation chain inputs for one turn."""
+    inputs = {
+        "question": full_query,
+        "chat_history": session.prompt_history(),
+        "domain": session.domain,
+    }
+    if prefetched_docs is not None:
+        inputs["prefetched_docs"] = prefetched_docs
+    return inputs
+
+
+def start_suggestions(session, user_id, query, answer_text):
+    """
+    Begin generating follow-up questions for the turn being answered. The
+    turn number only counts once ``save_chat_data`` saves the turn; until
+    then the questions are a prefetch, discarded if the turn fails.
+
+    Returns:
+        int: The turn number the questions are cached under.
+    """
+    turn = session.turns + 1
+    if SUGGESTIONS_ENABLED:
+        suggestion_cache.start(user_id, session.domain, turn, query, answer_text)
+    return turn
+
+
+async def inline_suggestions(user_id, domain, turn):
+    """Questions for the /chat response, if ready within the inline wait."""
+    if not SUGGESTIONS_ENABLED:
+        return None
+    return await suggestion_cache.get(user_id, domain, turn, timeout=SUGGESTIONS_INLINE_WAIT_SECONDS)
 
-# Add new metrics tracking at the top with other global variables
-class GlobalMetrics:
-    def __init__(self):
-        self.lifetime_requests = 0
-        self.successful_requests = 0
-        self.failed_requests = 0
-        self.start_time = datetime.now()
-        self.active_users_24h = set()
-        
-    def to_dict(self):
-        return {
-            "lifetime_requests": self.lifetime_requests,
-            "successful_requests": self.successful_requests,
-            "failed_requests": self.failed_requests,
-            "uptime": str(datetime.now() - self.start_time),
-            "active_users_24h": len(self.active_users_24h)
-        }
 
-# Initialize global metrics
-global_metrics = GlobalMetrics()
+def build_full_query(query, image_caption):
+    """Prepare query including image caption if provided."""
+    full_query = query
+    if image_caption:
+        full_query += f"\nMy skin conditions description: {image_caption}"
+    return full_query
 
 
 '''
 The chat endpoint processes user queries, with optional image uploads, and manages chat sessions. 
 It starts by creating a session or retrieving an existing one. If an image is uploaded, it's processed to extract a caption, which is added to the query. 
 The query is then sent to an AI model for processing, with retries in case of failure. If the AI response contains XML (e.g., product details), it's parsed and extracted into a structured format; otherwise, the response is treated as plain text. 
-The response is returned along with any parsed product data. A background task logs the chat data for later analysis. If errors occur, retries are attempted, and a final error response is returned if the maximum retry limit is reached.
+The response is returned along with any parsed product data, and the turn is saved before the next turn for the session may start. If errors occur, retries are attempted, and a final error response is returned if the maximum retry limit is reached.
+Turns for one session run one at a time, and an identical request (same user, domain, query and image) arriving while one is in flight gets that request's result instead of calling the model again.
+Under overload the admission controller queues the request by priority or refuses it with a 503 and Retry-After.
 '''
 
+async def answer_chat(request, image_bytes, start_time):
+    """
+    Run one /chat turn once the admission controller lets it in.
+
+    Returns:
+        tuple: (response payload, whether the conversation chain generated it).
+    """
+    priority = chat_priority(request.userId, request.domain)
+    timeout = start_time + CHAT_DEADLINE_SECONDS - time.time()
+    async with admission.admit(priority, timeout):
+        return await chat_turn(request, image_bytes, start_time)
+
+
+async def chat_turn(request, image_bytes, start_time):
+    """
+    The image is captioned before taking the session lock; the semantic cache
+    lookup, the conversation and saving the turn happen under it.
+    """
+    session = get_session(request.userId, request.domain)
+
+    # Caption the image (if provided) while prefetching documents
+    image_caption, prefetched_docs = await prepare_turn(
+        image_bytes, request.query, request.domain, start_time + CHAT_DEADLINE_SECONDS
+    )
+
+    async with session_turn(session):
+        # Answer near-duplicate questions from the semantic cache
+        cached_entry, question_vector = await lookup_cached_answer(
+            session, request.domain, request.query, image_caption
+        )
+        if cached_entry is not None:
+            answer = cached_entry["answer"]
+            formatted_response = {"text": cached_entry["text"], "products": cached_entry["products"]}
+        else:
+            answer, formatted_response = await generate_answer(
+                session, request, image_caption, prefetched_docs, question_vector, start_time
+            )
+
+        # Follow-up questions are generated while the response is sent
+        turn = start_suggestions(session, request.userId, request.query, formatted_response["text"])
+
+        # Saved before the lock is released, so the next turn sees this one
+        if not await save_chat_data(session, request.query, formatted_response["text"], request.userId, start_time, answer):
+            suggestion_cache.discard(request.userId, request.domain, turn)
+
+    return {
+        "response": formatted_response["text"],
+        "products": formatted_response.get("products", []),
+        "userId": request.userId,
+        "turn": turn,
+        "suggestions": await inline_suggestions(request.userId, request.domain, turn),
+        "timestamp": datetime.now().isoformat(),
+        "status": "success"
+    }, cached_entry is None
+
+
+async def generate_answer(session, request, image_caption, prefetched_docs, question_vector, start_time):
+    """
+    Run the conversation chain with retries, all within the request deadline.
+
+    Returns:
+        tuple: (raw answer, formatted response).
+    """
+    deadline = start_time + CHAT_DEADLINE_SECONDS
+    retry_count = 0
+    full_query = build_full_query(request.query, image_caption)
+
+    while True:
+        try:
+            # Process the conversation
+            result = await asyncio.wait_for(
+                conversation_chain.get().ainvoke(
+                    build_chain_inputs(session, full_query, prefetched_docs)
+                ),
+                timeout=max(deadline - time.time(), 0),
+            )
+        except asyncio.TimeoutError:
+            raise
+        except Exception as e:
+            retry_count += 1
+            delay = retry_delay(retry_count)
+            if retry_count < LLM_MAX_ATTEMPTS and time.time() + delay < deadline:
+                logger.warning(f"Chat attempt {retry_count} failed, retrying in {delay:.2f}s: {str(e)}")
+                await asyncio.sleep(delay)
+                continue
+            raise
+
+        # Parse the AI response to extract the products XML
+        formatted_response = await format_response(result["answer"], request.domain)
+        if question_vector is not None:
+            semantic_cache.store(
+                request.domain, question_vector, result["answer"],
+                formatted_response, time.time() - start_time
+            )
+        return result["answer"], formatted_response
+
+
 # Modified chat endpoint
 @app.post("/chat")
 async def chat(
@@ -449,202 +4480,737 @@ async def chat(
     userId: str = Form(...),
     domain: str = Form(...),
     image: Optional[UploadFile] = File(default=None, description="Image file to upload", media_type="image/*", include_in_schema=True, default_factory=None),
-    background_tasks: BackgroundTasks = BackgroundTasks()
 ):
     try:
         start_time = time.time()
+        record_request_start(userId)
         
         # Create request object
         request = QueryRequest(userId=userId, query=query, domain=domain)
-        
-        # Get or create session
-        session_key = f"{userId}"
-        if session_key not in sessions:
-            sessions[session_key] = UserSession(request.domain, userId)
-        
-        session = sessions[session_key]
-
-        # Handle image if provided
-        image_caption = ""
-        if image and image.filename:
+        image_bytes = await read_image(image)
 
-             # Process the image
-            try:
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_image:
-                    # Read the file in chunks to handle large files
-                    contents = await image.read()
-                    temp_image.write(contents)
-                    temp_image.flush()
-                    
-                    # Get image caption
-                    image_caption = get_image_caption(temp_image.name)
-                    
-            except Exception as e:
-                logger.error(f"Error processing image: {str(e)}")
-                # Continue without image if there's an error
-                pass
-            finally:
-                # Clean up temporary file if it exists
-                try:
-                    os.unlink(temp_image.name)
-                except:
-                    pass
-        
-        
-        # Process message with retries
-        max_retries = 3
-        retry_count = 0
-        
-        while retry_count < max_retries:
-            try:
-                # Prepare query including image caption if provided
-                full_query = request.query
-                if image_caption:
-                    full_query += f"\nMy skin conditions description: {image_caption}"
-
-                # Process the conversation
-                result = await session.conversation.ainvoke({
-                    "question": full_query,
-                    "chat_history": session.chat_history
-                })
-
-                # Parse the AI response to extract JSON
-                response_text = result["answer"]
-                formatted_response = {}
-
-                # Try to find and parse XML in the response
-                try:
-                    # Attempt to find XML in the response
-                    xml_match = re.findall(r'<products>[\s\S]*?</products>', response_text, re.DOTALL)
-                    if xml_match:
-                        # Extract the XML portion
-                        xml_string = xml_match[0].replace("&", "&amp;") # Escape the & character
-                        root = ET.fromstring(xml_string)
-
-                        # Parse the XML into a products list
-                        products = []
-                        for product in root.findall('product'):
-                            products.append({
-                                "id": product.find('id').text,
-                                "name": product.find('name').text,
-                                "highlights": product.find('highlights').text,
-                                "price": product.find('price').text,
-                                "image_url": product.find('image_url').text,
-                                "buy_link": product.find('buy_link').text,
-                            })
-
-                        # Remove the XML portion from the response text
-                        remaining_text = re.sub(r'<products>[\s\S]*?</products>', '', response_text).strip()
-
-                        # Format the response
-                        formatted_response = {
-                            "text": remaining_text,
-                            "products": products
-                        }
-                    else:
-                        # If no XML is found, treat the whole response as text
-                        formatted_response = {
-                            "text": response_text,
-                            "products": []
-                        }
-                except ET.ParseError as e:
-                    print(f"XML parsing error: {e}")  # Add logging for debugging
-                    # Handle XML parsing errors and default to treating the response as text
-                    formatted_response = {
-                        "text": response_text,
-                        "products": []
-                    }
-
-                # Update success metrics
-                global_metrics.successful_requests += 1
-
-                # Background task for database operations
-                background_tasks.add_task(
-                    save_chat_data,
-                    session,
-                    request.query,
-                    formatted_response["text"],
-                    userId,
-                    start_time
-                )
+        # Identical requests already in flight share that request's answer
+        flight_key = (
+            userId, request.domain, request.query,
+            hashlib.sha256(image_bytes).hexdigest() if image_bytes is not None else None,
+        )
+        (payload, generated), shared = await chat_flights.run(
+            flight_key, lambda: answer_chat(request, image_bytes, start_time)
+        )
 
-                # Return formatted response
-                return JSONResponse(content={
-                    "response": formatted_response["text"],
-                    "products": formatted_response.get("products", []),
-                    "userId": userId,
-                    "timestamp": datetime.now().isoformat(),
-                    "status": "success"
-                })
+        # Update success metrics
+        global_metrics.incr("successful_requests")
+        if shared:
+            global_metrics.incr("deduplicated_requests")
+            if generated:
+                global_metrics.incr("saved_llm_calls")
+            session_backend.record_request(userId, time.time() - start_time, True)
 
-            except Exception as e:
-                retry_count += 1
-                if retry_count < max_retries:
-                    llm._rotate_key()
-                    await asyncio.sleep(1)
-                    continue
-                raise
+        return JSONResponse(content=payload)
 
+    except HTTPException as e:
+        record_request_failure(userId, start_time, e)
+        raise
+    except asyncio.TimeoutError:
+        logger.error(f"Chat request for user {userId} exceeded its {CHAT_DEADLINE_SECONDS:g}s deadline")
+        record_request_failure(userId, start_time, "deadline exceeded")
+        raise HTTPException(
+            status_code=504,
+            detail={"error": "Request deadline exceeded", "response": "Sorry, this is taking too long. Please try again."}
+        )
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}")
+        record_request_failure(userId, start_time, e)
         raise HTTPException(
             status_code=500, 
             detail={"error": str(e), "response": "Sorry, an error occurred. Please try again."}
         )
 
+
+def sse_event(event, data):
+    """Encode one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+'''
+The streaming chat endpoint runs the same conversation as /chat but answers with server-sent events.
+Answer text is sent as "token" events while the model generates it, and every <product> from the XML block is sent as a "product" event as soon as its closing tag arrives, so raw XML never reaches the client.
+A final "done" event carries the same payload /chat returns, and the turn is saved exactly as /chat saves it. Retries only happen while nothing has been streamed yet; later failures end the stream with an "error" event.
+'''
+
+@app.post("/chat/stream")
+async def chat_stream(
+    query: str = Form(...),
+    userId: str = Form(...),
+    domain: str = Form(...),
+    image: Optional[UploadFile] = File(default=None, description="Image file to upload", media_type="image/*", include_in_schema=True, default_factory=None),
+):
+    start_time = time.time()
+    record_request_start(userId)
+    request = QueryRequest(userId=userId, query=query, domain=domain)
+
+    # Held until the stream ends (or the client goes away)
+    try:
+        slot = await admission.acquire(chat_priority(userId, request.domain), CHAT_DEADLINE_SECONDS)
+    except HTTPException as e:
+        record_request_failure(userId, start_time, e)
+        raise
+    try:
+        session = get_session(userId, request.domain)
+        image_caption, prefetched_docs = await prepare_turn(
+            await read_image(image), request.query, domain, start_time + CHAT_DEADLINE_SECONDS
+        )
+    except HTTPException as e:
+        slot.release()
+        record_request_failure(userId, start_time, e)
+        raise
+    except asyncio.TimeoutError:
+        slot.release()
+        logger.error(f"Chat stream for user {userId} exceeded its {CHAT_DEADLINE_SECONDS:g}s deadline")
+        record_request_failure(userId, start_time, "deadline exceeded")
+        raise HTTPException(
+            status_code=504,
+            detail={"error": "Request deadline exceeded", "response": "Sorry, this is taking too long. Please try again."}
+        )
+    except Exception as e:
+        slot.release()
+        logger.error(f"Error in chat stream endpoint: {str(e)}")
+        record_request_failure(userId, start_time, e)
+        raise HTTPException(
+            status_code=500,
+            detail={"error": str(e), "response": "Sorry, an error occurred. Please try again."}
+        )
+
+    full_query = build_full_query(request.query, image_caption)
+    # Turn the suggestions were started for, and the turn once it is saved
+    pending_turn = saved_turn = None
+
+    async def cached_event_stream(cached_entry):
+        nonlocal pending_turn, saved_turn
+        if cached_entry["text"]:
+            yield sse_event("token", {"text": cached_entry["text"]})
+        for product in cached_entry["products"]:
+            yield sse_event("product", product)
+        global_metrics.incr("successful_requests")
+        turn = pending_turn = start_suggestions(session, userId, request.query, cached_entry["text"])
+        yield sse_event("done", {
+            "response": cached_entry["text"],
+            "products": cached_entry["products"],
+            "userId": userId,
+            "turn": turn,
+            "timestamp": datetime.now().isoformat(),
+            "status": "success"
+        })
+        if await save_chat_data(session, request.query, cached_entry["text"], userId, start_time, cached_entry["answer"]):
+            saved_turn = turn
+
+    async def suggestions_event(turn, deadline):
+        if not SUGGESTIONS_ENABLED:
+            return
+        questions = await suggestion_cache.get(userId, request.domain, turn, timeout=max(deadline - time.time(), 0))
+        if questions:
+            yield sse_event("suggestions", {"turn": turn, "questions": questions})
+
+    async def event_stream(question_vector):
+        nonlocal pending_turn, saved_turn
+        deadline = start_time + CHAT_DEADLINE_SECONDS
+        retry_count = 0
+        streamed = False
+        turn = None
+
+        while True:
+            handler = TokenQueueCallbackHandler()
+            parser = ProductStreamParser(request.domain)
+
+            async def run_chain():
+                try:
+                    return await conversation_chain.get().ainvoke(
+                        build_chain_inputs(session, full_query, prefetched_docs),
+                        config={"callbacks": [handler]},
+                    )
+                finally:
+                    handler.queue.put_nowait(None)
+
+            task = asyncio.create_task(run_chain())
+            try:
+                while (token := await asyncio.wait_for(
+                    handler.queue.get(), timeout=max(deadline - time.time(), 0)
+                )) is not None:
+                    for event, data in await parser.feed(token):
+                        streamed = True
+                        yield sse_event(event, {"text": data} if event == "token" else data)
+                    if turn is None and parser.text_complete:
+                        # The answer text is final once the products block starts, so
+                        # prefetch its questions; they are dropped if the turn fails
+                        turn = pending_turn = start_suggestions(session, userId, request.query, parser.text.strip())
+                result = await task
+            except asyncio.TimeoutError:
+                logger.error(f"Chat stream for user {userId} exceeded its {CHAT_DEADLINE_SECONDS:g}s deadline")
+                record_request_failure(userId, start_time, "deadline exceeded")
+                yield sse_event("error", {"error": "Request deadline exceeded", "response": "Sorry, this is taking too long. Please try again."})
+                return
+            except Exception as e:
+                retry_count += 1
+                delay = retry_delay(retry_count)
+                if not streamed and retry_count < LLM_MAX_ATTEMPTS and time.time() + delay < deadline:
+                    logger.warning(f"Chat stream attempt {retry_count} failed, retrying in {delay:.2f}s: {str(e)}")
+                    await asyncio.sleep(delay)
+                    continue
+                logger.error(f"Error in chat stream endpoint: {str(e)}")
+                record_request_failure(userId, start_time, e)
+                yield sse_event("error", {"error": str(e), "response": "Sorry, an error occurred. Please try again."})
+                return
+            finally:
+                if not task.done():
+                    task.cancel()
+
+            for event, data in parser.close():
+                yield sse_event(event, {"text": data})
+
+            formatted_response = await format_response(result["answer"], request.domain)
+            if question_vector is not None:
+                semantic_cache.store(
+                    request.domain, question_vector, result["answer"],
+                    formatted_response, time.time() - start_time
+                )
+            global_metrics.incr("successful_requests")
+            if turn is None:
+                turn = pending_turn = start_suggestions(session, userId, request.query, formatted_response["text"])
+            else:
+                suggestion_cache.add_alias(userId, request.domain, turn, request.query, formatted_response["text"])
+            yield sse_event("done", {
+                "response": formatted_response["text"],
+                "products": formatted_response.get("products", []),
+                "userId": userId,
+                "turn": turn,
+                "timestamp": datetime.now().isoformat(),
+                "status": "success"
+            })
+
+            if await save_chat_data(session, request.query, formatted_response["text"], userId, start_time, result["answer"]):
+                saved_turn = turn
+            return
+
+    async def turn_stream():
+        # The whole turn runs under the session lock, like /chat
+        try:
+            async with session_turn(session):
+                cached_entry, question_vector = await lookup_cached_answer(
+                    session, request.domain, request.query, image_caption
+                )
+                events = (
+                    cached_event_stream(cached_entry) if cached_entry is not None
+                    else event_stream(question_vector)
+                )
+                try:
+                    async for event in events:
+                        yield event
+                finally:
+                    # Failed, timed out or the client left before the turn was saved
+                    if pending_turn is not None and saved_turn is None:
+                        suggestion_cache.discard(userId, request.domain, pending_turn)
+        finally:
+            slot.release()
+
+        # Follow-up questions are streamed after the next turn may start
+        if saved_turn is not None:
+            async for event in suggestions_event(saved_turn, start_time + CHAT_DEADLINE_SECONDS):
+                yield event
+
+    return StreamingResponse(
+        turn_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Also runs when the client disconnects before the stream starts
+        background=BackgroundTask(slot.release),
+    )
+
+# Bulk chat settings
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_JOB_MAX_ITEMS = int(os.getenv("BATCH_JOB_MAX_ITEMS", "50000"))
+BATCH_EMBED_SIZE = int(os.getenv("BATCH_EMBED_SIZE", "256"))
+BATCH_ITEM_TIMEOUT_SECONDS = float(os.getenv("BATCH_ITEM_TIMEOUT_SECONDS", "300"))
+
+
+def parse_batch(body: bytes, max_items: int):
+    """
+    Parse a JSONL body of {"userId", "domain", "query"} objects, each with an
+    optional "id" that is echoed back. Blank lines are skipped.
+
+    Returns:
+        list: (index, id, QueryRequest or None, error or None) per item, so
+        one bad line fails only its own item.
+    """
+    try:
+        lines = [line for line in body.decode("utf-8").splitlines() if line.strip()]
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Batch body must be UTF-8 encoded JSON lines")
+    if not lines:
+        raise HTTPException(status_code=400, detail="Batch body has no items")
+    if len(lines) > max_items:
+        raise HTTPException(status_code=413, detail=f"Batch has {len(lines)} items; the limit is {max_items}")
+
+    items = []
+    for index, line in enumerate(lines):
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            items.append((index, None, None, f"Invalid JSON: {str(e)}"))
+            continue
+        if not isinstance(data, dict):
+            items.append((index, None, None, "Item must be a JSON object"))
+            continue
+        missing = [field for field in ("userId", "domain", "query") if not isinstance(data.get(field), str)]
+        if missing:
+            items.append((index, data.get("id"), None, f"Missing or non-string fields: {', '.join(missing)}"))
+            continue
+        request = QueryRequest(userId=data["userId"], domain=data["domain"], query=data["query"])
+        items.append((index, data.get("id"), request, None))
+    return items
+
+
+class BatchRunner:
+    """
+    Answers batches of chat items through the same admission control,
+    session locks, semantic cache and conversation chain as /chat.
+
+    Each batch runs at most ``concurrency`` items at once, at the lowest
+    admission priority, so interactive traffic goes first; an item turned away
+    retries after Retry-After until ``item_timeout``. Before a chunk of
+    ``embed_size`` items starts, their queries are embedded in one call,
+    which puts them in the embedding cache for the semantic cache lookup and
+    retrieval. Turns are saved through the write-behind queue like any other,
+    and the request counters are updated once per batch. Follow-up
+    questions are not generated for batch items.
+
+    Jobs run a batch in the background and write each result to the
+    ``batch_results`` table, so any worker can report on them.
+    """
+
+    def __init__(self, concurrency, embed_size, item_timeout):
+        self.concurrency = concurrency
+        self.embed_size = embed_size
+        self.item_timeout = item_timeout
+        self._jobs = {}
+        self.batches = 0
+        self.running = 0
+        self.items = 0
+        self.failed_items = 0
+        self.embedded_queries = 0
+        self.embed_calls = 0
+        self.admission_retries = 0
+
+    def _session(self, request, local_sessions):
+        """
+        The worker's cached session when it has one, so a batch item and a
+        live turn share its history. Otherwise a session held for this batch
+        only, so a large batch does not evict the session cache. Turns are
+        serialized per (user_id, domain) by ``session_locks`` either way.
+        """
+        key = (request.userId, request.domain)
+        if key in sessions:
+            return get_session(*key)
+        session = local_sessions.get(key)
+        if session is None:
+            with latency_metrics.time_stage("session_load"):
+                session = local_sessions[key] = UserSession(request.domain, request.userId)
+        return session
+
+    async def _prefetch(self, chunks, started, ready):
+        """Embed each chunk's queries in one call once work reaches the chunk before it."""
+        for number, chunk in enumerate(chunks):
+            if number:
+                await started[number - 1].wait()
+            queries = list(dict.fromkeys(request.query for _, _, request, _ in chunk))
+            try:
+                await embedding.aembed_documents(queries)
+                self.embed_calls += 1
+                self.embedded_queries += len(queries)
+            except Exception as e:
+                # Items embed their own queries instead
+                logger.error(f"Error embedding batch queries: {str(e)}")
+            ready[number].set()
+
+    async def _answer(self, session, request):
+        """
+        One item's turn under the session lock.
+
+        Returns:
+            tuple: (formatted response, turn, whether it came from the semantic cache).
+        """
+        queued = time.time()
+        while True:
+            try:
+                async with admission.admit(PRIORITY_BATCH, queued + self.item_timeout - time.time()):
+                    start_time = time.time()
+                    async with session_turn(session):
+                        cached_entry, question_vector = await lookup_cached_answer(
+                            session, request.domain, request.query, ""
+                        )
+                        if cached_entry is not None:
+                            answer = cached_entry["answer"]
+                            formatted_response = {"text": cached_entry["text"], "products": cached_entry["products"]}
+                        else:
+                            answer, formatted_response = await generate_answer(
+                                session, request, "", None, question_vector, start_time
+                            )
+                        await save_chat_data(
+                            session, request.query, formatted_response["text"], request.userId, start_time, answer
+                        )
+                    return formatted_response, session.turns, cached_entry is not None
+            except Overloaded:
+                if time.time() + admission.retry_after >= queued + self.item_timeout:
+                    raise
+                self.admission_retries += 1
+                await asyncio.sleep(admission.retry_after)
+
+    async def _item(self, item, local_sessions):
+        index, item_id, request, error = item
+        result = {"index": index, "id": item_id}
+        if request is None:
+            return {**result, "status": "error", "code": 400, "error": error}
+        result.update(userId=request.userId, domain=request.domain)
+        start_time = time.time()
+        active_users.add(request.userId)
+        try:
+            session = self._session(request, local_sessions)
+            formatted_response, turn, cached = await self._answer(session, request)
+            return {
+                **result,
+                "status": "success",
+                "response": formatted_response["text"],
+                "products": formatted_response.get("products", []),
+                "turn": turn,
+                "cached": cached,
+                "timestamp": datetime.now().isoformat(),
+            }
+        except Overloaded as e:
+            code, message = 503, e.detail["error"]
+        except asyncio.TimeoutError:
+            code, message = 504, "Request deadline exceeded"
+        except Exception as e:
+            logger.error(f"Error in batch item {index}: {str(e)}")
+            code, message = 500, str(e)
+        session_backend.record_request(request.userId, time.time() - start_time, False, message)
+        return {**result, "status": "error", "code": code, "error": message}
+
+    async def run(self, items):
+        """Answer ``items`` from ``parse_batch``, yielding each result as it finishes."""
+        results = asyncio.Queue()
+        local_sessions = {}
+        valid = [item for item in items if item[2] is not None]
+        for item in items:
+            if item[2] is None:
+                results.put_nowait(await self._item(item, local_sessions))
+
+        chunks = [valid[start:start + self.embed_size] for start in range(0, len(valid), self.embed_size)]
+        started = [asyncio.Event() for _ in chunks]
+        ready = [asyncio.Event() for _ in chunks]
+        if not embedding.enabled:
+            # Nothing to warm; items embed their own queries
+            for event in ready:
+                event.set()
+        pending = iter(enumerate(valid))
+
+        async def worker():
+            for position, item in pending:
+                number = position // self.embed_size
+                started[number].set()
+                await ready[number].wait()
+                results.put_nowait(await self._item(item, local_sessions))
+
+        tasks = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, len(valid)))]
+        if embedding.enabled and valid:
+            tasks.append(asyncio.create_task(self._prefetch(chunks, started, ready)))
+
+        self.batches += 1
+        self.running += 1
+        failed = 0
+        try:
+            for _ in range(len(items)):
+                result = await results.get()
+                failed += result["status"] != "success"
+                yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.running -= 1
+            self.items += len(items)
+            self.failed_items += failed
+            global_metrics.incr("batch_items", len(items))
+            if failed:
+                global_metrics.incr("failed_batch_items", failed)
+
+    def start_job(self, job_id, items):
+        task = asyncio.create_task(self._run_job(job_id, items))
+        self._jobs[job_id] = task
+        task.add_done_callback(lambda done: self._jobs.pop(job_id, None))
+
+    async def _run_job(self, job_id, items):
+        succeeded = failed = 0
+        status = "interrupted"
+        try:
+            async for result in self.run(items):
+                if result["status"] == "success":
+                    succeeded += 1
+                else:
+                    failed += 1
+                db_writer.put("batch_results", (
+                    job_id, result["index"], result["status"], json.dumps(result, ensure_ascii=False),
+                ))
+            status = "done"
+        except Exception as e:
+            status = "failed"
+            logger.error(f"Batch job {job_id} failed: {str(e)}")
+        finally:
+            db_writer.put("batch_jobs", (status, succeeded, failed, str(datetime.now()), job_id))
+
+    async def cancel_job(self, job_id):
+        task = self._jobs.get(job_id)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def stop(self):
+        """Interrupt running jobs; their status is written before the queue flushes."""
+        tasks = list(self._jobs.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "concurrency": self.concurrency,
+            "batches": self.batches,
+            "running": self.running,
+            "jobs_running": len(self._jobs),
+            "items": self.items,
+            "failed_items": self.failed_items,
+            "embed_calls": self.embed_calls,
+            "embedded_queries": self.embedded_queries,
+            "admission_retries": self.admission_retries,
+        }
+
+
+batch_runner = BatchRunner(BATCH_CONCURRENCY, BATCH_EMBED_SIZE, BATCH_ITEM_TIMEOUT_SECONDS)
+
+
+'''
+The batch endpoint answers many chat turns in one request. The body is JSON lines, one {"userId", "domain", "query"} object per line (with an optional "id" echoed back), and the response is NDJSON, one line per item in the order items finish.
+Every line carries the item's "index" and "status"; failed items have an HTTP-style "code" and an "error" instead of a response, so one bad item never fails the batch.
+Larger inputs go to /chat/batch/jobs, which answers 202 with a job id straight away; poll the job for progress and page through its results once it is done.
+'''
+
+@app.post("/chat/batch")
+async def chat_batch(request: Request):
+    items = parse_batch(await request.body(), BATCH_MAX_ITEMS)
+
+    async def results():
+        async for result in batch_runner.run(items):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+
+def batch_job(db, job_id):
+    """The job's row with its progress so far, or None."""
+    job = db.execute("SELECT * FROM batch_jobs WHERE id = ?", (job_id,)).fetchone()
+    if job is None:
+        return None
+    completed, failed = db.execute('''
+        SELECT COUNT(*), COALESCE(SUM(status != 'success'), 0)
+        FROM batch_results WHERE job_id = ?
+    ''', (job_id,)).fetchone()
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "total": job["total"],
+        "completed": completed,
+        "succeeded": completed - failed,
+        "failed": failed,
+        "created_at": job["created_at"],
+        "finished_at": job["finished_at"],
+    }
+
+
+@app.post("/chat/batch/jobs", status_code=202)
+async def create_batch_job(request: Request):
+    items = parse_batch(await request.body(), BATCH_JOB_MAX_ITEMS)
+    job_id = uuid.uuid4().hex
+
+    def create():
+        with get_db() as db:
+            with db:
+                db.execute('''
+                    INSERT INTO batch_jobs (id, status, total, created_at)
+                    VALUES (?, 'running', ?, ?)
+                ''', (job_id, len(items), str(datetime.now())))
+
+    await asyncio.to_thread(create)
+    batch_runner.start_job(job_id, items)
+    return {
+        "job_id": job_id,
+        "status": "running",
+        "total": len(items),
+        "status_url": f"/chat/batch/jobs/{job_id}",
+        "results_url": f"/chat/batch/jobs/{job_id}/results",
+    }
+
+
+@app.get("/chat/batch/jobs/{job_id}")
+async def get_batch_job(job_id: str):
+    def read():
+        with get_db() as db:
+            return batch_job(db, job_id)
+
+    job = await asyncio.to_thread(read)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return job
+
+
+@app.get("/chat/batch/jobs/{job_id}/results")
+async def get_batch_job_results(job_id: str, after: int = -1, limit: int = 1000):
+    """
+    The job's results as NDJSON in input order, ``limit`` at a time from the
+    item after ``after``. Items finish out of order, so page through the
+    results once the job is done.
+    """
+    def read():
+        with get_db() as db:
+            if db.execute("SELECT 1 FROM batch_jobs WHERE id = ?", (job_id,)).fetchone() is None:
+                return None
+            return [row["result"] for row in db.execute('''
+                SELECT result FROM batch_results
+                WHERE job_id = ? AND item > ?
+                ORDER BY item LIMIT ?
+            ''', (job_id, after, max(1, min(limit, 10000))))]
+
+    results = await asyncio.to_thread(read)
+    if results is None:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return PlainTextResponse("".join(result + "\n" for result in results), media_type="application/x-ndjson")
+
+
+@app.delete("/chat/batch/jobs/{job_id}")
+async def delete_batch_job(job_id: str):
+    """
+    Stop the job if this worker is running it, and delete it with its
+    results. The deletes are queued behind the job's last result writes.
+    """
+    def exists():
+        with get_db() as db:
+            return db.execute("SELECT 1 FROM batch_jobs WHERE id = ?", (job_id,)).fetchone() is not None
+
+    if not await asyncio.to_thread(exists):
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    await batch_runner.cancel_job(job_id)
+    db_writer.put("batch_results_delete", (job_id,))
+    db_writer.put("batch_jobs_delete", (job_id,))
+    return {"job_id": job_id, "status": "deleted"}
+
+
 @app.post("/generate_questions")
 async def generate_questions(query: Query):
+    """
+    Return the follow-up questions generated when the answer was produced,
+    generating them now if they were never started or have expired.
+    """
     try:
-        # Combine user message and AI response into context
-        combined_context = f"User: {query.user_message}\nAI: {query.ai_response}"
-
-        # Use LangChain to generate follow-up questions
-        messages = [
-            SystemMessage(
-                content="You are NeuroBrain's Question Suggestion AI, and your goal is to guide users through helpful conversations by predicting relevant follow-up questions. Based on the user's original question you will generate only two or three follow-up short questions. The follow-up questions should: 1. Be relevant to both the user's original question and your answer. 2. Encourage deeper engagement or exploration of the topic. 3. Help guide the user toward meaningful next steps or further clarification. For example: First Interaction: - If the user asks, 'Hello! ' And Response from AI:  Hello Hello! NeuroBrain's AI-powered solutions are designed to automate and enhance your customer support experience. Whether you're looking to provide 24/7 support, reduce response times, or free up your human agents for more complex tasks, our Chatbots and Voice Assistants can help. They are customizable to fit your specific business needs and can integrate seamlessly with various platforms, including social media. How can I assist you further in exploring these solutions for your business? Your follow-up questions could be: 1. 'Does NeuroBrain support voice and chat? ' 2. ' My Business benefits ' 3. ' Pricing? ' Second Follow-up Interaction: User's Select: “Does NeuroBrain support voice and chat?” AI: Does Neur oBrain support voice and chat? Yes, NeuroBrain offers support for both voice and chat interactions. Our AI Chatbots and Voice Assistants are designed to cater to various user preferences, providing a seamless and versatile customer support experience. This allows businesses to engage with their customers across multiple channels effectively. Would you like to learn more about how these features can benefit your business?. Based on the conversation between the user and AI, generate 1-3 follow-up questions. the follow-up question in 3 to 5 words without emoji and special characters. Return only the questions separated by commas."
-            ),
-            HumanMessage(content=combined_context),
-        ]
-        response = llm.invoke(messages)
-
-        # Extract questions from response
-        questions = response.content.strip()
+        questions = await suggestion_cache.get(
+            query.userId, query.domain, query.turn, query.user_message, query.ai_response,
+            timeout=SUGGESTIONS_TIMEOUT_SECONDS,
+        )
+        if questions is None:
+            async with admission.admit(PRIORITY_SUGGESTIONS):
+                questions = await generate_suggestions(query.user_message, query.ai_response)
         return {"questions": questions}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
 
-async def save_chat_data(session, query, response, user_id, start_time):
+async def save_chat_data(session, query, response, user_id, start_time, answer=None):
+    """
+    Save a turn and count it in ``session.turns``.
+
+    Returns:
+        bool: False when saving failed, so the turn number was not taken.
+    """
     try:
-        # Save to database and update memory
+        # Save to database
         session.save_message(query, response)
-        
-        # Update in-memory chat history
-        session.chat_history.append((query, response))
+    except Exception as e:
+        logger.error(f"Error saving chat data: {str(e)}")
+        return False
+    session.turns += 1
+
+    try:
+        # Update in-memory chat history. The model's raw answer is kept, so
+        # later prompts still see which products were recommended.
+        session.chat_history.append((query, answer or response))
         if len(session.chat_history) > 20:
             session.chat_history = session.chat_history[-20:]
+        history_compactor.maybe_start(session)
 
-        # Update metrics
-        response_time = time.time() - start_time
-        user_metrics[user_id].successful_requests += 1
-        user_metrics[user_id].total_response_time += response_time
-        user_metrics[user_id].average_response_time = (
-            user_metrics[user_id].total_response_time / 
-            user_metrics[user_id].successful_requests
-        )
-
-        # Save metrics to database
-        with get_db() as db:
-            db.execute('''
-                INSERT INTO request_metrics 
-                (user_id, request_time, response_time, success, error_message)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (user_id, datetime.now(), response_time, True, None))
-            db.commit()
+        # Record metrics, shared across workers
+        session_backend.record_request(user_id, time.time() - start_time, True)
 
     except Exception as e:
         logger.error(f"Error saving chat data: {str(e)}")
+    return True
+
+def build_conversation_chain():
+    """
+    The answer pipeline shared by every session. It holds no per-user state:
+    each call brings the session's history and domain in its inputs, so
+    concurrent turns can run through it at once.
+    """
+    return KlyraRetrievalChain.from_llm(
+        llm=llm,
+        condense_question_llm=(
+            completion_llm if RETRIEVAL_QUERY_STRATEGY == "condense" else rewrite_llm
+        ),
+        retriever=DomainRetriever(registry=domain_retrievers),
+        combine_docs_chain_kwargs={"prompt": CONVERSATIONAL_PROMPT},
+        get_chat_history=prompt_budget.format_history,
+        query_strategy=RETRIEVAL_QUERY_STRATEGY,
+        return_source_documents=True,
+    )
+
+conversation_chain = Component("conversation", build_conversation_chain)
+
+openai_clients = Component(
+    "openai",
+    lambda: key_pool.warm([llm, completion_llm, rewrite_llm, suggestion_llm, summary_llm]),
+)
+
+components = (database, chroma, openai_clients, conversation_chain)
+
+
+async def warmup():
+    """
+    Build every component and pre-touch what the first request would
+    otherwise pay for: the pooled SQLite connections, the fallback
+    collection's vectors and product catalogue, the OpenAI clients and the
+    tokenizer.
+    """
+    started = time.perf_counter()
+    try:
+        await asyncio.to_thread(db_pool.fill)
+        for component in components:
+            await asyncio.to_thread(component.get)
+        collection_name = await asyncio.to_thread(domain_retrievers.warm)
+        if collection_name is not None:
+            await asyncio.to_thread(product_catalog._table, collection_name)
+        await asyncio.to_thread(count_tokens, "warmup")
+    except Exception as e:
+        logger.error(f"Warmup failed: {str(e)}")
+        raise
+    logger.info(f"Warmup finished in {time.perf_counter() - started:.2f}s")
 
 # Add health check endpoint
 @app.get("/health")
@@ -656,6 +5222,128 @@ async def health_check():
     }
 
 
+@app.get("/ready")
+async def ready():
+    """
+    Readiness, separate from liveness: every component builds and passes its
+    health check, and startup warmup has finished. Components that have not
+    been used yet are built here, so a readiness probe also warms the worker.
+    """
+    results = {}
+    for component in components:
+        await asyncio.to_thread(component.check)
+        results[component.name] = component.status()
+    startup_tasks = getattr(app.state, "startup_tasks", [])
+    warming_up = any(not task.done() for task in startup_tasks)
+    warmup_failed = any(
+        task.done() and not task.cancelled() and task.exception() is not None
+        for task in startup_tasks
+    )
+    is_ready = all(result["ready"] for result in results.values()) and not warming_up
+    return JSONResponse(
+        status_code=200 if is_ready else 503,
+        content={
+            "status": "ready" if is_ready else "not_ready",
+            "warming_up": warming_up,
+            "warmup_failed": warmup_failed,
+            "components": results,
+        },
+    )
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        # Counts the backend's request log, so keep it off the event loop
+        **await asyncio.to_thread(global_metrics.to_dict),
+        "session_cache": sessions.stats(),
+        "chat_flights": chat_flights.stats(),
+        "admission": admission.stats(),
+        "caption_cache": caption_cache.stats(),
+        "embedding_cache": embedding.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "domain_retrievers": domain_retrievers.stats(),
+        "product_catalog": product_catalog.stats(),
+        "suggestions": suggestion_cache.stats(),
+        "db_writer": db_writer.stats(),
+        "key_pool": key_pool.stats(),
+        "llm_latency": {
+            "answer": llm.latency.stats(),
+            "completion": completion_llm.latency.stats(),
+            "rewrite": rewrite_llm.latency.stats(),
+            "suggestions": suggestion_llm.latency.stats(),
+            "summary": summary_llm.latency.stats(),
+        },
+        "history": history_compactor.stats(),
+        "batch": batch_runner.stats(),
+        "retrieval_query": {"strategy": RETRIEVAL_QUERY_STRATEGY, **retrieval_query_stats},
+        "latency": latency_metrics.stats(),
+    }
+
+
+def prometheus_gauges(prefix, values):
+    """Gauge lines for the numeric (and boolean) fields of a stats dict."""
+    lines = []
+    for key, value in values.items():
+        if isinstance(value, (int, float)):
+            name = f"{prefix}_{key}"
+            lines += [f"# TYPE {name} gauge", f"{name} {int(value) if isinstance(value, bool) else value}"]
+    return lines
+
+
+def render_metrics():
+    lines = []
+    for name in GlobalMetrics.COUNTERS:
+        metric = "klyra_" + name.replace("lifetime_", "") + "_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {global_metrics.local[name]}"]
+
+    lines.append("# HELP klyra_active_users Estimated distinct users in the window (this worker).")
+    lines.append("# TYPE klyra_active_users gauge")
+    for window, seconds in (("1h", 3600), ("24h", 24 * 3600)):
+        lines.append(f'klyra_active_users{{window="{window}"}} {active_users.estimate(seconds)}')
+
+    now = time.monotonic()
+    key_metrics = [state.to_dict(now) for state in key_pool.keys]
+    for field in ("in_flight", "requests_available", "tokens_available", "circuit_open",
+                  "total_requests", "rate_limited", "errors"):
+        name = f"klyra_key_{field}"
+        lines.append(f"# TYPE {name} gauge")
+        for key in key_metrics:
+            value = int(key[field]) if isinstance(key[field], bool) else key[field]
+            lines.append(f"{name}{prometheus_labels({'key': key['key']})} {value}")
+    lines += prometheus_gauges("klyra_key_pool", {"waits": key_pool.waits})
+
+    for prefix, values in (
+        ("klyra_session_cache", sessions.stats()),
+        ("klyra_chat_flights", chat_flights.stats()),
+        ("klyra_admission", admission.stats()),
+        ("klyra_caption_cache", caption_cache.stats()),
+        ("klyra_embedding_cache", embedding.stats()),
+        ("klyra_semantic_cache", semantic_cache.stats()),
+        ("klyra_suggestions", suggestion_cache.stats()),
+        ("klyra_history", history_compactor.stats()),
+        ("klyra_batch", batch_runner.stats()),
+        ("klyra_product_catalog", product_catalog.stats()),
+        ("klyra_db_writer", db_writer.stats()),
+    ):
+        lines += prometheus_gauges(prefix, values)
+
+    lines += latency_metrics.prometheus()
+    return "\n".join(lines) + "\n"
+
+
+@app.get("/metrics")
+async def metrics():
+    """This worker's metrics in the Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats/users/{user_id}")
+async def user_stats(user_id: str):
+    # Aggregates the user's request log, which may be a network call for a custom backend
+    return {"user_id": user_id, **await asyncio.to_thread(session_backend.user_metrics, user_id)}
+
+
 @app.get("/")
 async def root():
     return {"message": "API is running"}
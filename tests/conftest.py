@@ -0,0 +1,14 @@
+"""
+Import ``main`` against a throwaway SQLite database. Nothing here needs an
+OpenAI key or network access; model calls are replaced in the tests that
+would make them.
+"""
+import os
+import tempfile
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "klyraai.db")
+
+import main  # noqa: E402
+
+main.init_db()
@@ -0,0 +1,118 @@
+"""
+AdmissionController hands free slots to the best waiter, sheds the lowest
+priority waiter for a better newcomer and refuses work it cannot queue.
+"""
+import asyncio
+
+import pytest
+
+import main
+
+
+def controller(max_concurrent=1, max_queue=2, queue_timeout=5.0):
+    return main.AdmissionController(max_concurrent, max_queue, queue_timeout, retry_after=2.0)
+
+
+async def settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_slots_go_to_the_best_priority_then_arrival_order():
+    async def run():
+        admission = controller(max_queue=3)
+        held = await admission.acquire(main.PRIORITY_CONVERSATION)
+        order = []
+
+        async def wait(priority, name):
+            slot = await admission.acquire(priority)
+            order.append(name)
+            slot.release()
+
+        waiters = [
+            asyncio.create_task(wait(main.PRIORITY_BATCH, "batch")),
+            asyncio.create_task(wait(main.PRIORITY_NEW_SESSION, "new 1")),
+            asyncio.create_task(wait(main.PRIORITY_NEW_SESSION, "new 2")),
+        ]
+        await settle()
+        assert admission.stats()["queue_depth"] == 3
+        held.release()
+        await asyncio.gather(*waiters)
+        return order, admission.stats()
+
+    order, stats = asyncio.run(run())
+    assert order == ["new 1", "new 2", "batch"]
+    assert stats["in_flight"] == 0
+    assert stats["admitted"] == 4
+
+
+def test_full_queue_refuses_a_newcomer_that_does_not_outrank_it():
+    async def run():
+        admission = controller(max_queue=1)
+        held = await admission.acquire(main.PRIORITY_CONVERSATION)
+        waiter = asyncio.create_task(admission.acquire(main.PRIORITY_NEW_SESSION))
+        await settle()
+        with pytest.raises(main.Overloaded) as refused:
+            await admission.acquire(main.PRIORITY_BATCH)
+        held.release()
+        (await waiter).release()
+        return refused.value, admission.stats()
+
+    refused, stats = asyncio.run(run())
+    assert refused.status_code == 503
+    assert refused.headers == {"Retry-After": "2"}
+    assert stats["rejected_by_reason"] == {"queue_full_batch": 1}
+
+
+def test_better_newcomer_sheds_the_lowest_priority_waiter():
+    async def run():
+        admission = controller(max_queue=1)
+        held = await admission.acquire(main.PRIORITY_CONVERSATION)
+        batch = asyncio.create_task(admission.acquire(main.PRIORITY_BATCH))
+        await settle()
+        conversation = asyncio.create_task(admission.acquire(main.PRIORITY_CONVERSATION))
+        await settle()
+        with pytest.raises(main.Overloaded):
+            await batch
+        held.release()
+        (await conversation).release()
+        return admission.stats()
+
+    stats = asyncio.run(run())
+    assert stats["rejected_by_reason"] == {"shed_batch": 1}
+    assert stats["in_flight"] == 0
+
+
+def test_waiter_is_refused_at_its_deadline():
+    async def run():
+        admission = controller()
+        held = await admission.acquire(main.PRIORITY_CONVERSATION)
+        with pytest.raises(main.Overloaded):
+            await admission.acquire(main.PRIORITY_NEW_SESSION, timeout=0.01)
+        stats = admission.stats()
+        held.release()
+        return stats, admission.stats()
+
+    waiting, released = asyncio.run(run())
+    assert waiting["queue_depth"] == 0
+    assert waiting["rejected_by_reason"] == {"queue_timeout_new_session": 1}
+    assert released["in_flight"] == 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        admission = controller()
+        held = await admission.acquire(main.PRIORITY_CONVERSATION)
+        waiter = asyncio.create_task(admission.acquire(main.PRIORITY_NEW_SESSION))
+        await settle()
+        waiter.cancel()
+        await settle()
+        depth = admission.stats()["queue_depth"]
+        held.release()
+        # Releasing twice is harmless
+        held.release()
+        return depth, admission.stats()
+
+    depth, stats = asyncio.run(run())
+    assert depth == 0
+    assert stats["in_flight"] == 0
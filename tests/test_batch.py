@@ -0,0 +1,83 @@
+"""
+Batch bodies are parsed line by line, and a bad line or a failing item only
+fails its own result.
+"""
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+def body(*lines):
+    return "\n".join(line if isinstance(line, str) else json.dumps(line) for line in lines).encode()
+
+
+def test_parses_items_and_echoes_ids():
+    items = main.parse_batch(body(
+        {"id": "a", "userId": "u1", "domain": "d", "query": "acne"},
+        "",
+        {"userId": "u2", "domain": "d", "query": "dry skin"},
+    ), 10)
+    assert [(index, item_id, error) for index, item_id, _, error in items] == [(0, "a", None), (1, None, None)]
+    assert items[1][2].query == "dry skin"
+
+
+def test_bad_lines_become_error_items():
+    items = main.parse_batch(body(
+        "{not json",
+        "[1, 2]",
+        {"id": 7, "userId": "u", "query": 3},
+        {"userId": "u", "domain": "d", "query": "ok"},
+    ), 10)
+    errors = [error for _, _, _, error in items]
+    assert errors[0].startswith("Invalid JSON")
+    assert errors[1] == "Item must be a JSON object"
+    assert errors[2] == "Missing or non-string fields: domain, query"
+    assert items[2][1] == 7
+    assert errors[3] is None and items[3][2] is not None
+
+
+@pytest.mark.parametrize("raw, status", [
+    (b"", 400),
+    (b"\n  \n", 400),
+    (b"\xff\xfe", 400),
+    (body(*[{"userId": "u", "domain": "d", "query": "q"}] * 3), 413),
+])
+def test_unusable_bodies_are_refused(raw, status):
+    with pytest.raises(HTTPException) as refused:
+        main.parse_batch(raw, 2)
+    assert refused.value.status_code == status
+
+
+def test_failing_items_only_fail_themselves(monkeypatch):
+    runner = main.BatchRunner(concurrency=2, embed_size=10, item_timeout=5)
+    monkeypatch.setattr(main.embedding, "enabled", False)
+
+    async def answer(session, request):
+        if request.query == "boom":
+            raise RuntimeError("model failed")
+        if request.query == "busy":
+            raise main.Overloaded("queue full", 2)
+        return {"text": f"answer to {request.query}", "products": []}, 1, False
+
+    monkeypatch.setattr(runner, "_answer", answer)
+    items = main.parse_batch(body(
+        {"id": "ok", "userId": "b1", "domain": "d", "query": "acne"},
+        "{not json",
+        {"id": "boom", "userId": "b2", "domain": "d", "query": "boom"},
+        {"id": "busy", "userId": "b3", "domain": "d", "query": "busy"},
+    ), 10)
+
+    async def run():
+        return [result async for result in runner.run(items)]
+
+    results = {result["index"]: result for result in asyncio.run(run())}
+    assert results[0]["status"] == "success"
+    assert results[0]["response"] == "answer to acne"
+    assert (results[1]["status"], results[1]["code"]) == ("error", 400)
+    assert (results[2]["status"], results[2]["code"], results[2]["error"]) == ("error", 500, "model failed")
+    assert (results[3]["code"], results[3]["id"]) == (503, "busy")
+    assert runner.stats()["failed_items"] == 3
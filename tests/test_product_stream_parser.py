@@ -0,0 +1,131 @@
+"""
+ProductStreamParser splits streamed answer text from its <products> XML,
+however the chunks fall.
+"""
+import asyncio
+
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def catalog(monkeypatch):
+    """Resolve every <product> to a record named after its <name>."""
+
+    async def aresolve(domain, references):
+        product_id, name, _ = references
+        if not name:
+            return None
+        return {"id": product_id or name, "name": name}
+
+    monkeypatch.setattr(main.product_catalog, "aresolve", aresolve)
+
+
+def parse(chunks):
+    """Feed ``chunks`` in order; return (text, product names, parser)."""
+    parser = main.ProductStreamParser("d")
+
+    async def run():
+        events = []
+        for chunk in chunks:
+            events.extend(await parser.feed(chunk))
+        return events + parser.close()
+
+    events = asyncio.run(run())
+    text = "".join(data for event, data in events if event == "token")
+    products = [data["name"] for event, data in events if event == "product"]
+    return text, products, parser
+
+
+def test_plain_text_passes_through():
+    text, products, parser = parse(["Use a ", "gentle cleanser."])
+    assert text == "Use a gentle cleanser."
+    assert products == []
+    assert not parser.text_complete
+
+
+def test_angle_bracket_that_is_not_a_tag_is_released():
+    text, _, _ = parse(["if a < b", " then"])
+    assert text == "if a < b then"
+
+
+def test_partial_tag_at_the_end_is_flushed_by_close():
+    text, _, _ = parse(["Done <pro"])
+    assert text == "Done <pro"
+
+
+def test_tags_split_across_chunks():
+    chunks = [
+        "Try these. <prod",
+        "ucts><product><name>Alpha</na",
+        "me></product><prod",
+        "uct><name>Beta</name></product></prod",
+        "ucts> Enjoy!",
+    ]
+    text, products, parser = parse(chunks)
+    assert text == "Try these.  Enjoy!"
+    assert products == ["Alpha", "Beta"]
+    assert parser.text_complete
+
+
+def test_text_is_complete_once_the_block_opens():
+    parser = main.ProductStreamParser("d")
+
+    async def run():
+        await parser.feed("Answer text <products><product><name>A")
+        return parser.text_complete, parser.text
+
+    assert asyncio.run(run()) == (True, "Answer text ")
+
+
+def test_products_are_emitted_as_each_closes():
+    parser = main.ProductStreamParser("d")
+
+    async def run():
+        first = await parser.feed("<products><product><name>A</name></product>")
+        second = await parser.feed("<product><name>B</name>")
+        third = await parser.feed("</product></products>")
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+    assert [data["name"] for _, data in first] == ["A"]
+    assert second == []
+    assert [data["name"] for _, data in third] == ["B"]
+
+
+def test_later_products_blocks_are_suppressed():
+    text, products, _ = parse([
+        "Pick <products><product><name>A</name></product></products>",
+        " or <products><product><name>B</name></product></products> too",
+    ])
+    assert products == ["A"]
+    assert text == "Pick  or  too"
+
+
+def test_repeated_products_are_emitted_once():
+    _, products, _ = parse([
+        "<products><product><name>A</name></product><product><name>A</name></product></products>",
+    ])
+    assert products == ["A"]
+
+
+def test_unescaped_ampersand():
+    _, products, _ = parse(["<products><product><name>Salt & Stone</name></product></products>"])
+    assert products == ["Salt & Stone"]
+
+
+def test_malformed_xml_keeps_earlier_products_and_later_text():
+    text, products, _ = parse([
+        "Here <products><product><name>A</name></product>",
+        "<product><name>B</nam></product>",
+        "<product><name>C</name></product></products> bye",
+    ])
+    assert products == ["A"]
+    assert text == "Here  bye"
+
+
+def test_unclosed_block_text_is_never_released():
+    text, products, _ = parse(["Hi <products><product><name>A</name></product>"])
+    assert text == "Hi "
+    assert products == ["A"]
@@ -0,0 +1,78 @@
+"""
+PromptBudget keeps the newest history and the best ranked documents that fit
+the answer prompt's token budget. Tokens are counted as words here.
+"""
+import pytest
+from langchain.schema import AIMessage, Document, HumanMessage, SystemMessage
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(main, "count_tokens", lambda text: len(text.split()))
+
+
+def budget(total=100, history=100, min_doc=3, static=0):
+    prompt_budget = main.PromptBudget(total, history, min_doc)
+    prompt_budget._static_tokens = static
+    return prompt_budget
+
+
+def test_history_keeps_the_newest_turns_that_fit():
+    turns = [("first question", "first answer"), ("second question", "second answer"), ("third question", "third answer")]
+    # Each turn is "Human: ... / Assistant: ..." = 6 words
+    history = budget(history=12).format_history(turns)
+    assert "first" not in history
+    assert history == "\nHuman: second question\nAssistant: second answer\nHuman: third question\nAssistant: third answer"
+
+
+def test_summary_is_kept_ahead_of_the_turns():
+    # The summary line takes 8 words, leaving room for one 6-word turn
+    history = budget(history=14).format_history([
+        SystemMessage(content="talked about acne"),
+        ("old question", "old answer"),
+        ("new question", "new answer"),
+    ])
+    assert history.startswith("\nSummary of the earlier conversation: talked about acne")
+    assert "new question" in history
+    assert "old question" not in history
+
+
+def test_message_history_is_grouped_into_turns():
+    history = budget().format_history([HumanMessage(content="hi"), AIMessage(content="hello")])
+    assert history == "\nHuman: hi\nAssistant: hello"
+
+
+def test_product_xml_in_past_answers_is_collapsed_to_names():
+    answer = "Try these. <products><product><name>Alpha</name><price>10</price></product><product><name>Beta</name></product></products>"
+    history = budget().format_history([("what helps?", answer)])
+    assert history == "\nHuman: what helps?\nAssistant: Try these. [Recommended products: Alpha; Beta]"
+
+
+def test_documents_fill_the_remaining_budget_in_rank_order():
+    docs = [Document(page_content="one two three"), Document(page_content="four five six"), Document(page_content="seven eight nine")]
+    # 20 total - 5 static - 2 history - 1 question = 12; each document costs 3 words + 1 separator
+    fitted = budget(total=20, static=5).fit_documents(docs, "question", "two words")
+    assert [doc.page_content for doc in fitted] == ["one two three", "four five six", "seven eight nine"]
+
+    fitted = budget(total=16, static=5, min_doc=2).fit_documents(docs, "question", "two words")
+    # 8 tokens left: two documents fit whole and nothing is left to truncate into
+    assert [doc.page_content for doc in fitted] == ["one two three", "four five six"]
+
+
+def test_last_document_is_truncated_when_enough_budget_remains():
+    docs = [Document(page_content="a b c"), Document(page_content="d e f g h i j k l m", metadata={"row": 1})]
+    # 12 tokens: 4 for the first document, 8 left for the second (needs 11)
+    fitted = budget(total=12, min_doc=3).fit_documents(docs, "", "")
+    assert fitted[0].page_content == "a b c"
+    second = fitted[1]
+    assert second.metadata == {"row": 1}
+    assert 0 < len(second.page_content.split()) + 1 <= 8
+
+
+def test_documents_stop_when_too_little_budget_remains():
+    docs = [Document(page_content="a b c"), Document(page_content="d e f g h i j k l m")]
+    # 6 tokens: 2 left after the first document, below min_doc
+    fitted = budget(total=6, min_doc=3).fit_documents(docs, "", "")
+    assert [doc.page_content for doc in fitted] == ["a b c"]
@@ -0,0 +1,65 @@
+"""
+Concurrent turns for one (user_id, domain) session must run one at a time,
+even when the cached session is evicted or goes stale mid-turn.
+"""
+import asyncio
+
+import main
+
+
+def run_turns(store, user_id, domain, count, during_turn):
+    running, overlaps = [0], []
+
+    async def turn(index):
+        session = store.get(user_id, domain)
+        async with main.session_turn(session):
+            running[0] += 1
+            if running[0] > 1:
+                overlaps.append(index)
+            during_turn(index)
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+
+    async def run():
+        await asyncio.gather(*(turn(index) for index in range(count)))
+
+    asyncio.run(run())
+    return overlaps
+
+
+def test_turns_do_not_overlap_when_session_is_evicted():
+    store = main.SessionStore(max_size=1, idle_ttl=3600)
+    # Each turn loads another user's session, which would evict this one
+    overlaps = run_turns(store, "u", "d", 5, lambda index: store.get(f"other-{index}", "d"))
+    assert overlaps == []
+    assert len(main.session_locks) == 0
+
+
+def test_turns_do_not_overlap_when_session_goes_stale(monkeypatch):
+    store = main.SessionStore(max_size=10, idle_ttl=3600)
+    # Another worker is always ahead, so every version check finds the copy stale
+    monkeypatch.setattr(main.session_backend, "version", lambda user_id, domain: 10**6)
+    sessions_seen = []
+    overlaps = run_turns(store, "u", "d", 5, lambda index: sessions_seen.append(store.get("u", "d")))
+    assert overlaps == []
+    # A session with a turn in progress is kept rather than replaced
+    assert all(session is sessions_seen[0] for session in sessions_seen)
+
+
+def test_turns_on_separate_session_objects_share_the_lock():
+    # A batch-local session and the cached one for the same key
+    first = main.UserSession("d", "u2")
+    second = main.UserSession("d", "u2")
+    order = []
+
+    async def turn(session, name):
+        async with main.session_turn(session):
+            order.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            order.append(f"{name} end")
+
+    async def run():
+        await asyncio.gather(turn(first, "a"), turn(second, "b"))
+
+    asyncio.run(run())
+    assert order == ["a start", "a end", "b start", "b end"]
@@ -0,0 +1,118 @@
+"""
+Compare the in-process NumPy vector index against Chroma.
+
+Reports recall@k of the index's top-k and overlap of its MMR results with
+Chroma's, plus per-query latency for both, as JSON:
+
+    python vector_index_check.py --k 10 --dtypes float32 float16 int8
+    python vector_index_check.py --queries queries.txt
+
+Without ``--queries`` the stored document vectors, with some noise added,
+are used as queries so no embedding calls are made.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import main
+
+
+def percentile_ms(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000, 3) if samples else None
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - started
+
+
+def latency(samples):
+    return {"p50_ms": percentile_ms(samples, 50), "p95_ms": percentile_ms(samples, 95)}
+
+
+def load_queries(args, vectordb):
+    if args.queries:
+        with open(args.queries) as f:
+            texts = [line.strip() for line in f if line.strip()]
+        return np.asarray(main.embedding.embed_documents(texts), dtype=np.float32)
+
+    vectors = np.asarray(vectordb.get(include=["embeddings"])["embeddings"], dtype=np.float32)
+    rng = np.random.default_rng(args.seed)
+    picked = vectors[rng.choice(len(vectors), size=min(args.samples, len(vectors)), replace=False)]
+    noise = rng.normal(scale=args.noise, size=picked.shape).astype(np.float32)
+    return picked + noise
+
+
+def check(index, vectordb, queries, k, fetch_k, lambda_mult):
+    collection = vectordb._collection
+    recalls, overlaps = [], []
+    chroma_topk, chroma_mmr, index_topk, index_mmr = [], [], [], []
+
+    index.ensure_loaded()
+    for vector in queries:
+        expected, seconds = timed(lambda: collection.query(query_embeddings=[vector.tolist()], n_results=k))
+        chroma_topk.append(seconds)
+        found, seconds = timed(lambda: index.search([vector], k)[0][0])
+        index_topk.append(seconds)
+        expected_ids = set(expected["ids"][0])
+        recalls.append(len(expected_ids & set(index.ids(found))) / max(len(expected_ids), 1))
+
+        expected, seconds = timed(lambda: vectordb.max_marginal_relevance_search_by_vector(
+            vector.tolist(), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult
+        ))
+        chroma_mmr.append(seconds)
+        found, seconds = timed(lambda: index.mmr(vector, k, fetch_k, lambda_mult))
+        index_mmr.append(seconds)
+        expected_texts = {doc.page_content for doc in expected}
+        found_texts = {doc.page_content for doc in index.documents(found)}
+        overlaps.append(len(expected_texts & found_texts) / max(len(expected_texts), 1))
+
+    _, batch_seconds = timed(lambda: index.search(queries, k))
+    return {
+        "index": index.stats(),
+        "recall_at_k": round(float(np.mean(recalls)), 4),
+        "mmr_overlap": round(float(np.mean(overlaps)), 4),
+        "latency": {
+            "chroma_topk": latency(chroma_topk),
+            "index_topk": latency(index_topk),
+            "chroma_mmr": latency(chroma_mmr),
+            "index_mmr": latency(index_mmr),
+            "index_batch_per_query_ms": round(batch_seconds / len(queries) * 1000, 4),
+        },
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--fetch-k", type=int, default=20)
+    parser.add_argument("--lambda-mult", type=float, default=0.5)
+    parser.add_argument("--collection", default=main.DOMAIN_FALLBACK_COLLECTION)
+    parser.add_argument("--dtypes", nargs="+", default=["float32", "float16", "int8"])
+    parser.add_argument("--queries", help="File with one query per line (embedded with the app's model)")
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--noise", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectordb = main.chroma_store(args.collection)
+    queries = load_queries(args, vectordb)
+    results = {"queries": len(queries), "k": args.k}
+    for dtype in args.dtypes:
+        index = main.NumpyVectorIndex(
+            vectordb,
+            os.path.join(main.VECTOR_INDEX_DIR, args.collection),
+            dtype,
+            main.VECTOR_INDEX_HNSW_THRESHOLD,
+            main.corpus,
+        )
+        results[dtype] = check(index, vectordb, queries, args.k, args.fetch_k, args.lambda_mult)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()